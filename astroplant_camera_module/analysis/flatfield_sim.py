@@ -0,0 +1,230 @@
+"""
+Implementation of the flatfield illumination simulator.
+Predicts the illumination of the ground plane of a kit with mirrored walls, lit by four diffuse light sources around the center of the top plate. Reflections in the walls are modelled with the image method up to the seventh order.
+"""
+
+import os
+import concurrent.futures
+
+import numpy as np
+
+
+# image sources used by the image method, per reflection order: (row block, column block, flip)
+# blocks are indices into a 15x15 grid of n by n blocks centered on block (7, 7), which is the ground plane itself
+# flip is None, 0 (flip rows), 1 (flip columns) or 2 (flip both)
+IMAGES = [
+    # first order
+    [(7, 7, None)],
+    # second order
+    [(6, 7, 0), (8, 7, 0), (7, 6, 1), (7, 8, 1)],
+    # third order
+    [(5, 7, None), (9, 7, None), (7, 5, None), (7, 9, None), (6, 6, 2), (8, 6, 2), (6, 8, 2), (8, 8, 2)],
+    # fourth order
+    [(4, 7, 0), (10, 7, 0), (7, 4, 1), (7, 10, 1), (6, 5, 0), (6, 9, 0), (8, 5, 0), (8, 9, 0),
+     (5, 6, 1), (9, 6, 1), (5, 8, 1), (9, 8, 1)],
+    # fifth order
+    [(3, 7, None), (11, 7, None), (7, 3, None), (7, 11, None), (5, 5, None), (5, 9, None), (9, 5, None), (9, 9, None),
+     (6, 4, 2), (6, 10, 2), (8, 4, 2), (8, 10, 2), (4, 6, 2), (10, 6, 2), (4, 8, 2), (10, 8, 2)],
+    # sixth order
+    [(2, 7, 0), (12, 7, 0), (7, 2, 1), (7, 12, 1), (4, 5, 0), (4, 9, 0), (10, 5, 0), (10, 9, 0),
+     (5, 4, 1), (5, 10, 1), (9, 4, 1), (9, 10, 1), (6, 3, 0), (6, 11, 0), (8, 3, 0), (8, 11, 0),
+     (3, 6, 1), (11, 6, 1), (3, 8, 1), (11, 8, 1)],
+    # seventh order
+    [(1, 7, None), (13, 7, None), (7, 1, None), (7, 13, None), (4, 4, 2), (4, 10, 2), (10, 4, 2), (10, 10, 2),
+     (5, 3, None), (5, 11, None), (9, 3, None), (9, 11, None), (3, 5, None), (11, 5, None), (3, 9, None), (11, 9, None),
+     (2, 6, 1), (12, 6, 1), (6, 2, 0), (6, 12, 0), (2, 8, 1), (12, 8, 1), (8, 2, 0), (8, 12, 0)],
+]
+
+# cache of simulated ground plane fields, keyed on geometry and height
+_cache = dict()
+
+
+def flip(a, kind):
+    """
+    Flip the last two axes of an array.
+
+    :param a: array of shape (..., n, n)
+    :param kind: None, 0 (flip rows), 1 (flip columns) or 2 (flip both)
+    :return: flipped array
+    """
+
+    if kind == 0:
+        return a[..., ::-1, :]
+    elif kind == 1:
+        return a[..., :, ::-1]
+    elif kind == 2:
+        return a[..., ::-1, ::-1]
+
+    return a
+
+
+def ground_distances(n, w):
+    """
+    Compute the squared distance in the ground plane between the light source (offset by half a kit radius in both directions) and every pixel of every image block that is used.
+
+    :param n: resolution of the ground plane in pixels
+    :param w: width of the kit in meters
+    :return: (list of blocks (row, column), array of squared distances with shape (blocks, n, n))
+    """
+
+    r = w/2
+
+    # the grid of the original simulation: 15 blocks of n pixels, the source at -0.5r in both directions
+    x = np.linspace(-15*r - 0.5*r, 15*r - 0.5*r, 15*n)
+    blocks = sorted(set((rb, cb) for order in IMAGES for rb, cb, f in order))
+
+    dist_gp = np.empty((len(blocks), n, n))
+    for k, (rb, cb) in enumerate(blocks):
+        yb = x[rb*n:(rb + 1)*n]
+        xb = x[cb*n:(cb + 1)*n]
+        dist_gp[k] = np.square(xb)[np.newaxis, :] + np.square(yb)[:, np.newaxis]
+
+    return (blocks, dist_gp)
+
+
+def simulate_heights(heights, n = 100, w = 0.41, R = 0.92, I0 = 1.0):
+    """
+    Simulate the ground plane illumination for a batch of kit heights at once. All heights are computed together and only the image blocks that are actually used are evaluated.
+
+    :param heights: array of effective heights (distance between top plate and ground plane) in meters
+    :param n: resolution of the ground plane in pixels
+    :param w: width of the kit in meters
+    :param R: reflectivity of the walls
+    :param I0: brightness of a single light source
+    :return: array of shape (heights, 2n, 2n) containing the field as seen by the camera, including the views on the walls
+    """
+
+    heights = np.asarray(heights, dtype=np.float64)
+    blocks, dist_gp = ground_distances(n, w)
+    index = {block: k for k, block in enumerate(blocks)}
+
+    # first order intensity of all blocks for all heights, shape (heights, blocks, n, n)
+    # cos(arctan(t))^2 is computed as 1/(1 + t^2) to save the trigonometry
+    h2 = np.square(heights)[:, np.newaxis, np.newaxis, np.newaxis]
+    t = dist_gp[np.newaxis]/h2
+    first_order = I0/((dist_gp[np.newaxis] + h2)*(1.0 + np.square(t)))
+
+    # flips are linear, so all blocks with the same flip are summed (weighted) first and flipped once
+    weights = np.zeros((4, len(blocks)))
+    for order, images in enumerate(IMAGES):
+        for rb, cb, f in images:
+            weights[3 if f is None else f, index[(rb, cb)]] += R**order
+
+    center = np.zeros((len(heights), n, n))
+    for f in [None, 0, 1, 2]:
+        center += flip(np.tensordot(first_order, weights[3 if f is None else f], axes=([1], [0])), f)
+
+    # the four light sources are mirror images of each other
+    center = center + flip(center, 0) + flip(center, 1) + flip(center, 2)
+
+    # view on the (first and second order) reflective walls around the ground plane
+    field = np.zeros((len(heights), 2*n, 2*n))
+    field[:, n//2:3*n//2, n//2:3*n//2] = center
+    field[:, 0:n//2, n//2:3*n//2] = R*flip(field[:, n//2:n, n//2:3*n//2], 0)
+    field[:, 3*n//2:2*n, n//2:3*n//2] = R*flip(field[:, n:3*n//2, n//2:3*n//2], 0)
+    field[:, n//2:3*n//2, 0:n//2] = R*flip(field[:, n//2:3*n//2, n//2:n], 1)
+    field[:, n//2:3*n//2, 3*n//2:2*n] = R*flip(field[:, n//2:3*n//2, n:3*n//2], 1)
+    field[:, 0:n//2, 0:n//2] = R*R*flip(field[:, n//2:n, n//2:n], 2)
+    field[:, 3*n//2:2*n, 0:n//2] = R*R*flip(field[:, n:3*n//2, n//2:n], 2)
+    field[:, 0:n//2, 3*n//2:2*n] = R*R*flip(field[:, n//2:n, n:3*n//2], 2)
+    field[:, 3*n//2:2*n, 3*n//2:2*n] = R*R*flip(field[:, n:3*n//2, n:3*n//2], 2)
+
+    return field
+
+
+def order_contributions(h, n = 100, w = 0.41, R = 0.92, I0 = 1.0):
+    """
+    Compute the contribution of every reflection order to the ground plane illumination of a single light source, mostly useful for plotting.
+
+    :param h: effective height in meters
+    :param n: resolution of the ground plane in pixels
+    :param w: width of the kit in meters
+    :param R: reflectivity of the walls
+    :param I0: brightness of a single light source
+    :return: list of arrays of shape (n, n), one per order
+    """
+
+    blocks, dist_gp = ground_distances(n, w)
+    index = {block: k for k, block in enumerate(blocks)}
+
+    first_order = I0/((dist_gp + h*h)*(1.0 + np.square(dist_gp/(h*h))))
+
+    return [sum(R**order*flip(first_order[index[(rb, cb)]], f) for rb, cb, f in images) for order, images in enumerate(IMAGES)]
+
+
+def illumination(heights, n = 100, w = 0.41, R = 0.92, I0 = 1.0, batch = 8, processes = 1, cache_dir = None):
+    """
+    Predict the illumination field for a kit geometry at the given heights. Results are cached per geometry and height (in memory and optionally on disk), heights that are not cached yet are simulated in batches, optionally spread over a pool of processes.
+
+    :param heights: list of effective heights (distance between top plate and ground plane) in meters
+    :param n: resolution of the ground plane in pixels
+    :param w: width of the kit in meters
+    :param R: reflectivity of the walls
+    :param I0: brightness of a single light source
+    :param batch: number of heights simulated at once, limits memory use
+    :param processes: number of processes used for the simulation
+    :param cache_dir: if given, simulated fields are also cached as .npy files in this directory
+    :return: array of shape (heights, 2n, 2n)
+    """
+
+    heights = [float(h) for h in np.atleast_1d(heights)]
+    keys = [(n, w, R, I0, h) for h in heights]
+
+    # look up what is cached already
+    missing = []
+    for key in keys:
+        if key in _cache:
+            continue
+
+        path = cache_path(cache_dir, key)
+        if path is not None and os.path.isfile(path):
+            _cache[key] = np.load(path)
+        elif key[-1] not in missing:
+            missing.append(key[-1])
+
+    # simulate the rest in batches
+    chunks = [missing[i:i + batch] for i in range(0, len(missing), batch)]
+    if processes > 1 and len(chunks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            fields = list(pool.map(simulate_heights, chunks, *zip(*[(n, w, R, I0)]*len(chunks))))
+    else:
+        fields = [simulate_heights(chunk, n, w, R, I0) for chunk in chunks]
+
+    for chunk, field in zip(chunks, fields):
+        for h, f in zip(chunk, field):
+            key = (n, w, R, I0, h)
+            _cache[key] = f
+
+            path = cache_path(cache_dir, key)
+            if path is not None:
+                np.save(path, f)
+
+    return np.stack([_cache[key] for key in keys])
+
+
+def cache_path(cache_dir, key):
+    """
+    Get the path of the on disk cache file for a geometry and height.
+
+    :param cache_dir: cache directory, or None if there is no disk cache
+    :param key: tuple (n, w, R, I0, h)
+    :return: path or None
+    """
+
+    if cache_dir is None:
+        return None
+
+    return "{}/ff_{}_{:.6g}_{:.6g}_{:.6g}_{:.6g}.npy".format(cache_dir, *key)
+
+
+def ground_plane_mean(field):
+    """
+    Average intensity of the ground plane (so excluding the view on the walls) of one or more simulated fields.
+
+    :param field: array of shape (..., 2n, 2n)
+    :return: mean per field
+    """
+
+    n = field.shape[-1]//2
+
+    return np.mean(field[..., n//2:3*n//2, n//2:3*n//2], axis=(-2, -1))
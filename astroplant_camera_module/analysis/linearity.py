@@ -0,0 +1,218 @@
+"""
+Implementation of the linearity analysis.
+Computes region of interest statistics over a sweep of frames (as saved by supporting-scripts/linearity-test/linearity_test.py) and fits the response of the sensor to exposure time, analog gain and digital gain.
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+
+# index of the swept parameter in a sweep setting [framerate, shutter speed, analog gain, digital gain]
+SHUTTER_SPEED = 1
+ANALOG_GAIN = 2
+DIGITAL_GAIN = 3
+
+PARAMETER_NAMES = {SHUTTER_SPEED: "shutter_speed", ANALOG_GAIN: "analog_gain", DIGITAL_GAIN: "digital_gain"}
+
+
+def frame_paths(directory, n = None):
+    """
+    Get the paths of the frames of a sweep, which are saved as <index>.np.
+
+    :param directory: directory containing the frames
+    :param n: number of frames, if None all consecutive frames starting at 0 are used
+    :return: list of paths
+    """
+
+    paths = []
+    i = 0
+    while n is None or i < n:
+        path = "{}/{}.np".format(directory, i)
+        if not os.path.isfile(path):
+            if n is not None:
+                raise FileNotFoundError(path)
+            break
+        paths.append(path)
+        i += 1
+
+    return paths
+
+
+def stream_rois(paths, rois):
+    """
+    Extract the regions of interest of all frames. Frames are memory mapped, so only the pages containing the regions are actually read from disk and never more than one frame is mapped at a time.
+
+    :param paths: paths of the frames
+    :param rois: list of regions of interest as [x1, y1, x2, y2]
+    :return: list with an array of shape (frames, height, width, channels) per region
+    """
+
+    stacks = None
+
+    for i, path in enumerate(paths):
+        frame = np.load(path, mmap_mode='r')
+
+        if stacks is None:
+            stacks = [np.empty((len(paths), roi[3] - roi[1], roi[2] - roi[0]) + frame.shape[2:], dtype=frame.dtype) for roi in rois]
+
+        for stack, roi in zip(stacks, rois):
+            stack[i] = frame[roi[1]:roi[3], roi[0]:roi[2]]
+
+        del frame
+
+    return stacks
+
+
+def roi_statistics(paths, rois):
+    """
+    Compute the mean and standard deviation per channel of every region of interest in every frame.
+
+    :param paths: paths of the frames
+    :param rois: list of regions of interest as [x1, y1, x2, y2]
+    :return: (means, stds), both arrays of shape (frames, regions, channels)
+    """
+
+    stacks = stream_rois(paths, rois)
+
+    # all frames are reduced at once per region
+    means = np.stack([np.mean(stack, axis=(1, 2)) for stack in stacks], axis=1)
+    stds = np.stack([np.std(stack, axis=(1, 2)) for stack in stacks], axis=1)
+
+    return (means, stds)
+
+
+def split_sweep(settings):
+    """
+    Split a sweep into segments in which only one parameter (shutter speed, analog gain or digital gain) increases while the others stay the same. Segments are found greedily, taking the longest possible segment at every point.
+
+    :param settings: list of settings [framerate, shutter speed, analog gain, digital gain]
+    :return: list of (parameter index, first frame, last frame + 1)
+    """
+
+    segments = []
+    i = 0
+    while i < len(settings):
+        best = (SHUTTER_SPEED, i + 1)
+        for p in PARAMETER_NAMES:
+            others = [q for q in PARAMETER_NAMES if q != p]
+            j = i + 1
+            while j < len(settings) and settings[j][p] > settings[j - 1][p] and all(settings[j][q] == settings[i][q] for q in others):
+                j += 1
+            if j > best[1]:
+                best = (p, j)
+
+        segments.append((best[0], i, best[1]))
+        i = best[1]
+
+    return segments
+
+
+def fit_response(settings, means, segments):
+    """
+    Fit a linear response (pixel value = slope*parameter + offset) for every segment, region and channel at once.
+
+    :param settings: list of settings [framerate, shutter speed, analog gain, digital gain]
+    :param means: array of shape (frames, regions, channels) as returned by roi_statistics
+    :param segments: list of (parameter index, first frame, last frame + 1)
+    :return: dict per parameter name containing x, slope, offset and r2 (the latter three of shape (regions, channels))
+    """
+
+    curves = dict()
+
+    for p, start, stop in segments:
+        x = np.array([float(s[p]) for s in settings[start:stop]])
+        y = means[start:stop].reshape(stop - start, -1)
+
+        if len(x) < 2:
+            continue
+
+        # polyfit fits all regions and channels in one go when y is 2d
+        slope, offset = np.polyfit(x, y, 1)
+
+        residual = y - (np.outer(x, slope) + offset)
+        total = y - np.mean(y, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r2 = 1.0 - np.sum(residual**2, axis=0)/np.sum(total**2, axis=0)
+
+        curve = dict()
+        curve["x"] = x
+        curve["slope"] = slope.reshape(means.shape[1:])
+        curve["offset"] = offset.reshape(means.shape[1:])
+        curve["r2"] = r2.reshape(means.shape[1:])
+        curve["range"] = np.array([start, stop])
+        curves[PARAMETER_NAMES[p]] = curve
+
+    return curves
+
+
+def save_calibration(path, curves, rois):
+    """
+    Save the fitted response curves as a compressed numpy archive. Keys are <parameter>_<field>, for example analog_gain_slope.
+
+    :param path: path of the archive
+    :param curves: dict as returned by fit_response
+    :param rois: list of regions of interest as [x1, y1, x2, y2]
+    """
+
+    arrays = dict()
+    arrays["rois"] = np.array(rois)
+    for name, curve in curves.items():
+        for field, value in curve.items():
+            arrays["{}_{}".format(name, field)] = value
+
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def load_calibration(path):
+    """
+    Load response curves saved by save_calibration.
+
+    :param path: path of the archive
+    :return: (curves, rois)
+    """
+
+    curves = dict()
+    with np.load(path) as archive:
+        rois = archive["rois"].tolist()
+        for name in PARAMETER_NAMES.values():
+            fields = [key for key in archive.files if key.startswith(name + "_")]
+            if fields:
+                curves[name] = {key[len(name) + 1:]: archive[key] for key in fields}
+
+    return (curves, rois)
+
+
+def analyze_sweep(directory, rois, segments = None, calibration_path = None):
+    """
+    Analyze a complete sweep as saved by linearity_test.py: compute the region statistics, fit the response curves and optionally save them.
+
+    :param directory: directory containing settings.pkl and the dat folder with the frames
+    :param rois: list of regions of interest as [x1, y1, x2, y2]
+    :param segments: list of (parameter index, first frame, last frame + 1), detected from the settings if None
+    :param calibration_path: if given, the response curves are saved here
+    :return: dict containing the settings, means, stds and curves
+    """
+
+    with open("{}/settings.pkl".format(directory), 'rb') as f:
+        settings = pickle.load(f)
+
+    paths = frame_paths("{}/dat".format(directory), len(settings))
+    means, stds = roi_statistics(paths, rois)
+
+    if segments is None:
+        segments = split_sweep(settings)
+    curves = fit_response(settings, means, segments)
+
+    if calibration_path is not None:
+        save_calibration(calibration_path, curves, rois)
+
+    res = dict()
+    res["settings"] = settings
+    res["means"] = means
+    res["stds"] = stds
+    res["curves"] = curves
+
+    return res
@@ -9,15 +9,26 @@ import picamera
 import os
 import cv2
 import numpy as np
-import subprocess
 import multiprocessing as mp
 
 from fractions import Fraction
 from PIL import Image
 
 from astroplant_camera_module.core.camera import CAMERA
+from astroplant_camera_module.core.encoder import ENCODER
+from astroplant_camera_module.core.roi_stats import ROI_STATS
 from astroplant_camera_module.core.ndvi import NDVI
+from astroplant_camera_module.core.exposure import EXPOSURE_PLANNER
+from astroplant_camera_module.core.parallel import PARALLEL
+from astroplant_camera_module.core.frame_ring import CAPTURE_PROCESS, run_command
+from astroplant_camera_module.core.quality import QUALITY_GATE
+from astroplant_camera_module.core.calibration import CALIBRATION_PLANNER
+from astroplant_camera_module.core.timelapse import TIMELAPSE
+from astroplant_camera_module.core.change import CHANGE_DETECTOR
+from astroplant_camera_module.core.watchdog import WATCHDOG
+from astroplant_camera_module.cameras.picamera_backend import PICAMERA_BACKEND
 from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.misc.trace import tracer
 from astroplant_camera_module.typedef import LC
 from astroplant_camera_module.misc.helper import light_control_dummy
 
@@ -61,6 +72,102 @@ class SETTINGS_V5(object):
         self.exposure_mode = "off"
         self.exposure_compensation = 0
 
+        # image encoding, see core/encoder.py for all available options
+        self.encoder = dict()
+        self.encoder["photo_format"] = "jpg"
+        self.encoder["jpeg_quality"] = 90
+        self.encoder["ndvi_format"] = "tif16"
+        self.encoder["pyramid_levels"] = 3
+
+        # append every photo to a daily motion jpeg segment per kind, taking the frame from this pyramid level of the
+        # encoder so nothing is encoded again (None to disable), see core/timelapse.py
+        self.timelapse = dict()
+        self.timelapse["level"] = 2
+
+        # seconds the lights need to settle after being switched (on, off), the growth lighting tends to ramp up slowly
+        self.light_settle = dict()
+        self.light_settle[LC.WHITE] = (0.05, 0.05)
+        self.light_settle[LC.RED] = (0.05, 0.05)
+        self.light_settle[LC.NIR] = (0.05, 0.05)
+        self.light_settle[LC.GROWTH] = (0.5, 0.5)
+
+        # with raspistill, let a persistent capture process write the frames into shared memory instead of spawning a
+        # process and writing bmp files per frame
+        self.frame_ring = True
+
+        # plan the gains and shutter speed of every capture from the previous one instead of running update() daily,
+        # see core/exposure.py for all available options
+        self.exposure_planner = True
+        self.exposure = dict()
+        self.exposure["target"] = 0.45
+        self.exposure["highlight"] = 0.95
+        self.exposure["saturation_limit"] = 0.001
+        self.exposure["ff_range"] = (0.67, 1.5)
+
+        # check every capture for saturation, black clipping, the level of the ground plane and blur right after it is
+        # decoded, and retry failing captures within a latency budget (None to disable), see core/quality.py for all
+        # available options
+        self.quality = dict()
+        self.quality["retries"] = 2
+        self.quality["budget"] = 15.0
+        self.quality["max_saturation"] = 0.01
+        self.quality["max_black"] = 0.25
+
+        # reuse the previous result of a command if its captures did not change (more than tolerance in more than
+        # max_changed of the cells of a downsampled signature) and it is less than max_age seconds old, instead of
+        # processing and writing everything again (None to disable), see core/change.py for all available options
+        self.change = dict()
+        self.change["tolerance"] = 0.05
+        self.change["max_changed"] = 0.01
+        self.change["max_age"] = 6*3600
+
+        # deadlines in seconds of the stages that run in a worker process (workers that hang are killed), and the retries of
+        # captures that failed, with a backoff that doubles every retry, within a budget, see core/watchdog.py
+        self.watchdog = dict()
+        self.watchdog["deadlines"] = {"exposure": 30, "plot": 60}
+        self.watchdog["retries"] = 2
+        self.watchdog["backoff"] = 1.0
+        self.watchdog["budget"] = 90.0
+
+        # the calibration of a light channel is stale after this many seconds, CC.CALIBRATE_STALE only calibrates the
+        # stale (or failed) channels, see core/calibration.py
+        self.calibration = dict()
+        self.calibration["max_age"] = 30*24*3600
+
+        # only read out the crop from the sensor instead of cropping the full frame afterwards
+        self.sensor_roi = True
+
+        # capture frames in process with a single picamera session ("picamera") or with raspistill ("raspistill")
+        self.backend = "picamera"
+
+        # post-processing of independent channels runs concurrently in a bounded number of threads (leaving cores
+        # free for capturing), large arrays are split into chunks of rows, see core/parallel.py
+        self.parallel = dict()
+        self.parallel["max_workers"] = 2
+        self.parallel["chunk_rows"] = 304
+
+        # register the nir frame onto the red frame before computing the ndvi (None to disable),
+        # see core/registration.py for all available options
+        self.registration = dict()
+        self.registration["levels"] = 2
+        self.registration["max_shift"] = 40
+
+        # compute the ndvi by looking up every (red, nir) pair in a precomputed table instead of per pixel
+        self.ndvi_lut = True
+
+        # vegetation indices computed next to the ndvi, as expressions over the calibrated planes R and NIR (reflectance)
+        # and WR, WG and WB (white image, an extra capture), for example "WG / (WR + WG + WB)" or "NIR / (WR + WG + WB)",
+        # reported as extra values of CC.NDVI and CC.NDVI_PHOTO (None for none), see core/indices.py
+        self.indices = dict()
+        self.indices["SR"] = "NIR / R"
+
+        # CC.NDVI only returns the mean, so it captures at the readout resolution divided by this factor, with its own
+        # flatfield calibration (None to use the full resolution)
+        self.quick_ndvi = 4
+
+        # record nested timing spans of every command in cam/res/trace.json (chrome trace format)
+        self.trace = False
+
         self.allowed_channels = [LC.WHITE, LC.GROWTH, LC.RED, LC.NIR]
 
 
@@ -87,6 +194,49 @@ class PI_CAM_NOIR_V21(CAMERA):
         # bind the settings to the camera object
         self.settings = settings
 
+        # let the lights settle according to the settings, unless the user supplied profiles
+        self.lights.set_default_profiles(self.settings.light_settle)
+
+        # determine the part of the sensor that is read out
+        self.setup_readout()
+
+        # set up the in-process capture backend, the session is opened on the first capture
+        if self.settings.backend == "picamera":
+            self.backend = PICAMERA_BACKEND(resolution = self.resolution, zoom = self.zoom)
+
+        # set up the exposure planner
+        self.planner = None
+        if self.settings.exposure_planner:
+            self.planner = EXPOSURE_PLANNER(camera = self, **self.settings.exposure)
+
+        # set up the calibration planner
+        self.calibrator = CALIBRATION_PLANNER(camera = self, **self.settings.calibration)
+
+        # set up the quality gate
+        if self.settings.quality is not None:
+            self.gate = QUALITY_GATE(camera = self, **self.settings.quality)
+
+        # set up the post-processing pool
+        self.pool = PARALLEL(**self.settings.parallel)
+
+        # set up the encoder used to write all images
+        self.encoder = ENCODER(**self.settings.encoder)
+
+        # set up the watchdog
+        self.watchdog = WATCHDOG(**self.settings.watchdog)
+
+        # set up the change detector
+        if self.settings.change is not None:
+            self.change = CHANGE_DETECTOR(camera = self, **self.settings.change)
+
+        # set up the time-lapses
+        if self.settings.timelapse is not None:
+            self.timelapse = TIMELAPSE(working_directory = self.working_directory, **self.settings.timelapse)
+
+        # enable tracing if requested
+        if self.settings.trace:
+            tracer.enabled = True
+
         # set up the light channel array
         self.light_channels = []
         for channel in light_channels:
@@ -131,13 +281,17 @@ class PI_CAM_NOIR_V21(CAMERA):
 
         for channel in self.light_channels:
             # turn on the light
-            self.light_control(channel, 1)
+            self.lights.on(channel)
+
+            d_print("Letting gains settle for the {} channel...", 1, channel)
 
-            d_print("Letting gains settle for the {} channel...".format(channel), 1)
+            # the sensor can only be opened once, so close the session of the capture backend
+            self.close_backend()
 
             with picamera.PiCamera() as sensor:
                 # set up the sensor with all its settings
-                sensor.resolution = self.settings.resolution
+                sensor.resolution = self.resolution
+                sensor.zoom = self.zoom
                 sensor.framerate = self.settings.framerate[channel]
                 sensor.shutter_speed = self.settings.shutter_speed[channel]
 
@@ -174,11 +328,14 @@ class PI_CAM_NOIR_V21(CAMERA):
                     self.config["d2d"][channel]["digital-gain"] = dg
                     self.config["d2d"][channel]["analog-gain"] = ag
 
-                d_print("Measured ag: {} and dg: {} for channel {}".format(ag, dg, channel), 1)
-                d_print("Saved ag: {} and dg: {} for channel {}".format(self.config["d2d"][channel]["analog-gain"], self.config["d2d"][channel]["digital-gain"], channel), 1)
+                # the gains were measured at the shutter speed from the settings
+                self.config["d2d"][channel].pop("shutter-speed", None)
+
+                d_print("Measured ag: {} and dg: {} for channel {}", 1, ag, dg, channel)
+                d_print("Saved ag: {} and dg: {} for channel {}", 1, self.config["d2d"][channel]["analog-gain"], self.config["d2d"][channel]["digital-gain"], channel)
 
-            # turn the light off
-            self.light_control(channel, 0)
+            # release the light
+            self.lights.release(channel)
 
         # update timestamp
         self.config["d2d"]["timestamp"] = time.time()
@@ -187,61 +344,195 @@ class PI_CAM_NOIR_V21(CAMERA):
         self.save_config_to_file()
 
 
-    def capture(self, channel: LC):
+    def capture_once(self, channel: LC, resolution = None):
         """
-        Function that captures an image. Uses raspistill in a separate terminal process to take the picture. This is faster (about 4-5 seconds to take an image on average) due to the possibility to manually set the gains of the camera, something that is not possible in picamera 1.13 (but will probably be in version 1.14 or 1.15).
+        Function that captures an image, together with a dark frame that is subtracted from it. With the picamera backend (see settings.backend) the frames are captured in process from a PiCamera session that is kept open, with the gains set through MMAL. Otherwise raspistill is used in a separate terminal process, which is also the fallback when the userland libraries are too old to set the gains.
 
         :param channel: channel of light in which the photo is taken, used for white balance and gain values
+        :param resolution: (width, height) the frames are scaled down to, None for the full readout resolution
         :return: 8 bit rgb array containing the image
         """
 
-        # check if gain information is available, if not, update first
+        # check if gain information is available, if not, update first (the planner starts from the defaults instead)
         if "d2d" not in self.config:
             self.setup_d2d()
-            self.update()
+            if self.planner is None:
+                self.update()
 
         # turn on the light
-        self.light_control(channel, 1)
+        self.lights.on(channel)
+
+        # the effective gain includes the deviation of the shutter speed from the settings
+        gain = self.config["d2d"][channel]["analog-gain"] * self.config["d2d"][channel]["digital-gain"] * self.shutter_speed(channel)/self.settings.shutter_speed[channel]
+
+        # take the bright and dark picture
+        frames = None
+        if self.backend is not None:
+            try:
+                frames = self.capture_picamera(channel, resolution)
+            except picamera.exc.PiCameraError as e:
+                d_print("picamera backend failed ({}), falling back to raspistill", 3, e)
+                self.backend.close()
+                self.backend = None
+                self.lights.on(channel)
+        if frames is None:
+            frames = self.capture_raspistill(channel)
+            if frames is None:
+                return (None, 0)
+        bright, dark = frames
+
+        # scale the frames down right after decoding if the backend didn't do so already
+        if resolution is not None and bright.shape[1] != resolution[0]:
+            with tracer.span("downsample", channel=channel):
+                bright = cv2.resize(bright, tuple(resolution), interpolation=cv2.INTER_AREA)
+                if dark is not None:
+                    dark = cv2.resize(dark, tuple(resolution), interpolation=cv2.INTER_AREA)
+
+        # perform dark frame subtraction and return the array
+        rgb = bright
+        if channel != LC.GROWTH:
+            with tracer.span("dark frame subtraction", channel=channel):
+                rgb = cv2.subtract(bright, dark)
+
+        if self.planner is not None:
+            # plan the exposure of the next capture of this channel
+            with tracer.span("exposure planning", channel=channel):
+                self.planner.observe(channel, bright, rgb)
+
+        if self.gate is not None:
+            # measure the quality while the bright frame is still available
+            with tracer.span("quality metrics", channel=channel):
+                self.quality[channel] = self.gate.metrics(channel, bright, rgb, gain)
+
+        # give the frame ring slots back, the returned image must not refer to them
+        if self.ring_slots:
+            if rgb is bright:
+                rgb = np.copy(rgb)
+            self.release_frames()
+
+        if self.planner is None and time.time() - self.config["d2d"]["timestamp"] > 3600*24:
+            # if the time since last update is larger than a day, update the gains after the photo
+            self.update()
+
+        return (rgb, gain)
+
+
+    def capture_picamera(self, channel: LC, resolution = None):
+        """
+        Capture the bright and the dark frame with the picamera backend. Expects the light of the channel to be on, and turns it off for the dark frame.
+
+        :param channel: channel of light in which the photo is taken
+        :param resolution: (width, height) the frames are scaled down to by the image processor, None for the full readout resolution
+        :return: (bright, dark), 8 bit rgb arrays
+        """
+
+        with tracer.span("configure", channel=channel):
+            self.backend.configure(framerate = self.settings.framerate[channel], shutter_speed = self.shutter_speed(channel), awb_gains = (self.config["wb"][channel]["r"], self.config["wb"][channel]["b"]), analog_gain = self.config["d2d"][channel]["analog-gain"], digital_gain = self.config["d2d"][channel]["digital-gain"])
+
+        with tracer.span("exposure", channel=channel, frame="bright"):
+            rgb = self.backend.capture(resize = resolution)
+        # turn off the light for the dark frame
+        self.lights.off(channel)
+        dark = None
+        if channel != LC.GROWTH:
+            with tracer.span("exposure", channel=channel, frame="dark"):
+                dark = self.backend.capture(resize = resolution)
+
+        return (rgb, dark)
+
+
+    def capture_raspistill(self, channel: LC):
+        """
+        Capture the bright and the dark frame with raspistill. Expects the light of the channel to be on, and turns it off for the dark frame.
+
+        :param channel: channel of light in which the photo is taken
+        :return: (bright, dark), 8 bit rgb arrays, or None if the child process could not be started or the photo command failed (a worker that hangs is killed by the watchdog, which raises STAGE_TIMEOUT)
+        """
 
         # assemble the terminal command
-        path_to_bright = os.getcwd() + "/cam/tmp/bright.bmp"
-        path_to_dark = os.getcwd() + "/cam/tmp/dark.bmp"
-        gain = self.config["d2d"][channel]["analog-gain"] * self.config["d2d"][channel]["digital-gain"]
+        path_to_bright = self.working_directory + "/cam/tmp/bright.bmp"
+        path_to_dark = self.working_directory + "/cam/tmp/dark.bmp"
+
+        photo_cmd = "raspistill -e bmp -w {} -h {} -ss {} -t 1000 -awb off -awbg {},{} -ag {} -dg {}".format(self.resolution[0], self.resolution[1], self.shutter_speed(channel), self.config["wb"][channel]["r"], self.config["wb"][channel]["b"], self.config["d2d"][channel]["analog-gain"], self.config["d2d"][channel]["digital-gain"])
+        if self.zoom != (0.0, 0.0, 1.0, 1.0):
+            photo_cmd += " -roi {},{},{},{}".format(*self.zoom)
 
-        photo_cmd = "raspistill -e bmp -w {} -h {} -ss {} -t 1000 -awb off -awbg {},{} -ag {} -dg {}".format(self.settings.resolution[0], self.settings.resolution[1], self.settings.shutter_speed[channel], self.config["wb"][channel]["r"], self.config["wb"][channel]["b"], self.config["d2d"][channel]["analog-gain"], self.config["d2d"][channel]["digital-gain"])
+        if self.settings.frame_ring:
+            return self.capture_frame_ring(channel, photo_cmd)
 
         # run command and take bright and dark picture
         # start the bright image capture by spawning a clean process and executing the command, then waiting for the q
         p = mp.Process(target=photo_worker, args=(photo_cmd + " -o {}".format(path_to_bright),))
         try:
-            p.start()
-            p.join()
+            with tracer.span("worker startup", channel=channel, frame="bright"):
+                p.start()
+            with tracer.span("exposure", channel=channel, frame="bright"):
+                self.watchdog.join(p, "exposure")
         except OSError:
             d_print("Could not start child process, out of memory", 3)
-            return (None, 0)
-        # turn off the light
-        self.light_control(channel, 0)
+            return None
+        if p.exitcode != 0:
+            d_print("Photo command failed (exit code {})", 3, p.exitcode)
+            return None
+        # turn off the light for the dark frame
+        self.lights.off(channel)
         # start the dark image capture by spawning a clean process and executing the command, then waiting for the q
         p = mp.Process(target=photo_worker, args=(photo_cmd + " -o {}".format(path_to_dark),))
         try:
-            p.start()
-            p.join()
+            with tracer.span("worker startup", channel=channel, frame="dark"):
+                p.start()
+            with tracer.span("exposure", channel=channel, frame="dark"):
+                self.watchdog.join(p, "exposure")
         except OSError:
             d_print("Could not start child process, out of memory", 3)
-            return (None, 0)
+            return None
+        if p.exitcode != 0:
+            d_print("Photo command failed (exit code {})", 3, p.exitcode)
+            return None
 
-        # load the images from file, perform dark frame subtraction and return the array
-        bright = Image.open(path_to_bright)
-        rgb = np.array(bright)
-        if channel != LC.GROWTH:
-            dark = Image.open(path_to_dark)
-            rgb = cv2.subtract(rgb, np.array(dark))
+        # load the images from file
+        dark = None
+        with tracer.span("decode", channel=channel):
+            rgb = np.array(Image.open(path_to_bright))
+            if channel != LC.GROWTH:
+                dark = np.array(Image.open(path_to_dark))
 
-        # if the time since last update is larger than a day, update the gains after the photo
-        if time.time() - self.config["d2d"]["timestamp"] > 3600*24:
-            self.update()
+        return (rgb, dark)
 
-        return (rgb, gain)
+
+    def capture_frame_ring(self, channel: LC, photo_cmd):
+        """
+        Capture the bright and the dark frame with raspistill in the capture process, which writes them into the shared memory frame ring. Expects the light of the channel to be on, and turns it off for the dark frame. The slots stay taken until release_frames() is called.
+
+        :param channel: channel of light in which the photo is taken
+        :param photo_cmd: raspistill command without output
+        :return: (bright, dark), 8 bit rgb arrays backed by the frame ring, or None if a capture failed
+        """
+
+        if self.capture_process is None:
+            self.capture_process = CAPTURE_PROCESS(shape = (self.resolution[1], self.resolution[0], 3))
+
+        with tracer.span("exposure", channel=channel, frame="bright"):
+            bright = self.capture_process.capture(photo_cmd + " -o -", timeout = self.watchdog.deadline("exposure"))
+        if bright is not None:
+            self.ring_slots.append(bright)
+        # turn off the light for the dark frame
+        self.lights.off(channel)
+        dark = None
+        if channel != LC.GROWTH and bright is not None:
+            with tracer.span("exposure", channel=channel, frame="dark"):
+                dark = self.capture_process.capture(photo_cmd + " -o -", timeout = self.watchdog.deadline("exposure"))
+            if dark is None:
+                self.release_frames()
+                return None
+            self.ring_slots.append(dark)
+
+        if bright is None:
+            d_print("Capture process failed to take a photo", 3)
+            return None
+
+        ring = self.capture_process.ring
+        return (ring.view(bright), None if dark is None else ring.view(dark))
 
 
     def calibrate_white_balance(self, channel: LC):
@@ -254,52 +545,47 @@ class PI_CAM_NOIR_V21(CAMERA):
         d_print("Warming up camera sensor...", 1)
 
         # turn on channel light
-        self.light_control(channel, 1)
+        self.lights.on(channel)
 
         if channel == LC.WHITE or channel == LC.NIR:
-            with picamera.PiCamera() as sensor:
-                # set up the sensor with all its settings
-                sensor.resolution = (128, 80)
-                sensor.rotation = self.config["rotation"]
-                sensor.framerate = self.settings.framerate[channel]
-                sensor.shutter_speed = self.settings.shutter_speed[channel]
+            # share the session of the capture backend (so the flatfield capture after this doesn't open the sensor
+            # again), or open a session just for the white balance
+            backend = self.backend
+            if backend is None:
+                backend = PICAMERA_BACKEND(resolution = (128, 80))
 
+            try:
                 # set up the blue and red gains
-                sensor.awb_mode = "off"
                 rg, bg = (1.1, 1.1)
-                sensor.awb_gains = (rg, bg)
+                backend.auto_exposure(framerate = self.settings.framerate[channel], shutter_speed = self.settings.shutter_speed[channel], awb_gains = (rg, bg))
 
                 # now sleep and lock exposure
                 time.sleep(20)
-                sensor.exposure_mode = self.settings.exposure_mode
+                backend.lock_exposure()
+
+                # capture images scaled down to 128x80 and analyze until convergence
+                for i in range(30):
+                    rgb = backend.capture(resize = (128, 80))
+
+                    #crop = rgb[508:708,666:966,:]
+                    r, g, b = ROI_STATS(rgb).mean([32, 30, 96, 50])
+                    d_print("\trg: {:4.3f} bg: {:4.3f} --- ({:4.1f}, {:4.1f}, {:4.1f})", 1, rg, bg, r, g, b)
+
+                    if abs(r - g) > 1:
+                        if r > g:
+                            rg -= 0.025
+                        else:
+                            rg += 0.025
+                    if abs(b - g) > 1:
+                        if b > g:
+                            bg -= 0.025
+                        else:
+                            bg += 0.025
 
-                # record camera data to array and scale up a numpy array
-                #rgb = np.zeros((1216,1216,3), dtype=np.uint16)
-                with picamera.array.PiRGBArray(sensor) as output:
-                    # capture images and analyze until convergence
-                    for i in range(30):
-                        output.truncate(0)
-                        sensor.capture(output, 'rgb')
-                        rgb = np.copy(output.array)
-
-                        #crop = rgb[508:708,666:966,:]
-                        crop = rgb[30:50,32:96,:]
-
-                        r, g, b = (np.mean(crop[..., i]) for i in range(3))
-                        d_print("\trg: {:4.3f} bg: {:4.3f} --- ({:4.1f}, {:4.1f}, {:4.1f})".format(rg, bg, r, g, b), 1)
-
-                        if abs(r - g) > 1:
-                            if r > g:
-                                rg -= 0.025
-                            else:
-                                rg += 0.025
-                        if abs(b - g) > 1:
-                            if b > g:
-                                bg -= 0.025
-                            else:
-                                bg += 0.025
-
-                        sensor.awb_gains = (rg, bg)
+                    backend.set_awb_gains((rg, bg))
+            finally:
+                if backend is not self.backend:
+                    backend.close()
         elif channel == LC.GROWTH:
             rg = self.settings.wb[LC.GROWTH]["r"]
             bg = self.settings.wb[LC.GROWTH]["b"]
@@ -307,8 +593,8 @@ class PI_CAM_NOIR_V21(CAMERA):
             rg = self.settings.wb[LC.RED]["r"]
             bg = self.settings.wb[LC.RED]["b"]
 
-        # turn off channel light
-        self.light_control(channel, 0)
+        # release channel light
+        self.lights.release(channel)
 
         self.config["wb"][channel] = dict()
         self.config["wb"][channel]["r"] = rg
@@ -350,8 +636,7 @@ def photo_worker(cmd):
     """
     Function that executes a photo command. Because of the implementation of subprocess (which forks the entire process) a new thread is first made with a way smaller footprint. This ensures that memory usage stays as low as possible and the program doesn't crash when memory gets scarce.
 
-    :param q: Queue in which a signal is posted when the photo is done
     :param cmd: Photo command to be executed
     """
 
-    subprocess.run(cmd, shell=True, timeout=20)
+    run_command(cmd, timeout=20)
@@ -0,0 +1,212 @@
+"""
+Implementation of the in-process picamera backend.
+Keeps a single PiCamera session open and sets the shutter speed, white balance and analog/digital gains directly, so frames can be captured without spawning raspistill.
+"""
+
+import time
+import picamera
+import picamera.array
+
+import numpy as np
+
+from picamera import mmal, exc
+from picamera.mmalobj import to_rational
+
+from astroplant_camera_module.misc.debug_print import d_print
+
+
+# gain parameters and corresponding functions, based on the gist of rwb27 on github
+# link: https://gist.github.com/rwb27/a23808e9f4008b48de95692a38ddaa08/
+# requires userland library (https://github.com/raspberrypi/userland.git)
+MMAL_PARAMETER_ANALOG_GAIN = mmal.MMAL_PARAMETER_GROUP_CAMERA + 0x59
+MMAL_PARAMETER_DIGITAL_GAIN = mmal.MMAL_PARAMETER_GROUP_CAMERA + 0x5A
+
+
+def set_gain(sensor, gain, value):
+    """
+    Set the analog or digital gain of a PiCamera through its MMAL control port.
+
+    :param sensor: the picamera.PiCamera() instance that is configured
+    :param gain: either MMAL_PARAMETER_ANALOG_GAIN or MMAL_PARAMETER_DIGITAL_GAIN
+    :param value: a numeric value that can be converted to a rational number
+    """
+
+    if gain not in [MMAL_PARAMETER_ANALOG_GAIN, MMAL_PARAMETER_DIGITAL_GAIN]:
+        raise ValueError("The gain parameter was not valid")
+
+    ret = mmal.mmal_port_parameter_set_rational(sensor._camera.control._port, gain, to_rational(value))
+    if ret == 4:
+        raise exc.PiCameraMMALError(ret, "Are you running the latest version of the userland libraries? Gain setting was introduced in late 2017.")
+    elif ret != 0:
+        raise exc.PiCameraMMALError(ret)
+
+
+def set_analog_gain(sensor, value):
+    """
+    Set the analog gain of a PiCamera.
+    """
+
+    set_gain(sensor, MMAL_PARAMETER_ANALOG_GAIN, value)
+
+
+def set_digital_gain(sensor, value):
+    """
+    Set the digital gain of a PiCamera.
+    """
+
+    set_gain(sensor, MMAL_PARAMETER_DIGITAL_GAIN, value)
+
+
+class PICAMERA_BACKEND(object):
+    def __init__(self, *args, resolution, zoom = (0.0, 0.0, 1.0, 1.0), settle_frames = 3, **kwargs):
+        """
+        Initialize the backend. The PiCamera session is opened on the first capture and kept open until close() is called.
+
+        :param resolution: resolution of the captured frames
+        :param zoom: (x, y, w, h) part of the sensor that is read out, as fractions of the full frame
+        :param settle_frames: number of frame periods to wait after the sensor settings changed, so frames exposed with the old settings are flushed
+        """
+
+        self.resolution = resolution
+        self.zoom = zoom
+        self.settle_frames = settle_frames
+
+        self.sensor = None
+        self.output = None
+        self.resized = dict()
+        self.current = dict()
+
+
+    def open(self):
+        """
+        Open the PiCamera session and the reused capture buffer, if they are not open already.
+        """
+
+        if self.sensor is not None:
+            return
+
+        self.sensor = picamera.PiCamera(resolution = self.resolution)
+        self.sensor.zoom = self.zoom
+        self.sensor.awb_mode = "off"
+        self.output = picamera.array.PiRGBArray(self.sensor, size = self.resolution)
+        self.current = dict()
+
+        d_print("Opened picamera session at {} (zoom: {})", 1, self.resolution, self.zoom)
+
+
+    def close(self):
+        """
+        Close the PiCamera session, freeing the camera for other users (for example a separate PiCamera object or raspistill).
+        """
+
+        if self.sensor is None:
+            return
+
+        self.output.close()
+        for output in self.resized.values():
+            output.close()
+        self.sensor.close()
+        self.sensor = None
+        self.output = None
+        self.resized = dict()
+        self.current = dict()
+
+
+    def configure(self, *args, framerate, shutter_speed, awb_gains, analog_gain, digital_gain, **kwargs):
+        """
+        Apply sensor settings, skipping the ones that are already in effect. Changing the framerate restarts the sensor, so it is only done when needed.
+
+        :param framerate: framerate, this limits the maximum shutter speed
+        :param shutter_speed: shutter speed in microseconds
+        :param awb_gains: tuple of the red and blue white balance gains
+        :param analog_gain: analog gain
+        :param digital_gain: digital gain
+        """
+
+        self.open()
+
+        settings = dict(framerate = framerate, shutter_speed = shutter_speed, awb_gains = tuple(awb_gains), analog_gain = analog_gain, digital_gain = digital_gain)
+        changed = {key: value for key, value in settings.items() if self.current.get(key) != value}
+        if not changed:
+            return
+
+        if "framerate" in changed:
+            self.sensor.framerate = framerate
+        if "shutter_speed" in changed:
+            self.sensor.shutter_speed = shutter_speed
+        if "awb_gains" in changed:
+            self.sensor.awb_gains = awb_gains
+
+        # gains can only be set manually when the automatic exposure is off
+        self.sensor.exposure_mode = "off"
+        if "analog_gain" in changed:
+            set_analog_gain(self.sensor, analog_gain)
+        if "digital_gain" in changed:
+            set_digital_gain(self.sensor, digital_gain)
+
+        self.current.update(changed)
+
+        # let frames exposed with the old settings pass
+        time.sleep(self.settle_frames/float(framerate))
+
+
+    def auto_exposure(self, *args, framerate, shutter_speed, awb_gains, **kwargs):
+        """
+        Let the sensor determine its gains itself (for example to calibrate the white balance), until lock_exposure() is called. The next configure() applies all its settings again.
+
+        :param framerate: framerate, this limits the maximum shutter speed
+        :param shutter_speed: shutter speed in microseconds
+        :param awb_gains: tuple of the red and blue white balance gains
+        """
+
+        self.open()
+
+        self.sensor.framerate = framerate
+        self.sensor.shutter_speed = shutter_speed
+        self.sensor.awb_gains = awb_gains
+        self.sensor.exposure_mode = "auto"
+        self.current = dict()
+
+
+    def lock_exposure(self):
+        """
+        Fix the gains the automatic exposure settled on.
+        """
+
+        self.sensor.exposure_mode = "off"
+
+
+    def set_awb_gains(self, awb_gains):
+        """
+        Change the white balance gains, without waiting for them to take effect.
+
+        :param awb_gains: tuple of the red and blue white balance gains
+        """
+
+        self.sensor.awb_gains = awb_gains
+        self.current.pop("awb_gains", None)
+
+
+    def capture(self, resize = None):
+        """
+        Capture a frame into the reused buffer.
+
+        :param resize: (width, height) the frame is scaled down to by the image processor before it is transferred, None for the full resolution
+        :return: 8 bit rgb array containing the frame (a copy, the buffer is overwritten by the next capture)
+        """
+
+        self.open()
+
+        output = self.output
+        if resize is not None and tuple(resize) != tuple(self.resolution):
+            resize = tuple(resize)
+            if resize not in self.resized:
+                self.resized[resize] = picamera.array.PiRGBArray(self.sensor, size = resize)
+            output = self.resized[resize]
+        else:
+            resize = None
+
+        output.truncate(0)
+        self.sensor.capture(output, 'rgb', resize = resize)
+
+        return np.copy(output.array)
@@ -0,0 +1,202 @@
+"""
+Implementation of the calibration planner.
+Keeps track of when every light channel was calibrated and whether that succeeded, so only the channels that are stale or failed are calibrated again, one at a time, keeping the results of the channels that succeed.
+"""
+
+import copy
+import time
+
+from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.misc.trace import tracer
+from astroplant_camera_module.typedef import LC
+
+
+class CALIBRATION_PLANNER(object):
+    def __init__(self, *args, camera, max_age = 30*24*3600, **kwargs):
+        """
+        Initialize a calibration planner. The calibration of every channel is recorded in the calibration part of the configuration: when it was last tried, whether it succeeded and why not, and when it last succeeded.
+
+        :param camera: link to the camera object controlling these subroutines
+        :param max_age: number of seconds after which the calibration of a channel is stale
+        """
+
+        self.camera = camera
+        self.max_age = max_age
+
+
+    def records(self):
+        return self.camera.config.setdefault("calibration", dict())
+
+
+    def missing(self, channel: LC):
+        """
+        Check whether calibration values of a channel are missing from the configuration.
+
+        :param channel: light channel
+        :return: True if a value is missing
+        """
+
+        config = self.camera.config
+        if channel not in config.get("wb", dict()):
+            return True
+
+        if channel == LC.RED or channel == LC.NIR:
+            resolutions = [None]
+            if self.camera.quick_resolution is not None:
+                resolutions.append(self.camera.quick_resolution)
+
+            for resolution in resolutions:
+                ff = self.camera.calibration(resolution)
+                if ff is None or channel not in ff["gain"] or channel not in ff["value"]:
+                    return True
+
+        return False
+
+
+    def is_stale(self, channel: LC):
+        """
+        Check whether a channel needs to be calibrated: it never was, it failed, it is older than max_age or values are missing.
+
+        :param channel: light channel
+        :return: True if the channel needs to be calibrated
+        """
+
+        record = self.records().get(channel)
+        if record is None or not record["valid"]:
+            return True
+
+        return time.time() - record["timestamp"] > self.max_age or self.missing(channel)
+
+
+    def stale_channels(self):
+        """
+        :return: list of the light channels of the camera that need to be calibrated
+        """
+
+        return [channel for channel in self.camera.light_channels if self.is_stale(channel)]
+
+
+    def is_complete(self):
+        """
+        Check whether every light channel has a usable calibration, however old. A channel whose last calibration failed is usable if an earlier one succeeded, its values were restored.
+
+        :return: True if the camera can be considered calibrated
+        """
+
+        for channel in self.camera.light_channels:
+            record = self.records().get(channel)
+            if record is None or not (record["valid"] or record.get("last_valid") is not None) or self.missing(channel):
+                return False
+
+        return True
+
+
+    def backup(self, channel: LC):
+        """
+        Copy the calibration values of a channel, so they can be restored if calibrating it fails.
+
+        :param channel: light channel
+        :return: dict with the values
+        """
+
+        config = self.camera.config
+        values = dict()
+        values["wb"] = copy.deepcopy(config["wb"].get(channel))
+        values["ff"] = {key: config["ff"][key].get(channel) for key in ["gain", "value"]}
+        values["quick"] = {name: {key: ff[key].get(channel) for key in ["gain", "value"]} for name, ff in config["ff"].get("quick", dict()).items()}
+
+        return values
+
+
+    def restore(self, channel: LC, values):
+        """
+        Put back the calibration values of a channel.
+
+        :param channel: light channel
+        :param values: dict as returned by backup()
+        """
+
+        def put(d, key, value):
+            if value is None:
+                d.pop(key, None)
+            else:
+                d[key] = value
+
+        config = self.camera.config
+        put(config["wb"], channel, values["wb"])
+        for key in ["gain", "value"]:
+            put(config["ff"][key], channel, values["ff"][key])
+
+        quick = config["ff"].get("quick", dict())
+        for name, ff in quick.items():
+            for key in ["gain", "value"]:
+                put(ff[key], channel, values["quick"].get(name, dict()).get(key))
+
+
+    def calibrate_channel(self, channel: LC):
+        """
+        Calibrate a single channel: the white balance and, for the red and nir channel, the flatfield gains (also at the quick ndvi resolution). The lights are held so they stay on in between.
+
+        :param channel: light channel
+        """
+
+        with self.camera.lights.hold():
+            self.camera.calibrate_white_balance(channel)
+            if channel == LC.RED or channel == LC.NIR:
+                self.camera.calibrate_flatfield_gains(channel)
+                if self.camera.quick_resolution is not None:
+                    self.camera.calibrate_flatfield_gains(channel, self.camera.quick_resolution)
+
+
+    def run(self, channels):
+        """
+        Calibrate a number of channels, one at a time. If a channel fails, its previous values are restored and the failure is recorded (so it is calibrated again next time), the other channels continue. The configuration is saved after every channel, so a partial calibration is kept.
+
+        :param channels: list of light channels
+        :return: dict with the channels that succeeded and the ones that failed (with the error)
+        """
+
+        config = self.camera.config
+        config.setdefault("wb", dict())
+        config.setdefault("ff", dict()).setdefault("gain", dict())
+        config["ff"].setdefault("value", dict())
+
+        summary = dict()
+        summary["calibrated"] = []
+        summary["failed"] = dict()
+
+        # no quality checks on the white surface while calibrating
+        self.camera.CALIBRATED = False
+
+        for channel in channels:
+            d_print("Calibrating the {} channel...", 1, channel)
+            values = self.backup(channel)
+
+            record = dict()
+            record["timestamp"] = time.time()
+            try:
+                with tracer.span("calibrate", channel=channel):
+                    self.calibrate_channel(channel)
+                record["valid"] = True
+                record["error"] = None
+                record["last_valid"] = record["timestamp"]
+                summary["calibrated"].append(channel)
+            except Exception as e:
+                d_print("Calibration of the {} channel failed, keeping its previous calibration: {}", 3, channel, e)
+                self.restore(channel, values)
+                record["valid"] = False
+                record["error"] = str(e)
+                summary["failed"][channel] = str(e)
+
+                # keep the time of the last successful calibration, whose values were restored
+                previous = self.records().get(channel)
+                record["last_valid"] = None
+                if previous is not None:
+                    record["last_valid"] = previous["timestamp"] if previous["valid"] else previous.get("last_valid")
+
+            self.records()[channel] = record
+            self.camera.save_config_to_file()
+
+        self.camera.CALIBRATED = self.is_complete()
+
+        return summary
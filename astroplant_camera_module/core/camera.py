@@ -11,9 +11,13 @@ import json
 import cv2
 
 import numpy as np
-from imageio import imwrite
 
 from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.misc.trace import tracer
+from astroplant_camera_module.core.encoder import add_encode_info
+from astroplant_camera_module.core.roi_stats import ROI_STATS
+from astroplant_camera_module.core.light import LIGHT_MANAGER
+from astroplant_camera_module.core.watchdog import STAGE_TIMEOUT
 from astroplant_camera_module.typedef import CC, LC
 from astroplant_camera_module.setup import check_directories
 
@@ -22,7 +26,7 @@ class CAMERA(object):
         """
         Initilize the parent camera object. Most of the routines are specified here, as well as the command tree of what to do with commands received from the user. Initializes some variables to a dummy state, which need to be overwritten explicitly by the child camera.
 
-        :param light_control: function that allows control over the lighting. Parameters are the channel to control and either a 0 or 1 for off and on respectively
+        :param light_control: function that allows control over the lighting. Parameters are the channel to control and either a 0 or 1 for off and on respectively. A LIGHT_MANAGER (see core/light.py) can be given instead
         :param light_channels: list containing allowable light channels
         """
 
@@ -31,18 +35,134 @@ class CAMERA(object):
         self.HAS_UPDATE = False
         self.CALIBRATED = False
 
-        self.light_control = light_control
+        # all light switching goes through the light manager, which skips redundant switches
+        if isinstance(light_control, LIGHT_MANAGER):
+            self.lights = light_control
+        else:
+            self.lights = LIGHT_MANAGER(light_control = light_control)
         self.working_directory = working_directory
 
+        # in-process capture backend, if the child camera has one
+        self.backend = None
+
+        # capture process writing into a shared memory frame ring, and the slots of the current capture
+        self.capture_process = None
+        self.ring_slots = []
+
+        # part of the sensor that is read out (see setup_readout()), the full frame until the child camera sets it up
+        self.zoom = (0.0, 0.0, 1.0, 1.0)
+        self.resolution = None
+        self.crop = None
+        self.quick_resolution = None
+
+        # watchdog of the worker processes and the retries of failed captures, if the child camera has one, and the
+        # reason the last capture failed
+        self.watchdog = None
+        self.capture_error = None
+
+        # time-lapse builder, if the child camera has one
+        self.timelapse = None
+
+        # calibration planner, set up by the child camera
+        self.calibrator = None
+
+        # change detector, if the child camera has one
+        self.change = None
+
+        # quality gate, if the child camera has one, and the quality metrics of the last capture per channel
+        self.gate = None
+        self.quality = dict()
+
         # check and set up the necessary directories
         check_directories(self.working_directory)
 
 
+    def close_backend(self):
+        """
+        Close the session of the capture backend, if it is open. It is opened again on the next capture.
+        """
+
+        if getattr(self, "backend", None) is not None:
+            self.backend.close()
+
+
+    def setup_readout(self):
+        """
+        Determine the part of the sensor that is read out. With settings.sensor_roi, only the crop is read out, at the same scale as the full frame, so the rest of the frame is never transferred, decoded or processed. The crop then covers the whole frame, so self.crop holds the crop in the coordinates of the captured frame. The ground plane is relative to the crop and stays the same.
+        """
+
+        crop = self.settings.crop
+        width, height = self.settings.resolution
+
+        if self.settings.sensor_roi:
+            self.zoom = (crop["x_min"]/width, crop["y_min"]/height, (crop["x_max"] - crop["x_min"])/width, (crop["y_max"] - crop["y_min"])/height)
+            self.resolution = (crop["x_max"] - crop["x_min"], crop["y_max"] - crop["y_min"])
+            self.crop = dict(x_min = 0, x_max = self.resolution[0], y_min = 0, y_max = self.resolution[1])
+        else:
+            self.zoom = (0.0, 0.0, 1.0, 1.0)
+            self.resolution = (width, height)
+            self.crop = dict(crop)
+
+        # resolution of the quick ndvi captures
+        self.quick_resolution = None
+        if self.settings.quick_ndvi is not None:
+            self.quick_resolution = (self.resolution[0]//self.settings.quick_ndvi, self.resolution[1]//self.settings.quick_ndvi)
+
+        d_print("Reading out {}x{} pixels of the sensor (zoom: {})", 1, self.resolution[0], self.resolution[1], self.zoom)
+
+
+    def release_frames(self):
+        """
+        Give the frame ring slots of the current capture back to the capture process.
+        """
+
+        for slot in self.ring_slots:
+            self.capture_process.ring.release(slot)
+        self.ring_slots = []
+
+
+    def __del__(self):
+        """
+        Free the sensor, the capture process and the post-processing threads when the camera object is destroyed.
+        """
+
+        self.close_backend()
+        if getattr(self, "capture_process", None) is not None:
+            self.capture_process.stop()
+        if getattr(self, "pool", None) is not None:
+            self.pool.shutdown()
+
+
     def do(self, command: CC):
+        """
+        Function that executes the commands from the user. When tracing is enabled, the nested timing spans of the command are written to cam/res/trace.json afterwards.
+
+        :param command: (C)amera (C)ommand, what the user wants to do.
+        """
+
+        with tracer.span("do", command=command):
+            res = self.dispatch(command)
+
+            # append the new photos to their time-lapses while they are still in the page cache
+            if self.timelapse is not None:
+                with tracer.span("timelapse"):
+                    try:
+                        self.timelapse.add_result(res)
+                    except EnvironmentError as e:
+                        d_print("Could not append to the time-lapse: {}", 3, e)
+
+        if tracer.enabled:
+            tracer.export("{}/cam/res/trace.json".format(self.working_directory))
+
+        return res
+
+
+    def dispatch(self, command: CC):
         """
         Function that directs the commands from the user to the right place. Does some preliminary checks to see if actions are allowed in the current state of the camera (uncalibrated etc.). Throws an error on the command line if actions are illegal.
 
         :param command: (C)amera (C)ommand, what the user wants to do.
+        :return: result dict, the calibration summary for CALIBRATE and CALIBRATE_STALE, None for UPDATE, or an empty string if the command is refused
         """
 
         if command == CC.WHITE_PHOTO and LC.WHITE in self.light_channels and self.CALIBRATED:
@@ -56,19 +176,78 @@ class CAMERA(object):
         elif command == CC.NIR_PHOTO and LC.NIR in self.light_channels and self.CALIBRATED:
             return self.photo(LC.NIR)
         elif command == CC.CALIBRATE:
-            self.calibrate()
+            return self.calibrate()
+        elif command == CC.CALIBRATE_STALE:
+            return self.calibrate_stale()
         elif command == CC.UPDATE and self.HAS_UPDATE and self.CALIBRATED:
             self.update()
         else:
-            d_print("Camera is unable to perform command '{}', is it calibrated? ({})\n    Run [cam].state() to check current camera and lighting status...\n    Returning empty...".format(command, self.CALIBRATED), 3)
+            d_print("Camera is unable to perform command '{}', is it calibrated? ({})\n    Run [cam].state() to check current camera and lighting status...\n    Returning empty...", 3, command, self.CALIBRATED)
             return ""
 
 
     @abc.abstractmethod
-    def capture(self, channel):
+    def capture_once(self, channel, resolution = None):
         raise NotImplementedError()
 
 
+    def capture(self, channel: LC, resolution = None):
+        """
+        Capture an image (see capture_once() of the child camera). With a quality gate, a calibrated camera retries captures that fail its checks, as long as another attempt fits in the latency budget. The last attempt is returned either way, its metrics are kept in self.quality[channel]. Captures that fail (for example a hung worker killed by the watchdog) are retried with a backoff, as set up in the watchdog. If all attempts fail, the reason is kept in self.capture_error.
+
+        :param channel: channel of light in which the photo is taken
+        :param resolution: (width, height) the frame is scaled down to, an integer fraction of self.resolution (None for the full readout resolution)
+        :return: (8 bit rgb array containing the image, effective gain)
+        """
+
+        self.quality.pop(channel, None)
+        self.capture_error = None
+        start = time.monotonic()
+        attempt = 1
+        failures = 0
+        while True:
+            attempt_start = time.monotonic()
+            error = "capture of the {} channel failed".format(channel)
+            try:
+                rgb, gain = self.capture_once(channel, resolution)
+            except (STAGE_TIMEOUT, EnvironmentError) as e:
+                error = "capture of the {} channel failed: {}".format(channel, e)
+                rgb, gain = (None, 0)
+
+            if rgb is None:
+                # the light may still be on from the bright frame
+                self.lights.off(channel)
+                failures += 1
+                if self.watchdog is None or not self.watchdog.retry(failures, start, attempt_start):
+                    d_print("{}, giving up after {} attempts", 3, error, attempt)
+                    self.capture_error = error
+                    return (None, 0)
+                d_print("{}, retrying...", 2, error)
+                attempt += 1
+                continue
+
+            if self.gate is None:
+                return (rgb, gain)
+
+            with tracer.span("quality gate", channel=channel):
+                metrics = self.quality[channel]
+                reasons = self.gate.check(metrics) if self.CALIBRATED else []
+            metrics["attempts"] = attempt
+            metrics["passed"] = not reasons
+            metrics["reasons"] = reasons
+            if not reasons:
+                return (rgb, gain)
+
+            # only retry if another attempt, taking as long as this one, fits in the budget
+            now = time.monotonic()
+            if attempt > self.gate.retries or now + (now - attempt_start) - start > self.gate.budget:
+                d_print("Capture of the {} channel failed the quality gate ({}), giving up after {} attempts", 3, channel, ", ".join(reasons), attempt)
+                return (rgb, gain)
+
+            d_print("Capture of the {} channel failed the quality gate ({}), retrying...", 2, channel, ", ".join(reasons))
+            attempt += 1
+
+
     @abc.abstractmethod
     def calibrate_white_balance(self, channel):
         raise NotImplementedError()
@@ -81,11 +260,13 @@ class CAMERA(object):
 
     def save_config_to_file(self):
         """
-        Save camera configuration to file.
+        Save camera configuration to file (atomically, so an interrupted save does not leave a broken configuration).
         """
 
-        with open("{}/cam/cfg/config.json".format(self.working_directory), 'w') as f:
+        path = "{}/cam/cfg/config.json".format(self.working_directory)
+        with open(path + ".tmp", 'w') as f:
             json.dump(self.config, f, indent=4, sort_keys=True)
+        os.replace(path + ".tmp", path)
 
 
     def load_config_from_file(self):
@@ -99,106 +280,217 @@ class CAMERA(object):
 
     def photo(self, channel: LC):
         """
-        Make a photo with the specified light channel and save the image to disk
+        Make a photo with the specified light channel and save the image to disk. With a change detector, the previous photo is returned instead if nothing changed since it was taken.
 
         :param channel: channel of light a photo needs to be taken from
         :return: path to the photo taken
         """
 
         # capture a photo of the appropriate channel
-        rgb, _ = self.capture(channel)
+        rgb, gain = self.capture(channel)
+        quality = self.quality.get(channel)
 
         # catch error
         if rgb is None:
-            res = dict()
-            res["contains_photo"] = False
-            res["contains_value"] = False
-            res["encountered_error"] = True
-            res["timestamp"] = curr_time
+            return self.error_result(self.capture_error)
 
-            return res
+        # point to the previous photo if nothing changed
+        if self.change is not None:
+            with tracer.span("change detection", channel=channel):
+                reused = self.change.check(channel, [(rgb, gain)])
+            if reused is not None:
+                if quality is not None:
+                    reused["quality"] = [quality]
+                return reused
 
         # crop the sensor readout
-        rgb = rgb[self.settings.crop["y_min"]:self.settings.crop["y_max"], self.settings.crop["x_min"]:self.settings.crop["x_max"], :]
+        rgb = self.crop_frame(rgb)
 
-        # write image to file using imageio's imwrite
+        # write image to file using the configured encoder
         d_print("Writing to file...", 1)
         curr_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-        path_to_img = "{}/cam/img/{}_{}.jpg".format(self.working_directory, channel, curr_time)
-        imwrite(path_to_img, rgb)
+        path_to_img = "{}/cam/img/{}_{}".format(self.working_directory, channel, curr_time)
+        info = self.encoder.write_photo(path_to_img, rgb)
 
         res = dict()
         res["contains_photo"] = True
         res["contains_value"] = False
         res["encountered_error"] = False
         res["timestamp"] = curr_time
-        res["photo_path"] = [path_to_img]
+        add_encode_info(res, [info])
         res["photo_kind"] = [channel]
+        if quality is not None:
+            res["quality"] = [quality]
+
+        if self.change is not None:
+            self.change.store(channel, res)
 
         return(res)
 
 
+    def error_result(self, error):
+        """
+        Make the result of a command that failed.
+
+        :param error: description of what went wrong
+        :return: result dict
+        """
+
+        res = dict()
+        res["contains_photo"] = False
+        res["contains_value"] = False
+        res["encountered_error"] = True
+        res["timestamp"] = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        res["error"] = error
+
+        return res
+
+
     def calibrate(self):
         """
-        Calibrates the camera and the light sources.
+        Calibrates the camera and all light sources. Channels are calibrated one at a time by the calibration planner (see core/calibration.py), a channel that fails keeps its previous calibration.
+
+        :return: dict with the channels that succeeded and the ones that failed
         """
 
         # ask user to put something white and diffuse in the kit
         d_print("Assuming a white diffuse surface is placed at the bottom of the kit...", 1)
 
-        self.CALIBRATED = False
-
-        # set up the camera config dict
-        self.config = dict()
-        self.config["cam_id"] = self.CAM_ID
-        self.config["rotation"] = 0
-        self.config["wb"] = dict()
-        self.config["ff"] = dict()
-        self.config["ff"]["gain"] = dict()
-        self.config["ff"]["value"] = dict()
+        # set up the camera config dict, unless there is one of this camera to fall back on
+        if getattr(self, "config", None) is None or self.config.get("cam_id") != self.CAM_ID:
+            self.config = dict()
+            self.config["cam_id"] = self.CAM_ID
+            self.config["rotation"] = 0
+            self.config["wb"] = dict()
+            self.config["ff"] = dict()
+            self.config["ff"]["gain"] = dict()
+            self.config["ff"]["value"] = dict()
 
         d_print("Starting calibration...", 1)
 
-        # calibrate all white balances
-        for channel in self.light_channels:
-            self.calibrate_white_balance(channel)
-        # calibrate the gains
-        for channel in self.light_channels:
-            if channel == LC.RED or channel == LC.NIR:
-                self.calibrate_flatfield_gains(channel)
+        return self.calibrator.run(self.light_channels)
 
-        # write the configuration to file
-        self.save_config_to_file()
 
-        self.CALIBRATED = True
+    def calibrate_stale(self):
+        """
+        Calibrates only the light sources whose calibration is stale, failed or missing (see core/calibration.py).
 
+        :return: dict with the channels that succeeded and the ones that failed
+        """
 
-    def calibrate_flatfield_gains(self, channel: LC):
+        if getattr(self, "config", None) is None or self.config.get("cam_id") != self.CAM_ID:
+            return self.calibrate()
+
+        channels = self.calibrator.stale_channels()
+        if not channels:
+            d_print("Calibration of all channels is up to date.", 1)
+            return dict(calibrated = [], failed = dict())
+
+        d_print("Assuming a white diffuse surface is placed at the bottom of the kit...", 1)
+        d_print("Calibrating stale channels: {}", 1, channels)
+
+        return self.calibrator.run(channels)
+
+
+    def calibrate_flatfield_gains(self, channel: LC, resolution = None):
         """
-        Calibrate the flatfield of the given channel. A reference value is needed for calculations of for example NDVI. This function computes the average value of the flatfield and saves it with the accompanying gain.
+        Calibrate the flatfield of the given channel. A reference value is needed for calculations of for example NDVI. This function computes the average value of the flatfield and saves it with the accompanying gain. Captures at a lower resolution (see capture()) get their own calibration, since scaling down changes the values slightly (for example the maximum of the rgb values of the nir channel).
 
         :param channel: channel of light that requires flatfield calibration
+        :param resolution: capture resolution to calibrate, None for the full readout resolution
         """
 
         # capture a photo of the appropriate channel
-        rgb, gain = self.capture(channel)
+        rgb, gain = self.capture(channel, resolution)
+        factor = self.frame_factor(rgb)
 
         # save the flatfield gain to the config
-        self.config["ff"]["gain"][channel] = float(gain)
+        if resolution is None:
+            ff = self.config["ff"]
+        else:
+            ff = self.config["ff"].setdefault("quick", dict()).setdefault("{}x{}".format(*resolution), dict(gain = dict(), value = dict()))
+        ff["gain"][channel] = float(gain)
 
         # cut image to size
-        rgb = rgb[self.settings.crop["y_min"]:self.settings.crop["y_max"], self.settings.crop["x_min"]:self.settings.crop["x_max"], :]
+        rgb = self.crop_frame(rgb)
 
         # turn rgb into hsv and extract the v channel as the mask
         v = self.extract_value_from_rgb(channel, rgb)
         # get the average intensity of the light and save for flatfielding
-        self.config["ff"]["value"][channel] = np.mean(v[self.settings.ground_plane["y_min"]:self.settings.ground_plane["y_max"], self.settings.ground_plane["x_min"]:self.settings.ground_plane["x_max"]])
-        d_print("{} ff std: ".format(channel) + str(np.std(v[self.settings.ground_plane["y_min"]:self.settings.ground_plane["y_max"], self.settings.ground_plane["x_min"]:self.settings.ground_plane["x_max"]])), 1)
+        mean, std = ROI_STATS(v).mean_std(self.ground_plane_roi(factor, cropped = True))
+        ff["value"][channel] = float(mean)
+        d_print("{} ff std: {} (resolution: {})", 1, channel, std, resolution or self.resolution)
 
-        # write image to file using imageio's imwrite
-        path_to_img = "{}/cam/cfg/{}_mask.jpg".format(self.working_directory, channel)
-        d_print("Writing to file...", 1)
-        imwrite(path_to_img, rgb.astype(np.uint8))
+        if resolution is None:
+            # write image to file using the encoder
+            path_to_img = "{}/cam/cfg/{}_mask".format(self.working_directory, channel)
+            d_print("Writing to file...", 1)
+            self.encoder.write(path_to_img, rgb.astype(np.uint8), "jpg")
+
+
+    def calibration(self, resolution = None):
+        """
+        Flatfield calibration of captures at a resolution.
+
+        :param resolution: capture resolution, None for the full readout resolution
+        :return: dict with the gain and value per channel, or None if the camera was not calibrated at that resolution
+        """
+
+        ff = self.config.get("ff")
+        if ff is None or resolution is None or tuple(resolution) == tuple(self.resolution):
+            return ff
+
+        return ff.get("quick", dict()).get("{}x{}".format(*resolution))
+
+
+    def frame_factor(self, rgb):
+        """
+        Integer factor a captured frame is scaled down by, relative to the readout resolution.
+
+        :param rgb: captured (uncropped) frame
+        :return: 1 for frames at the readout resolution
+        """
+
+        return max(1, int(round(self.resolution[0]/rgb.shape[1])))
+
+
+    def crop_frame(self, rgb):
+        """
+        Crop a captured frame to the crop, also for frames captured at a lower resolution.
+
+        :param rgb: captured frame
+        :return: view of the cropped frame
+        """
+
+        f = self.frame_factor(rgb)
+
+        return rgb[self.crop["y_min"]//f:self.crop["y_max"]//f, self.crop["x_min"]//f:self.crop["x_max"]//f, :]
+
+
+    def ground_plane_roi(self, factor = 1, cropped = False):
+        """
+        The ground plane in the coordinates of a captured frame. The coordinates are divided by the same integer factor as the crop, so the ground plane always stays within it.
+
+        :param factor: factor the frame is scaled down by (see frame_factor())
+        :param cropped: whether the frame was cropped already
+        :return: [x_min, y_min, x_max, y_max]
+        """
+
+        ground_plane = self.settings.ground_plane
+        x, y = (0, 0) if cropped else (self.crop["x_min"], self.crop["y_min"])
+
+        return [(x + ground_plane["x_min"])//factor, (y + ground_plane["y_min"])//factor, (x + ground_plane["x_max"])//factor, (y + ground_plane["y_max"])//factor]
+
+
+    def shutter_speed(self, channel: LC):
+        """
+        Shutter speed used for a capture, as planned by the exposure planner or otherwise from the settings.
+
+        :param channel: light channel
+        :return: shutter speed in microseconds
+        """
+
+        return self.config["d2d"][channel].get("shutter-speed", self.settings.shutter_speed[channel])
 
 
     def extract_value_from_rgb(self, channel: LC, rgb):
@@ -218,7 +510,7 @@ class CAMERA(object):
             # extract the red channel
             v = rgb[:,:,0]
         else:
-            d_print("unknown channel {}, cannot extract value, returning black matrix...".format(channel), 3)
+            d_print("unknown channel {}, cannot extract value, returning black matrix...", 3, channel)
             v = np.zeros([10, 10])
 
         return v
@@ -235,8 +527,20 @@ class CAMERA(object):
         print("    HAS_UPDATE:    {}".format(self.HAS_UPDATE))
         print("    CALIBRATED:    {}".format(self.CALIBRATED))
 
+        if self.calibrator is not None and getattr(self, "config", None) is not None:
+            print("\nCalibration:")
+            for channel in self.light_channels:
+                record = self.calibrator.records().get(channel)
+                if record is None:
+                    print("    {:<8} never calibrated".format(channel))
+                else:
+                    print("    {:<8} {} valid: {} stale: {} error: {}".format(channel, time.strftime("%Y-%m-%d %H:%M", time.localtime(record["timestamp"])), record["valid"], self.calibrator.is_stale(channel), record["error"]))
+                    if not record["valid"] and record.get("last_valid") is not None:
+                        print("    {:<8} using the calibration of {}".format("", time.strftime("%Y-%m-%d %H:%M", time.localtime(record["last_valid"]))))
+
         print("\nConnections:")
-        print("    light control:   {}".format(self.light_control))
+        print("    light control:   {}".format(self.lights.light_control or self.lights.gpio))
+        print("    light states:    {}".format(self.lights.state))
         print("    light channels:  {}".format(self.light_channels))
         print("    settings:        {}".format(self.settings))
 
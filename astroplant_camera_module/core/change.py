@@ -0,0 +1,152 @@
+"""
+Implementation of the change detector.
+Compares a small, downsampled signature of the captures of a cycle with the signature of the captures the previous full result was based on, so a cycle in which nothing changed (lights off overnight, plants that did not move) reuses that result instead of processing and writing everything again.
+"""
+
+import copy
+import datetime
+import json
+import os
+import time
+import cv2
+
+import numpy as np
+
+from astroplant_camera_module.misc.debug_print import d_print
+
+
+class CHANGE_DETECTOR(object):
+    def __init__(self, *args, camera, size = (32, 24), tolerance = 0.05, floor = 32.0, max_changed = 0.01, max_age = 6*3600, **kwargs):
+        """
+        Initialize a change detector. The signature of a capture is its crop, scaled down to a few hundred cells (every cell averages a large block of pixels, so the sensor noise mostly cancels out) and scaled to the gain of the previous signature. A cell changed if it differs by more than the tolerance, relative to its previous level (or the floor, for dark cells). The signatures and results are kept in cam/res/change.json, so they carry over to the next camera object.
+
+        :param camera: link to the camera object controlling these subroutines
+        :param size: (width, height) of the signature in cells
+        :param tolerance: relative difference at which a cell counts as changed
+        :param floor: lowest level (8 bit value) the tolerance is relative to, so noise and the rounding of the 8 bit cells in dark cells do not count as change
+        :param max_changed: maximum fraction of changed cells of a capture that is still considered unchanged
+        :param max_age: seconds after which a result is not reused anymore, however little changed
+        """
+
+        self.camera = camera
+        self.size = tuple(size)
+        self.tolerance = tolerance
+        self.floor = floor
+        self.max_changed = max_changed
+        self.max_age = max_age
+
+        self.state_file = "{}/cam/res/change.json".format(self.camera.working_directory)
+        self.load_state()
+
+        # signatures of the current cycle per key, stored with the result once it is complete
+        self.pending = dict()
+
+
+    def load_state(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                self.state = json.load(f)
+        except (EnvironmentError, ValueError):
+            self.state = dict()
+
+
+    def save_state(self):
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f, default=float)
+        os.replace(tmp_file, self.state_file)
+
+
+    def signature(self, rgb):
+        """
+        Compute the signature of a capture.
+
+        :param rgb: captured (uncropped) 8 bit rgb frame
+        :return: float32 array of size[1] x size[0] x 3 cells
+        """
+
+        return cv2.resize(self.camera.crop_frame(rgb), self.size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+    def changed_fraction(self, signature, gain, previous):
+        """
+        Fraction of cells of a signature that changed compared to the previous one.
+
+        :param signature: signature of the capture
+        :param gain: effective gain of the capture
+        :param previous: dict with the previous signature and gain
+        :return: fraction of changed cells (1.0 if the signatures can't be compared)
+        """
+
+        old = np.asarray(previous["signature"], dtype=np.float32)
+        if old.shape != signature.shape:
+            return 1.0
+
+        # compare at the gain of the previous capture, the exposure may have been corrected in between
+        new = signature*(previous["gain"]/gain)
+        changed = np.abs(new - old) > self.tolerance*np.maximum(old, self.floor)
+
+        return float(np.count_nonzero(changed.any(axis=2))/changed.shape[0]/changed.shape[1])
+
+
+    def check(self, key, frames):
+        """
+        Check whether the captures of a cycle changed since the previous result of the same key. The signatures are kept, and stored with the result by store().
+
+        :param key: name of the result (for example the command), results of different keys are never mixed
+        :param frames: list of (rgb, gain) tuples of the captures the result is based on, always in the same order
+        :return: copy of the previous result to reuse, with the timestamp of this cycle and the reused field set to the timestamp of the original, or None if it has to be computed again
+        """
+
+        signatures = [(self.signature(rgb), float(gain)) for rgb, gain in frames]
+        self.pending[key] = signatures
+
+        entry = self.state.get(key)
+        if entry is None or len(entry["frames"]) != len(signatures):
+            return None
+
+        if time.time() - entry["time"] > self.max_age:
+            d_print("Previous {} result is too old to reuse", 1, key)
+            return None
+
+        # the files the previous result refers to may have been cleaned up since
+        res = entry["result"]
+        if any(not os.path.exists(path) for path in res.get("photo_path", [])):
+            return None
+
+        changed = max(self.changed_fraction(signature, gain, previous) for (signature, gain), previous in zip(signatures, entry["frames"]))
+        if changed > self.max_changed:
+            d_print("{} changed ({:.1%} of the cells), processing...", 1, key, changed)
+            return None
+
+        d_print("{} did not change ({:.1%} of the cells), reusing the result of {}", 1, key, changed, res["timestamp"])
+        res = copy.deepcopy(res)
+        res["reused"] = res["timestamp"]
+        res["timestamp"] = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        res["changed"] = changed
+
+        return res
+
+
+    def store(self, key, res):
+        """
+        Keep a complete result, with the signatures of the captures it is based on, to compare the next cycle with. Results with an error are not kept.
+
+        :param key: name of the result, as passed to check()
+        :param res: result dict
+        """
+
+        signatures = self.pending.pop(key, None)
+        if signatures is None or res.get("encountered_error"):
+            return
+
+        entry = dict()
+        entry["time"] = time.time()
+        entry["frames"] = [dict(signature = np.round(signature, 1).tolist(), gain = gain) for signature, gain in signatures]
+        entry["result"] = res
+        self.state[key] = entry
+
+        try:
+            self.save_state()
+        except EnvironmentError as e:
+            d_print("Could not save the change detector state: {}", 3, e)
@@ -0,0 +1,380 @@
+"""
+Implementation of the capture daemon.
+Keeps a single (warm) camera object alive and runs camera commands on a cron-like schedule.
+"""
+
+import time
+import datetime
+import json
+import os
+import random
+import signal
+import threading
+
+from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.typedef import CC
+
+
+class CRON(object):
+    def __init__(self, expression):
+        """
+        Parse a cron-like expression with the five usual fields (minute, hour, day of month, month, day of week). Every field supports '*', '*/n', 'a', 'a-b', 'a-b/n' and comma separated lists of these.
+
+        :param expression: cron expression, for example "0 */2 * * *" to run every two hours on the hour
+        """
+
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("cron expression '{}' should contain exactly 5 fields".format(expression))
+
+        self.expression = expression
+        self.minutes = self.parse_field(fields[0], 0, 59)
+        self.hours = self.parse_field(fields[1], 0, 23)
+        self.days = self.parse_field(fields[2], 1, 31)
+        self.months = self.parse_field(fields[3], 1, 12)
+        # both 0 and 7 are sunday in cron, python uses 0 for monday
+        self.weekdays = set((d - 1) % 7 for d in self.parse_field(fields[4], 0, 7))
+
+        self.days_restricted = fields[2] != "*"
+        self.weekdays_restricted = fields[4] != "*"
+
+
+    @staticmethod
+    def parse_field(field, lo, hi):
+        """
+        Parse a single cron field into the set of allowed values.
+
+        :param field: the field as a string
+        :param lo: lowest allowed value
+        :param hi: highest allowed value
+        :return: set of allowed values
+        """
+
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/")
+                step = int(step)
+
+            if part == "*":
+                start, stop = lo, hi
+            elif "-" in part:
+                start, stop = (int(x) for x in part.split("-"))
+            else:
+                start = int(part)
+                stop = hi if step != 1 else start
+
+            if start < lo or stop > hi or start > stop or step < 1:
+                raise ValueError("cron field '{}' out of range [{}, {}]".format(field, lo, hi))
+
+            values.update(range(start, stop + 1, step))
+
+        return values
+
+
+    def day_matches(self, t):
+        """
+        Check whether the day of the given datetime matches the day of month and day of week fields, using the cron convention that either of them may match if both are restricted.
+        """
+
+        dom = t.day in self.days
+        dow = t.weekday() in self.weekdays
+
+        if self.days_restricted and self.weekdays_restricted:
+            return dom or dow
+
+        return dom and dow
+
+
+    def next_after(self, timestamp):
+        """
+        Compute the first time strictly after the given timestamp that matches the expression.
+
+        :param timestamp: unix timestamp
+        :return: unix timestamp of the next matching minute
+        """
+
+        t = datetime.datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = t + datetime.timedelta(days=4*366)
+
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1) + datetime.timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self.day_matches(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t = t + datetime.timedelta(minutes=1)
+            else:
+                return t.timestamp()
+
+        raise ValueError("cron expression '{}' never matches".format(self.expression))
+
+
+class JOB(object):
+    def __init__(self, *args, name, command: CC, schedule, jitter = 0, catch_up = True, **kwargs):
+        """
+        Initialize a scheduled job for the daemon.
+
+        :param name: unique name of the job, used to keep track of its state across restarts
+        :param command: (C)amera (C)ommand that is sent to the camera when the job runs
+        :param schedule: cron expression describing when the job should run
+        :param jitter: maximum number of seconds a run is randomly delayed, to spread out load and light usage
+        :param catch_up: if True, a run that was missed (daemon down or busy) is performed once as soon as possible
+        """
+
+        self.name = name
+        self.command = command
+        self.cron = CRON(schedule)
+        self.jitter = jitter
+        self.catch_up = catch_up
+
+        # runtime state
+        self.last_run = None
+        self.next_run = None
+
+        # latency statistics
+        self.stats = dict()
+        self.stats["runs"] = 0
+        self.stats["errors"] = 0
+        self.stats["missed"] = 0
+        self.stats["last_latency"] = 0.0
+        self.stats["mean_latency"] = 0.0
+        self.stats["max_latency"] = 0.0
+        self.stats["last_delay"] = 0.0
+
+
+    def schedule_after(self, timestamp):
+        """
+        Plan the next run of the job after the given timestamp, including jitter.
+
+        :param timestamp: unix timestamp after which the job should run next
+        """
+
+        self.next_run = self.cron.next_after(timestamp) + random.uniform(0, self.jitter)
+
+
+    def record(self, scheduled, started, finished, error):
+        """
+        Record the statistics of a single run.
+
+        :param scheduled: timestamp at which the run was planned
+        :param started: timestamp at which the run actually started
+        :param finished: timestamp at which the run finished
+        :param error: whether the run encountered an error
+        """
+
+        latency = finished - started
+
+        self.stats["runs"] += 1
+        self.stats["errors"] += int(error)
+        self.stats["last_latency"] = latency
+        self.stats["mean_latency"] += (latency - self.stats["mean_latency"])/self.stats["runs"]
+        self.stats["max_latency"] = max(self.stats["max_latency"], latency)
+        self.stats["last_delay"] = started - scheduled
+
+        self.last_run = started
+
+
+class DAEMON(object):
+    def __init__(self, *args, camera, jobs, state_file = None, on_result = None, retention = None, publisher = None, **kwargs):
+        """
+        Initialize a daemon that keeps one warm camera object and runs the given jobs on their schedule. Calibration, configuration and any other state built up by the camera is kept between runs instead of being rebuilt every cycle.
+
+        :param camera: camera object that executes the commands
+        :param jobs: list of JOB objects
+        :param state_file: file in which the job state is kept across restarts, defaults to cam/res/daemon.json in the working directory of the camera
+        :param on_result: optional function that is called with the job and the result of every run that did not raise (None for commands without a result, like UPDATE)
+        :param retention: optional RETENTION object that is run in the background while the daemon runs
+        :param publisher: optional PUBLISHER object that the result of every run is published to, it sends them in the background while the daemon runs
+        """
+
+        self.camera = camera
+        self.jobs = jobs
+        self.on_result = on_result
+        self.retention = retention
+        self.publisher = publisher
+
+        if state_file is None:
+            state_file = "{}/cam/res/daemon.json".format(self.camera.working_directory)
+        self.state_file = state_file
+
+        self.stop_event = threading.Event()
+
+        names = [job.name for job in self.jobs]
+        if len(names) != len(set(names)):
+            raise ValueError("job names should be unique")
+
+
+    def load_state(self):
+        """
+        Load the timestamps of the last runs and the statistics of the jobs from file.
+        """
+
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+        except (EnvironmentError, ValueError):
+            d_print("No daemon state found, starting fresh.", 1)
+            return
+
+        for job in self.jobs:
+            if job.name in state:
+                job.last_run = state[job.name]["last_run"]
+                job.stats.update(state[job.name]["stats"])
+
+
+    def save_state(self):
+        """
+        Save the timestamps of the last runs and the statistics of the jobs to file. The file is replaced atomically so a crash never leaves a half written state behind.
+        """
+
+        state = dict()
+        for job in self.jobs:
+            state[job.name] = dict()
+            state[job.name]["last_run"] = job.last_run
+            state[job.name]["stats"] = job.stats
+
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=4, sort_keys=True)
+        os.replace(tmp_file, self.state_file)
+
+
+    def plan(self, now):
+        """
+        Plan the first run of every job. Jobs that missed a run while the daemon was down are scheduled immediately (once) if they allow catching up.
+
+        :param now: current unix timestamp
+        """
+
+        for job in self.jobs:
+            if job.last_run is not None and job.catch_up and job.cron.next_after(job.last_run) <= now:
+                d_print("Job '{}' missed a run, catching up...", 2, job.name)
+                job.stats["missed"] += 1
+                job.next_run = now
+            else:
+                job.schedule_after(now)
+
+
+    def is_error(self, res):
+        """
+        Check whether the return value of camera.do() means the command failed. Commands that don't produce a result (UPDATE) return None, which is a success.
+
+        :param res: return value of camera.do()
+        :return: True if the command was refused, its result has an error or channels failed to calibrate
+        """
+
+        if isinstance(res, dict):
+            return bool(res.get("encountered_error", False) or res.get("failed"))
+
+        # camera.do() returns an empty string for commands it refuses
+        return res is not None
+
+
+    def run_job(self, job):
+        """
+        Run a single job on the camera and keep track of its latency.
+
+        :param job: the job to run
+        """
+
+        scheduled = job.next_run
+        started = time.time()
+        d_print("Running job '{}' ({})...", 1, job.name, job.command)
+
+        try:
+            res = self.camera.do(job.command)
+            error = self.is_error(res)
+            raised = False
+        except Exception as e:
+            d_print("Job '{}' raised an exception: {}", 3, job.name, e)
+            res = None
+            error = True
+            raised = True
+
+        finished = time.time()
+        job.record(scheduled, started, finished, error)
+        d_print("Job '{}' took {:.2f} s (started {:.2f} s late)", 1, job.name, finished - started, started - scheduled)
+
+        if self.on_result is not None and not raised:
+            self.on_result(job, res)
+
+        if self.publisher is not None and isinstance(res, dict):
+            self.publisher.publish_result(res, command = job.command, job = job.name)
+
+        # runs that were missed while this job was running are coalesced into a single catch up run
+        if job.cron.next_after(scheduled) <= finished and job.catch_up:
+            job.stats["missed"] += 1
+            job.next_run = finished
+        else:
+            job.schedule_after(finished)
+
+
+    def run(self):
+        """
+        Run the daemon until stop() is called or SIGINT/SIGTERM is received. Due jobs are run one at a time in order of their planned time.
+        """
+
+        self.install_signal_handlers()
+        self.load_state()
+        self.plan(time.time())
+
+        if self.retention is not None:
+            self.retention.start()
+        if self.publisher is not None:
+            self.publisher.start()
+
+        d_print("Daemon started with {} job(s).", 1, len(self.jobs))
+
+        # the background threads are stopped however the loop ends
+        try:
+            while not self.stop_event.is_set():
+                job = min(self.jobs, key=lambda j: j.next_run)
+                delay = job.next_run - time.time()
+
+                # wait until the job is due, but wake up immediately when asked to stop
+                if delay > 0 and self.stop_event.wait(delay):
+                    break
+
+                self.run_job(job)
+                self.save_state()
+        finally:
+            self.save_state()
+
+            if self.retention is not None:
+                self.retention.stop()
+            if self.publisher is not None:
+                self.publisher.stop()
+
+        d_print("Daemon stopped.", 1)
+
+
+    def stop(self, *args):
+        """
+        Ask the daemon to stop. A job that is currently running is finished first.
+        """
+
+        self.stop_event.set()
+
+
+    def install_signal_handlers(self):
+        """
+        Stop the daemon gracefully on SIGINT and SIGTERM. Only possible from the main thread.
+        """
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+
+
+    def stats(self):
+        """
+        Return the latency statistics of all jobs.
+
+        :return: dict with the statistics per job name
+        """
+
+        return {job.name: dict(job.stats) for job in self.jobs}
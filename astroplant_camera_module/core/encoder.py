@@ -0,0 +1,198 @@
+"""
+Implementation of the image encoder.
+All images written by the camera go through this object, so the format, quality and compression can be configured in one place.
+"""
+
+import os
+import time
+import cv2
+
+import numpy as np
+
+from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.misc.trace import tracer
+
+
+# compression tag and schemes as defined by libtiff (not all versions of opencv expose these as named constants)
+IMWRITE_TIFF_COMPRESSION = getattr(cv2, "IMWRITE_TIFF_COMPRESSION", 259)
+TIFF_COMPRESSION_NONE = 1
+TIFF_COMPRESSION_LZW = 5
+TIFF_COMPRESSION_DEFLATE = 8
+
+
+class ENCODER(object):
+    def __init__(self, *args, photo_format = "jpg", jpeg_quality = 90, png_compression = 3, webp_quality = 90, ndvi_format = "tif16", tiff_compression = TIFF_COMPRESSION_LZW, pyramid_levels = 0, **kwargs):
+        """
+        Initialize an encoder that turns image arrays into files on disk. Encoding is done with cv2.imencode, which is considerably faster than imageio for jpeg and allows tuning the quality and compression.
+
+        :param photo_format: format of the regular photos, one of "jpg", "png" or "webp"
+        :param jpeg_quality: jpeg quality, 0-100 (higher is better and larger)
+        :param png_compression: png compression level, 0-9 (higher is smaller and slower)
+        :param webp_quality: webp quality, 1-100, values above 100 are lossless
+        :param ndvi_format: format of the raw ndvi matrix, either "tif16" (lossless compressed 16 bit) or "tif8" (uncompressed 8 bit, legacy)
+        :param tiff_compression: libtiff compression scheme used for 16 bit tiffs
+        :param pyramid_levels: number of downscaled versions (1/2, 1/4, ...) written next to every photo, for use as previews/thumbnails
+        """
+
+        if photo_format not in ["jpg", "png", "webp"]:
+            raise ValueError("unknown photo format '{}'".format(photo_format))
+        if ndvi_format not in ["tif16", "tif8"]:
+            raise ValueError("unknown ndvi format '{}'".format(ndvi_format))
+
+        self.photo_format = photo_format
+        self.jpeg_quality = jpeg_quality
+        self.png_compression = png_compression
+        self.webp_quality = webp_quality
+        self.ndvi_format = ndvi_format
+        self.tiff_compression = tiff_compression
+        self.pyramid_levels = pyramid_levels
+
+
+    def params(self, ext):
+        """
+        Get the opencv encoding parameters for the given file extension.
+
+        :param ext: file extension without the dot
+        :return: list of opencv imwrite parameters
+        """
+
+        if ext == "jpg":
+            return [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        elif ext == "png":
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        elif ext == "webp":
+            return [cv2.IMWRITE_WEBP_QUALITY, self.webp_quality]
+        elif ext == "tif":
+            return [IMWRITE_TIFF_COMPRESSION, self.tiff_compression]
+        else:
+            return []
+
+
+    def encode(self, img, ext, params = None):
+        """
+        Encode an image to bytes in memory.
+
+        :param img: 8 or 16 bit array, either single channel or rgb (so NOT bgr as opencv expects)
+        :param ext: file extension without the dot
+        :param params: opencv imwrite parameters, overrides the configured ones if given
+        :return: encoded bytes
+        """
+
+        if img.ndim == 3 and img.shape[2] == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        elif img.ndim == 3 and img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGRA)
+
+        if params is None:
+            params = self.params(ext)
+
+        ok, buf = cv2.imencode("." + ext, img, params)
+        if not ok:
+            raise ValueError("could not encode image to '{}'".format(ext))
+
+        return buf
+
+
+    def write(self, path_without_ext, img, ext, params = None):
+        """
+        Encode an image and write it to disk (atomically), measuring how long encoding took and how large the result is.
+
+        :param path_without_ext: path of the file to write, the extension is added by the encoder
+        :param img: 8 or 16 bit array, either single channel or rgb
+        :param ext: file extension without the dot
+        :param params: opencv imwrite parameters, overrides the configured ones if given
+        :return: dict containing the path, the number of bytes and the encoding time in seconds
+        """
+
+        with tracer.span("encode", ext=ext):
+            start = time.perf_counter()
+            buf = self.encode(img, ext, params)
+            encode_time = time.perf_counter() - start
+
+        # write next to the final path first, so nothing (like the retention engine) ever sees a half written file
+        path = "{}.{}".format(path_without_ext, ext)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(buf.tobytes())
+        os.replace(tmp_path, path)
+
+        d_print("Encoded {} ({} bytes) in {:.3f} s", 1, path, buf.size, encode_time)
+
+        info = dict()
+        info["path"] = path
+        info["bytes"] = int(buf.size)
+        info["encode_time"] = encode_time
+
+        return info
+
+
+    def write_photo(self, path_without_ext, rgb):
+        """
+        Write a regular (8 bit) photo in the configured photo format.
+
+        :param path_without_ext: path of the file to write, the extension is added by the encoder
+        :param rgb: 8 bit rgb or single channel array
+        :return: dict containing the path, the number of bytes and the encoding time in seconds
+        """
+
+        rgb = rgb.astype(np.uint8, copy=False)
+
+        info = self.write(path_without_ext, rgb, self.photo_format)
+        info["pyramid"] = self.write_pyramid(path_without_ext, rgb)
+
+        return info
+
+
+    def write_pyramid(self, path_without_ext, img):
+        """
+        Write the downscaled versions of an image that is still in memory, halving the resolution every level with cv2.pyrDown. Levels are written in the photo format with the scale appended to the file name, for example photo_1-4.jpg for the quarter resolution version.
+
+        :param path_without_ext: path of the full resolution file, without extension
+        :param img: 8 bit rgb or single channel array
+        :return: list with the paths of the levels, from large to small
+        """
+
+        paths = []
+        for level in range(1, self.pyramid_levels + 1):
+            img = cv2.pyrDown(img)
+            info = self.write("{}_1-{}".format(path_without_ext, 2**level), img, self.photo_format)
+            paths.append(info["path"])
+
+        return paths
+
+
+    def write_ndvi(self, path_without_ext, ndvi):
+        """
+        Write a raw ndvi matrix (values in [-1, 1]) losslessly. In the 16 bit format -1 maps to 0 and 1 maps to 65535, in the legacy 8 bit format -1 maps to 0 and 1 maps to 255.
+
+        :param path_without_ext: path of the file to write, the extension is added by the encoder
+        :param ndvi: ndvi matrix with values in [-1, 1]
+        :return: dict containing the path, the number of bytes and the encoding time in seconds
+        """
+
+        rescaled = np.uint8(np.round(127.5*(ndvi + 1.0)))
+
+        if self.ndvi_format == "tif16":
+            info = self.write(path_without_ext, np.uint16(np.round(32767.5*(ndvi + 1.0))), "tif")
+        else:
+            # uncompressed, as written by previous versions of the module
+            info = self.write(path_without_ext, rescaled, "tif", [IMWRITE_TIFF_COMPRESSION, TIFF_COMPRESSION_NONE])
+
+        # previews of the raw ndvi are always 8 bit
+        info["pyramid"] = self.write_pyramid(path_without_ext, rescaled)
+
+        return info
+
+
+def add_encode_info(res, infos):
+    """
+    Add the paths, sizes and encoding times of the written artifacts (and the paths of their pyramid levels) to a result dict.
+
+    :param res: result dict as returned to the user
+    :param infos: list of dicts as returned by ENCODER.write
+    """
+
+    res["photo_path"] = [info["path"] for info in infos]
+    res["encode_bytes"] = [info["bytes"] for info in infos]
+    res["encode_time"] = [info["encode_time"] for info in infos]
+    res["pyramid_path"] = [info.get("pyramid", []) for info in infos]
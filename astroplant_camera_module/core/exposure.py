@@ -0,0 +1,188 @@
+"""
+Implementation of the exposure planner.
+Keeps the exposure of every channel current by planning the gains and shutter speed of the next capture from the histogram of the last one, instead of letting the automatic exposure of the sensor settle.
+"""
+
+import time
+import cv2
+
+import numpy as np
+
+from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.core.roi_stats import ROI_STATS
+from astroplant_camera_module.typedef import LC
+
+
+class EXPOSURE_PLANNER(object):
+    def __init__(self, *args, camera, target = 0.45, highlight = 0.95, percentile = 99.9, saturation_limit = 0.001, damping = 0.7, analog_gain = (1.0, 8.0), digital_gain = (1.0, 2.0), ff_range = (0.67, 1.5), save_interval = 600, save_tolerance = 0.05, **kwargs):
+        """
+        Initialize an exposure planner. After every capture, the exposure needed to bring the mean of the ground plane to the target is computed, limited so the highlights don't clip, and split over analog gain, digital gain and shutter speed (in that order of preference).
+
+        The linear range ff_range is a fixed assumption, not a measurement: it is the limit update() has always enforced (at most 1.5 times the flatfield gain, above which the sensor was seen to respond non-linearly to bright pixels). The response curves of analysis/linearity.py are fitted per swept parameter and don't give a range relative to the flatfield gain, so they are not used here; adjust ff_range in the settings if a sweep of the sensor shows otherwise.
+
+        :param camera: link to the camera object controlling these subroutines
+        :param target: target mean of the ground plane as a fraction of full scale
+        :param highlight: the given percentile of the bright frame is kept below this fraction of full scale
+        :param percentile: percentile of the bright frame that counts as the highlights
+        :param saturation_limit: if a larger fraction of the bright frame is saturated, the exposure is at least halved
+        :param damping: exponent applied to the correction factor, values below 1 prevent the exposure from oscillating
+        :param analog_gain: (min, max) analog gain of the sensor
+        :param digital_gain: (min, max) digital gain of the sensor
+        :param ff_range: (min, max) effective gain of the red and nir channels relative to their flatfield gain, the range in which the response is assumed to be linear
+        :param save_interval: seconds after which the plans are saved to the configuration file, even if they hardly changed
+        :param save_tolerance: relative change of the gains or shutter speed of a plan at which it is saved right away
+        """
+
+        self.camera = camera
+
+        self.target = target
+        self.highlight = highlight
+        self.percentile = percentile
+        self.saturation_limit = saturation_limit
+        self.damping = damping
+        self.analog_gain = analog_gain
+        self.digital_gain = digital_gain
+        self.ff_range = ff_range
+        self.save_interval = save_interval
+        self.save_tolerance = save_tolerance
+
+        # statistics of the last capture per channel
+        self.state = dict()
+
+        # plans as last saved to the configuration file per channel, the configuration in memory is always current
+        self.saved = dict()
+        self.saved_time = None
+
+
+    def statistics(self, channel: LC, bright, rgb):
+        """
+        Compute the statistics of a capture that the plan is based on.
+
+        :param channel: channel of light in which the photo was taken
+        :param bright: 8 bit rgb array of the bright frame (before dark frame subtraction)
+        :param rgb: 8 bit rgb array after dark frame subtraction
+        :return: dict with the histogram of the bright frame, the saturated fraction, the highlight level and the mean of the ground plane
+        """
+
+        # the brightest subpixel decides whether a pixel clips
+        peak = cv2.max(cv2.max(bright[:, :, 0], bright[:, :, 1]), bright[:, :, 2])
+        hist = cv2.calcHist([peak], [0], None, [256], [0, 256]).ravel()
+        cumulative = np.cumsum(hist)/peak.size
+
+        if channel == LC.RED:
+            v = rgb[:, :, 0]
+        else:
+            v = cv2.max(cv2.max(rgb[:, :, 0], rgb[:, :, 1]), rgb[:, :, 2])
+
+        # the ground plane in the coordinates of the captured frame, which may be scaled down
+        roi = self.camera.ground_plane_roi(self.camera.frame_factor(rgb))
+
+        stats = dict()
+        stats["hist"] = hist
+        stats["saturation"] = float(hist[255]/peak.size)
+        stats["highlight"] = int(np.searchsorted(cumulative, self.percentile/100.0))
+        stats["mean"] = float(ROI_STATS(v).mean(roi))
+        stats["timestamp"] = time.time()
+
+        return stats
+
+
+    def gain_range(self, channel: LC):
+        """
+        Range of the effective gain in which the response of the channel is linear.
+
+        :param channel: light channel
+        :return: (min, max) effective gain
+        """
+
+        low = self.analog_gain[0]*self.digital_gain[0]
+        high = self.analog_gain[1]*self.digital_gain[1]
+
+        if (channel == LC.RED or channel == LC.NIR) and self.camera.CALIBRATED:
+            ff_gain = self.camera.config["ff"]["gain"][channel]
+            low = max(low, self.ff_range[0]*ff_gain)
+            high = min(high, self.ff_range[1]*ff_gain)
+
+        return (low, high)
+
+
+    def split(self, channel: LC, exposure):
+        """
+        Split an exposure, relative to the exposure at the shutter speed from the settings with unity gain, into analog gain, digital gain and shutter speed. Gains are preferred over a longer shutter speed, since the shutter speed from the settings is close to the frame period already.
+
+        :param channel: light channel
+        :param exposure: relative exposure
+        :return: (analog gain, digital gain, shutter speed)
+        """
+
+        reference = self.camera.settings.shutter_speed[channel]
+        shortest = 0.25*reference
+        longest = max(reference, 1e6/float(self.camera.settings.framerate[channel]))
+
+        low, high = self.gain_range(channel)
+        gain = min(max(exposure, low), high)
+
+        ag = min(max(gain, self.analog_gain[0]), self.analog_gain[1])
+        dg = min(max(gain/ag, self.digital_gain[0]), self.digital_gain[1])
+
+        # whatever the gains can't deliver is made up for by the shutter speed
+        shutter_speed = int(min(max(reference*exposure/(ag*dg), shortest), longest))
+
+        return (ag, dg, shutter_speed)
+
+
+    def observe(self, channel: LC, bright, rgb):
+        """
+        Update the state of a channel with a new capture and store the plan for the next capture of that channel in the d2d part of the configuration.
+
+        :param channel: channel of light in which the photo was taken
+        :param bright: 8 bit rgb array of the bright frame (before dark frame subtraction)
+        :param rgb: 8 bit rgb array after dark frame subtraction
+        """
+
+        stats = self.statistics(channel, bright, rgb)
+        self.state[channel] = stats
+
+        d2d = self.camera.config["d2d"][channel]
+        reference = self.camera.settings.shutter_speed[channel]
+        exposure = d2d["analog-gain"]*d2d["digital-gain"]*d2d.get("shutter-speed", reference)/reference
+
+        # correction needed to hit the target, limited by the highlights
+        factor = self.target*255/max(stats["mean"], 1.0)
+        factor = min(factor, self.highlight*255/max(stats["highlight"], 1))
+        if stats["saturation"] > self.saturation_limit:
+            factor = min(factor, 0.5)
+        factor = factor**self.damping
+
+        ag, dg, shutter_speed = self.split(channel, exposure*factor)
+        d2d["analog-gain"] = ag
+        d2d["digital-gain"] = dg
+        d2d["shutter-speed"] = shutter_speed
+        self.camera.config["d2d"]["timestamp"] = stats["timestamp"]
+
+        d_print("Exposure of {}: mean {:.1f}, saturated {:.4f}, highlight {}, next ag: {:.3f} dg: {:.3f} ss: {}", 1, channel, stats["mean"], stats["saturation"], stats["highlight"], ag, dg, shutter_speed)
+
+        self.save((ag, dg, shutter_speed), channel)
+
+
+    def save(self, plan, channel: LC):
+        """
+        Save the configuration with the new plan of a channel, but only if the plan changed noticeably since it was last saved or the plans were not saved for save_interval seconds, instead of writing the file after every capture.
+
+        :param plan: (analog gain, digital gain, shutter speed)
+        :param channel: light channel of the plan
+        """
+
+        now = time.monotonic()
+        saved = self.saved.get(channel)
+        if saved is not None and now - self.saved_time < self.save_interval:
+            if all(abs(new - old) <= self.save_tolerance*abs(old) for new, old in zip(plan, saved)):
+                return
+
+        self.camera.save_config_to_file()
+
+        # the file now holds the current plans of all channels
+        d2d = self.camera.config["d2d"]
+        for c in self.state:
+            self.saved[c] = (d2d[c]["analog-gain"], d2d[c]["digital-gain"], d2d[c]["shutter-speed"])
+        self.saved_time = now
@@ -0,0 +1,393 @@
+"""
+Implementation of the shared memory frame ring.
+Frames are handed between processes through a fixed number of slots in shared memory, so multi-megabyte frames are written once and read in place by every other process. Every slot is owned by at most one process at a time: a writer acquires a free slot, fills it and commits it, a reader takes a ready slot and releases it when done.
+
+This module only imports numpy and the standard library, so the capture process that uses it stays small.
+"""
+
+import os
+import queue
+import signal
+import time
+import subprocess
+import multiprocessing as mp
+
+import numpy as np
+
+from multiprocessing import shared_memory
+
+
+# states of a slot
+FREE = 0
+WRITING = 1
+READY = 2
+READING = 3
+
+# number of float64 metadata values stored per slot (for example a channel index, gain and timestamp)
+META_SIZE = 4
+
+ALIGNMENT = 64
+
+
+def aligned(size):
+    return (size + ALIGNMENT - 1)//ALIGNMENT*ALIGNMENT
+
+
+class FRAME_RING(object):
+    def __init__(self, *args, slots, shape, dtype = np.uint8, name = None, condition = None, **kwargs):
+        """
+        Create a frame ring, or attach to an existing one when a name is given. Rings are attached to in other processes by passing the ring object as an argument of a multiprocessing.Process, which attaches to the same shared memory.
+
+        :param slots: number of slots
+        :param shape: shape of the frame in every slot
+        :param dtype: dtype of the frames
+        :param name: name of the shared memory to attach to (None to create a new ring)
+        :param condition: multiprocessing.Condition guarding the slot states, created if None
+        """
+
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.condition = condition if condition is not None else mp.get_context("spawn").Condition()
+
+        # header: state, owner pid and sequence number per slot, metadata per slot and the sequence counter
+        self.header_size = aligned(8*slots*(3 + META_SIZE) + 8)
+        self.slot_size = aligned(int(np.prod(self.shape))*self.dtype.itemsize)
+
+        self.created = name is None
+        if self.created:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.header_size + slots*self.slot_size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+        buf = self.shm.buf
+        self.states = np.ndarray((slots,), dtype=np.int64, buffer=buf, offset=0)
+        self.owners = np.ndarray((slots,), dtype=np.int64, buffer=buf, offset=8*slots)
+        self.seqs = np.ndarray((slots,), dtype=np.int64, buffer=buf, offset=16*slots)
+        self.meta = np.ndarray((slots, META_SIZE), dtype=np.float64, buffer=buf, offset=24*slots)
+        self.counter = np.ndarray((1,), dtype=np.int64, buffer=buf, offset=8*slots*(3 + META_SIZE))
+
+        if self.created:
+            self.states[:] = FREE
+            self.owners[:] = 0
+            self.counter[0] = 0
+
+
+    def __getstate__(self):
+        return dict(slots=self.slots, shape=self.shape, dtype=self.dtype.str, name=self.name, condition=self.condition)
+
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+    def view(self, slot):
+        """
+        Get the frame in a slot, without copying it. Only use it while owning the slot.
+
+        :param slot: slot index
+        :return: array backed by the shared memory
+        """
+
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf, offset=self.header_size + slot*self.slot_size)
+
+
+    def transition(self, select, new_state, timeout):
+        """
+        Wait for a slot that the select function picks, and move it to a new state owned by this process.
+
+        :param select: function returning a slot index or None, called with the condition held
+        :param new_state: state of the slot afterwards
+        :param timeout: maximum number of seconds to wait (None to wait forever)
+        :return: slot index, or None on timeout
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.condition:
+            while True:
+                slot = select()
+                if slot is not None:
+                    self.states[slot] = new_state
+                    self.owners[slot] = os.getpid()
+                    return slot
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+
+    def acquire_write(self, timeout = None):
+        """
+        Acquire a free slot to write a frame into.
+
+        :param timeout: maximum number of seconds to wait for a free slot
+        :return: slot index, or None on timeout
+        """
+
+        def select():
+            free = np.flatnonzero(self.states == FREE)
+            return int(free[0]) if free.size else None
+
+        return self.transition(select, WRITING, timeout)
+
+
+    def commit(self, slot, meta = ()):
+        """
+        Mark a written slot as ready for readers.
+
+        :param slot: slot index, owned by this process in the WRITING state
+        :param meta: up to META_SIZE numbers stored with the frame
+        """
+
+        with self.condition:
+            self.check_owner(slot, WRITING)
+            self.meta[slot, :] = np.nan
+            self.meta[slot, :len(meta)] = meta
+            self.counter[0] += 1
+            self.seqs[slot] = self.counter[0]
+            self.states[slot] = READY
+            self.owners[slot] = 0
+            self.condition.notify_all()
+
+
+    def acquire_read(self, slot = None, timeout = None):
+        """
+        Take a ready slot for reading, the oldest one unless a specific slot is asked for.
+
+        :param slot: slot index to take, or None for the oldest ready slot
+        :param timeout: maximum number of seconds to wait
+        :return: slot index, or None on timeout
+        """
+
+        def select():
+            if slot is not None:
+                return slot if self.states[slot] == READY else None
+            ready = np.flatnonzero(self.states == READY)
+            return int(ready[np.argmin(self.seqs[ready])]) if ready.size else None
+
+        return self.transition(select, READING, timeout)
+
+
+    def release(self, slot):
+        """
+        Give a slot back, after reading it (or after giving up on writing it).
+
+        :param slot: slot index, owned by this process
+        """
+
+        with self.condition:
+            if self.owners[slot] != os.getpid():
+                raise ValueError("slot {} is not owned by this process".format(slot))
+            self.states[slot] = FREE
+            self.owners[slot] = 0
+            self.condition.notify_all()
+
+
+    def check_owner(self, slot, state):
+        if self.states[slot] != state or self.owners[slot] != os.getpid():
+            raise ValueError("slot {} is not in the expected state or not owned by this process".format(slot))
+
+
+    def reclaim(self, ready = False):
+        """
+        Free the slots owned by processes that no longer exist (for example a capture process that was killed).
+
+        :param ready: also free the ready slots, whose frames nobody is going to read anymore (for example because the reply of the writer was lost)
+        :return: number of reclaimed slots
+        """
+
+        reclaimed = 0
+        with self.condition:
+            for slot in range(self.slots):
+                pid = int(self.owners[slot])
+                if pid == 0:
+                    if ready and self.states[slot] == READY:
+                        self.states[slot] = FREE
+                        reclaimed += 1
+                    continue
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:
+                    self.states[slot] = FREE
+                    self.owners[slot] = 0
+                    reclaimed += 1
+            if reclaimed:
+                self.condition.notify_all()
+
+        return reclaimed
+
+
+    def close(self):
+        """
+        Detach from the shared memory in this process. Views of the slots can't be used afterwards.
+        """
+
+        self.states = self.owners = self.seqs = self.meta = self.counter = None
+        self.shm.close()
+
+
+    def unlink(self):
+        """
+        Close and free the shared memory, done by the process that created the ring.
+        """
+
+        self.close()
+        if self.created:
+            self.shm.unlink()
+
+
+def bmp_into(data, out):
+    """
+    Decode an uncompressed 24 bit bmp (as written by raspistill) into an rgb array, flipping it upright and swapping bgr to rgb in the single copy into out.
+
+    :param data: bytes of the bmp file
+    :param out: 8 bit rgb array with the shape of the image
+    """
+
+    offset = int.from_bytes(data[10:14], "little")
+    width = int.from_bytes(data[18:22], "little", signed=True)
+    height = int.from_bytes(data[22:26], "little", signed=True)
+    bpp = int.from_bytes(data[28:30], "little")
+    if bpp != 24 or (abs(height), width) != out.shape[:2]:
+        raise ValueError("unexpected bmp: {}x{} at {} bits per pixel".format(width, height, bpp))
+
+    row = (3*width + 3)//4*4
+    pixels = np.frombuffer(data, dtype=np.uint8, count=row*abs(height), offset=offset).reshape(abs(height), row)[:, :3*width].reshape(abs(height), width, 3)
+
+    # positive heights are stored bottom-up
+    if height > 0:
+        pixels = pixels[::-1]
+    out[...] = pixels[:, :, ::-1]
+
+
+def run_command(cmd, timeout, stdout = None):
+    """
+    Run a shell command in its own process group, so on a timeout the command itself (for example raspistill, which would keep the camera busy) is killed along with the shell. Raises subprocess.TimeoutExpired on a timeout and subprocess.CalledProcessError if the command fails.
+
+    :param cmd: shell command
+    :param timeout: maximum number of seconds the command may take
+    :param stdout: None to leave stdout alone, subprocess.PIPE to return it
+    :return: the output on stdout (if requested)
+    """
+
+    p = subprocess.Popen(cmd, shell=True, stdout=stdout, stderr=subprocess.DEVNULL if stdout is not None else None, start_new_session=True)
+    try:
+        out, _ = p.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(p.pid, signal.SIGKILL)
+        p.communicate()
+        raise
+
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+    return out
+
+
+def capture_loop(ring, requests, replies):
+    """
+    Main loop of the capture process: runs the photo commands it receives, which have to write a bmp to stdout, and puts the frames straight into slots of the ring. Replies with the slot index, or None if the capture failed.
+
+    :param ring: FRAME_RING with 8 bit rgb frames
+    :param requests: queue of (command, timeout, meta) tuples, None to stop
+    :param replies: queue the slot indices are put in
+    """
+
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        cmd, timeout, meta = request
+
+        slot = None
+        try:
+            out = run_command(cmd, timeout, stdout=subprocess.PIPE)
+            slot = ring.acquire_write(timeout=timeout)
+            if slot is not None:
+                bmp_into(out, ring.view(slot))
+                ring.commit(slot, meta)
+        except Exception:
+            if slot is not None:
+                ring.release(slot)
+            slot = None
+
+        replies.put(slot)
+
+
+class CAPTURE_PROCESS(object):
+    def __init__(self, *args, shape, slots = 3, **kwargs):
+        """
+        Initialize a lean capture process (started on first use) that writes frames into a shared memory ring owned by this process.
+
+        :param shape: shape of the 8 bit rgb frames
+        :param slots: number of slots in the ring (a bright and a dark frame, plus one to overlap with processing)
+        """
+
+        self.ctx = mp.get_context("spawn")
+        self.ring = FRAME_RING(slots=slots, shape=shape, dtype=np.uint8, condition=self.ctx.Condition())
+        self.requests = self.ctx.Queue()
+        self.replies = self.ctx.Queue()
+        self.process = None
+
+
+    def start(self):
+        if self.process is None or not self.process.is_alive():
+            self.ring.reclaim()
+            self.process = self.ctx.Process(target=capture_loop, args=(self.ring, self.requests, self.replies), daemon=True)
+            self.process.start()
+
+
+    def capture(self, cmd, timeout = 20, meta = ()):
+        """
+        Capture a frame with a photo command that writes a bmp to stdout (for example raspistill ... -o -). If the capture process does not reply in time, it is killed and started again on the next capture.
+
+        :param cmd: photo command
+        :param timeout: maximum number of seconds the command may take
+        :param meta: numbers stored with the frame
+        :return: slot index, taken for reading by this process (release it when done), or None if the capture failed
+        """
+
+        self.start()
+        self.requests.put((cmd, timeout, meta))
+        try:
+            slot = self.replies.get(timeout=timeout + 10)
+        except queue.Empty:
+            self.kill()
+            return None
+        if slot is None:
+            return None
+
+        return self.ring.acquire_read(slot, timeout=timeout)
+
+
+    def kill(self):
+        """
+        Kill a capture process that hangs. Its queues are replaced, so requests and replies that are still in them are dropped, and the slots it was writing or that nobody will read are freed.
+        """
+
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(2)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+        self.process = None
+
+        self.requests = self.ctx.Queue()
+        self.replies = self.ctx.Queue()
+        self.ring.reclaim(ready = True)
+
+
+    def stop(self):
+        """
+        Stop the capture process and free the ring.
+        """
+
+        if self.process is not None and self.process.is_alive():
+            self.requests.put(None)
+            self.process.join()
+        self.process = None
+        self.ring.unlink()
@@ -0,0 +1,252 @@
+"""
+Implementation of the vegetation index engine.
+Vegetation indices are declared as expressions over the calibrated planes of the red, nir and white captures, for example "NIR / R" or "WG / (WR + WG + WB)". All requested indices are compiled once into a single kernel that computes them in one pass over the shared planes: every subexpression is computed once, and indices of at most two planes are looked up in a table of all 8 bit combinations (like the ndvi, see core/ndvi.py) instead of being computed per pixel.
+"""
+
+import ast
+
+import numpy as np
+
+from astroplant_camera_module.misc.debug_print import d_print
+
+
+# calibrated planes available to the expressions:
+#   R:          red reflectance (red capture, 0.8 for the flatfield, like the ndvi)
+#   NIR:        nir reflectance (nir capture, 0.8 for the flatfield, like the ndvi)
+#   WR, WG, WB: red, green and blue of the white balanced white capture, scaled to 0-1 and divided by its gain
+PLANES = ["R", "NIR", "WR", "WG", "WB"]
+WHITE_PLANES = ["WR", "WG", "WB"]
+
+# functions available to the expressions
+FUNCTIONS = {"abs": "np.abs", "sqrt": "np.sqrt", "min": "np.minimum", "max": "np.maximum"}
+
+OPERATORS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Pow: "**"}
+
+
+def safe_divide(num, den, min_denominator):
+    """
+    Divide, with 0 wherever the denominator is (almost) zero, like the failsafe of the ndvi.
+
+    :param num: numerator
+    :param den: denominator
+    :param min_denominator: denominators closer to zero than this give 0
+    :return: quotient
+    """
+
+    num, den = np.broadcast_arrays(num, den)
+    out = np.zeros(num.shape, dtype=np.result_type(num, den, np.float32))
+
+    return np.divide(num, den, out=out, where=np.abs(den) >= min_denominator)
+
+
+class INDEX_ENGINE(object):
+    def __init__(self, *args, indices, lut = True, min_denominator = 0.05, **kwargs):
+        """
+        Initialize an index engine and compile the indices.
+
+        :param indices: dict of expressions by index name, using the planes in PLANES (at least one), numbers, + - * / **, and the functions abs, sqrt, min and max
+        :param lut: look up the indices of at most two planes in a table of all 8 bit combinations instead of computing them per pixel (same result)
+        :param min_denominator: divisions by values closer to zero than this give 0
+        """
+
+        self.indices = dict(indices)
+        self.min_denominator = min_denominator
+
+        # parse and check all expressions before anything is compiled
+        trees = dict()
+        used = dict()
+        for name, expression in self.indices.items():
+            trees[name], used[name] = self.parse(name, expression)
+
+        # planes the indices need, in a fixed order
+        self.planes = [plane for plane in PLANES if any(plane in used[name] for name in self.indices)]
+        self.uses_white = any(plane in WHITE_PLANES for plane in self.planes)
+
+        # group the indices that can be looked up by the planes they use, every group shares one table
+        self.groups = []
+        computed = []
+        for name in self.indices:
+            planes = tuple(plane for plane in PLANES if plane in used[name])
+            if lut and 1 <= len(planes) <= 2:
+                for group in self.groups:
+                    if group["planes"] == planes:
+                        group["names"].append(name)
+                        break
+                else:
+                    self.groups.append(dict(planes = planes, names = [name]))
+            else:
+                computed.append(name)
+
+        # slots of the indices in the output: the groups first, then the computed indices
+        self.names = [name for group in self.groups for name in group["names"]] + computed
+        self.slots = {name: slot for slot, name in enumerate(self.names)}
+
+        # every group gets its own kernel to build its table with, the computed indices share one
+        for group in self.groups:
+            group["kernel"] = self.compile(trees, group["names"], dict((name, slot) for slot, name in enumerate(group["names"])))
+            group["slots"] = (self.slots[group["names"][0]], self.slots[group["names"][-1]] + 1)
+        self.kernel = self.compile(trees, computed, self.slots) if computed else None
+
+        # tables of the last capture, rebuilt only when the calibrated levels change
+        self.tables = None
+        self.table_key = None
+
+        d_print("Compiled vegetation indices {} over planes {} ({} looked up)", 1, self.names, self.planes, len(self.names) - len(computed))
+
+
+    def parse(self, name, expression):
+        """
+        Parse an expression and check that it only uses what is allowed.
+
+        :param name: name of the index
+        :param expression: expression string
+        :return: (expression tree, set of the planes it uses)
+        """
+
+        try:
+            tree = ast.parse(expression, mode="eval").body
+        except SyntaxError as e:
+            raise ValueError("index {}: invalid expression '{}': {}".format(name, expression, e))
+
+        # names of functions are only allowed where they are called
+        functions = set(id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call))
+
+        used = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                if node.id in PLANES:
+                    used.add(node.id)
+                elif node.id not in FUNCTIONS or id(node) not in functions:
+                    raise ValueError("index {}: unknown plane '{}', available: {}".format(name, node.id, PLANES))
+            elif isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords:
+                    raise ValueError("index {}: only the functions {} can be used".format(name, list(FUNCTIONS)))
+            elif isinstance(node, ast.Constant):
+                if not isinstance(node.value, (int, float)) or isinstance(node.value, bool):
+                    raise ValueError("index {}: only numbers can be used as constants".format(name))
+            elif isinstance(node, ast.BinOp):
+                if type(node.op) not in OPERATORS and not isinstance(node.op, ast.Div):
+                    raise ValueError("index {}: only + - * / ** can be used".format(name))
+            elif isinstance(node, ast.UnaryOp):
+                if not isinstance(node.op, (ast.USub, ast.UAdd)):
+                    raise ValueError("index {}: only + - * / ** can be used".format(name))
+            elif not isinstance(node, (ast.Load, ast.operator, ast.unaryop)):
+                raise ValueError("index {}: '{}' can't be used in an expression".format(name, type(node).__name__))
+
+        # a constant is not an index, and there would be nothing to take the shape of the output from
+        if not used:
+            raise ValueError("index {}: expression '{}' does not use any plane, available: {}".format(name, expression, PLANES))
+
+        return (tree, used)
+
+
+    def compile(self, trees, names, slots):
+        """
+        Compile the expressions of a number of indices into one kernel. Subexpressions that appear more than once (within or across indices) are computed once.
+
+        :param trees: dict of expression trees by index name
+        :param names: names of the indices to compute
+        :param slots: dict of the slot of every index in the last axis of the output
+        :return: function kernel(out, **planes) that writes the indices into out[..., slot], with the planes as float arrays
+        """
+
+        lines = []
+        temps = dict()
+
+        def emit(node):
+            key = ast.dump(node)
+            if key in temps:
+                return temps[key]
+
+            if isinstance(node, ast.Name):
+                return node.id
+            elif isinstance(node, ast.Constant):
+                return repr(float(node.value))
+            elif isinstance(node, ast.UnaryOp):
+                operand = emit(node.operand)
+                code = "-{}".format(operand) if isinstance(node.op, ast.USub) else operand
+            elif isinstance(node, ast.BinOp):
+                left, right = emit(node.left), emit(node.right)
+                if isinstance(node.op, ast.Div):
+                    code = "safe_divide({}, {}, {!r})".format(left, right, self.min_denominator)
+                else:
+                    code = "{} {} {}".format(left, OPERATORS[type(node.op)], right)
+            else:
+                code = "{}({})".format(FUNCTIONS[node.func.id], ", ".join(emit(arg) for arg in node.args))
+
+            temps[key] = "t{}".format(len(temps))
+            lines.append("    {} = {}".format(temps[key], code))
+
+            return temps[key]
+
+        for name in names:
+            result = emit(trees[name])
+            lines.append("    out[..., {}] = {}".format(slots[name], result))
+
+        source = "def kernel(out, {}):\n{}\n".format(", ".join("{} = None".format(plane) for plane in PLANES), "\n".join(lines))
+        namespace = dict(np = np, safe_divide = safe_divide)
+        exec(compile(source, "<indices {}>".format(", ".join(names)), "exec"), namespace)
+
+        return namespace["kernel"]
+
+
+    def build_tables(self, levels):
+        """
+        Build the lookup table of every group from the calibrated levels of its planes, unless they did not change.
+
+        :param levels: dict of the 256 calibrated values of every plane
+        """
+
+        key = tuple((plane, levels[plane].tobytes()) for plane in self.planes)
+        if key == self.table_key:
+            return
+
+        self.tables = []
+        for group in self.groups:
+            grids = np.meshgrid(*[levels[plane] for plane in group["planes"]], indexing="ij")
+            table = np.empty(grids[0].shape + (len(group["names"]),), dtype=np.float32)
+            group["kernel"](table, **dict(zip(group["planes"], grids)))
+            self.tables.append(table.reshape(-1, len(group["names"])))
+        self.table_key = key
+
+
+    def rows(self, out, *planes, levels):
+        """
+        Compute all indices of (a chunk of rows of) the 8 bit planes, in the order of self.planes.
+
+        :param out: output array of rows x cols x len(self.names)
+        :param levels: dict of the 256 calibrated values of every plane
+        """
+
+        planes = dict(zip(self.planes, planes))
+
+        for group, table in zip(self.groups, self.tables):
+            index = planes[group["planes"][0]].astype(np.uint16)
+            if len(group["planes"]) == 2:
+                index <<= 8
+                index |= planes[group["planes"][1]]
+            start, stop = group["slots"]
+            out[..., start:stop] = np.take(table, index, axis=0)
+
+        if self.kernel is not None:
+            self.kernel(out, **{plane: levels[plane][planes[plane]] for plane in self.planes})
+
+
+    def compute(self, pool, planes, levels):
+        """
+        Compute all indices in one pass over the planes, in row chunks in the post-processing pool.
+
+        :param pool: PARALLEL post-processing pool
+        :param planes: dict of the 8 bit planes (of the same shape) by name, at least the ones in self.planes
+        :param levels: dict of the 256 calibrated values of every plane (the value of every 8 bit level)
+        :return: dict of the index matrices by name
+        """
+
+        levels = {plane: np.asarray(levels[plane], dtype=np.float32) for plane in self.planes}
+        self.build_tables(levels)
+
+        shape = planes[self.planes[0]].shape
+        out = np.empty(shape + (len(self.names),), dtype=np.float32)
+        pool.rows(lambda out, *chunks: self.rows(out, *chunks, levels = levels), out, *[planes[plane] for plane in self.planes])
+
+        return {name: out[..., self.slots[name]] for name in self.names}
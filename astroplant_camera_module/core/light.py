@@ -0,0 +1,192 @@
+"""
+Implementation of the light manager.
+Keeps track of the state of the lights of the kit so they are only switched when needed, and waits for them to settle based on per-channel profiles.
+"""
+
+import time
+import contextlib
+
+from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.misc.trace import tracer
+from astroplant_camera_module.typedef import LC
+
+
+class LIGHT_MANAGER(object):
+    def __init__(self, *args, light_control = None, gpio = None, pins = None, settle = None, **kwargs):
+        """
+        Initialize a light manager. The lights are either controlled through a light control function (see the README) or directly through a gpio object, such as pigpio.pi() or a stand-in object for testing. A gpio object needs a write(pin, level) method, and if it also has set_bank_1(bits) and clear_bank_1(bits) methods (like pigpio), all pins that change are switched in a single bank write.
+
+        :param light_control: function with parameters channel and state (0 or 1) that controls the lighting
+        :param gpio: gpio object, used instead of light_control
+        :param pins: dict mapping every channel to a pin or a list of pins, required when gpio is used
+        :param settle: dict mapping channels to a tuple (seconds to settle after switching on, seconds to settle after switching off), channels without a profile settle for 0.1 seconds
+        """
+
+        if (light_control is None) == (gpio is None):
+            raise ValueError("supply either a light control function or a gpio object")
+        if gpio is not None and pins is None:
+            raise ValueError("pins are required when controlling the lights through gpio")
+
+        self.light_control = light_control
+        self.gpio = gpio
+        self.pins = dict()
+        if pins is not None:
+            for channel, pin in pins.items():
+                self.pins[channel] = list(pin) if isinstance(pin, (list, tuple)) else [pin]
+
+        self.settle = dict()
+        if settle is not None:
+            self.settle.update(settle)
+
+        # state of every channel as far as we know (None if unknown), and the time at which the lights are settled
+        self.state = dict()
+        self.ready_at = 0.0
+
+        # channels that were released while holding, switched off at the end of the hold
+        self.holding = 0
+        self.pending_off = set()
+
+
+    def set_default_profiles(self, settle):
+        """
+        Set the settle time profiles of channels that have no profile yet, used by the camera to fill in the profiles from its settings without overriding the ones given by the user.
+
+        :param settle: dict mapping channels to a tuple (seconds to settle after switching on, seconds to settle after switching off)
+        """
+
+        for channel, profile in settle.items():
+            self.settle.setdefault(channel, profile)
+
+
+    def switch(self, changes):
+        """
+        Apply a number of channel changes at once, skipping channels that are already in the requested state, and block until the lights are settled.
+
+        :param changes: dict mapping channels to their new state (0 or 1)
+        """
+
+        changes = {channel: state for channel, state in changes.items() if self.state.get(channel) != state}
+
+        if changes:
+            with tracer.span("light", changes=changes):
+                if self.gpio is not None:
+                    self.write_pins(changes)
+                else:
+                    for channel, state in changes.items():
+                        self.light_control(channel, state)
+
+            now = time.time()
+            for channel, state in changes.items():
+                self.state[channel] = state
+                self.ready_at = max(self.ready_at, now + self.settle.get(channel, (0.1, 0.1))[1 - state])
+
+        self.wait()
+
+
+    def write_pins(self, changes):
+        """
+        Write the pins belonging to the changed channels, in a single bank write if the gpio object supports it.
+
+        :param changes: dict mapping channels to their new state (0 or 1)
+        """
+
+        high = 0
+        low = 0
+        for channel, state in changes.items():
+            if channel not in self.pins:
+                d_print("no such light available: {}", 3, channel)
+                continue
+            for pin in self.pins[channel]:
+                if state:
+                    high |= 1 << pin
+                else:
+                    low |= 1 << pin
+
+        if hasattr(self.gpio, "set_bank_1") and hasattr(self.gpio, "clear_bank_1"):
+            if low:
+                self.gpio.clear_bank_1(low)
+            if high:
+                self.gpio.set_bank_1(high)
+        else:
+            for pin in range(max(high | low, 1).bit_length()):
+                if low & (1 << pin):
+                    self.gpio.write(pin, 0)
+                if high & (1 << pin):
+                    self.gpio.write(pin, 1)
+
+
+    def wait(self):
+        """
+        Block until all lights are settled.
+        """
+
+        delay = self.ready_at - time.time()
+        if delay > 0:
+            with tracer.span("light settle"):
+                time.sleep(delay)
+
+
+    def on(self, channel: LC):
+        """
+        Switch a channel on (if it isn't on already) and cancel a pending release of it.
+
+        :param channel: light channel
+        """
+
+        self.pending_off.discard(channel)
+        self.switch({channel: 1})
+
+
+    def off(self, channel: LC):
+        """
+        Switch a channel off immediately (for example for a dark frame).
+
+        :param channel: light channel
+        """
+
+        self.pending_off.discard(channel)
+        self.switch({channel: 0})
+
+
+    def release(self, channel: LC):
+        """
+        Signal that a channel is no longer needed. It is switched off immediately, unless the lights are being held, in which case it is switched off at the end of the hold (or not at all if it is needed again before then).
+
+        :param channel: light channel
+        """
+
+        if self.holding:
+            self.pending_off.add(channel)
+        else:
+            self.off(channel)
+
+
+    def all_off(self):
+        """
+        Switch off all known channels at once.
+        """
+
+        self.pending_off.clear()
+        channels = set(self.pins) | set(self.state)
+        self.switch({channel: 0 for channel in channels})
+
+
+    @contextlib.contextmanager
+    def hold(self):
+        """
+        Context manager in which released lights stay on until the end, so consecutive operations on the same channel don't switch it off and on again:
+
+            with lights.hold():
+                calibrate_white_balance(LC.RED)
+                calibrate_flatfield_gains(LC.RED)
+        """
+
+        self.holding += 1
+        try:
+            yield self
+        finally:
+            self.holding -= 1
+            if not self.holding and self.pending_off:
+                changes = {channel: 0 for channel in self.pending_off}
+                self.pending_off.clear()
+                self.switch(changes)
@@ -1,4 +1,5 @@
 import datetime
+import functools
 import time
 import cv2
 
@@ -11,9 +12,13 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 
-from imageio import imwrite
-
 from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.misc.trace import tracer
+from astroplant_camera_module.core.encoder import add_encode_info
+from astroplant_camera_module.core.registration import REGISTRATION
+from astroplant_camera_module.core.frame_ring import FRAME_RING
+from astroplant_camera_module.core.indices import INDEX_ENGINE, WHITE_PLANES
+from astroplant_camera_module.core.watchdog import STAGE_TIMEOUT
 from astroplant_camera_module.typedef import LC
 
 
@@ -24,6 +29,75 @@ def truncate_colormap(cmap, minval=0.0, maxval=1.0, n=100):
     return new_cmap
 
 
+def ndvi_rows(ndvi, Rr, Rnir):
+    """
+    Compute the ndvi of (a chunk of rows of) the reflectance matrices, with some failsafes against division by (almost) zero.
+
+    :param ndvi: output matrix
+    :param Rr: red reflectance, changed in place
+    :param Rnir: nir reflectance, changed in place
+    """
+
+    Rr[Rnir < 0.1] = 0
+    Rnir[Rnir < 0.1] = 0
+    num = Rnir - Rr
+    den = Rnir + Rr
+    num[np.logical_and(den < 0.05, den > -0.05)] = 0.0
+    den[den < 0.05] = 1.0
+    np.divide(num, den, out=ndvi)
+
+
+def reflectance(v, factor, mask):
+    """
+    Compare pixel values to the saved flatfield value of the calibration.
+
+    :param v: value matrix (or array of values)
+    :param factor: gain correction, 0.8*(flatfield gain)/(gain of the capture)
+    :param mask: flatfield value
+    :return: reflectance
+    """
+
+    return factor*np.divide(v, mask)
+
+
+def ndvi_table(levels_r, levels_nir, dtype = None):
+    """
+    Compute the ndvi of every combination of 8 bit red and nir values. Since the scale factors are constant across a frame, the ndvi of a whole frame is then a single lookup in this table, with exactly the same result as the arithmetic path.
+
+    :param levels_r: red reflectance of each of the 256 values
+    :param levels_nir: nir reflectance of each of the 256 values
+    :param dtype: None for float ndvi, or np.int8 (ndvi*127) or np.uint8 ((ndvi + 1)*127.5) to quantize directly
+    :return: 256x256 table indexed by [red, nir]
+    """
+
+    Rr, Rnir = np.meshgrid(levels_r, levels_nir, indexing="ij")
+    table = np.empty_like(Rr)
+    ndvi_rows(table, Rr, Rnir)
+
+    if dtype == np.int8:
+        table = np.round(np.clip(table, -1.0, 1.0)*127).astype(np.int8)
+    elif dtype == np.uint8:
+        table = np.round((np.clip(table, -1.0, 1.0) + 1)*127.5).astype(np.uint8)
+
+    return table
+
+
+def ndvi_lookup_rows(ndvi, r, v, table):
+    """
+    Look up the ndvi of (a chunk of rows of) the 8 bit red and nir value matrices.
+
+    :param ndvi: output matrix, with the dtype of the table
+    :param r: 8 bit red value matrix
+    :param v: 8 bit nir value matrix
+    :param table: table as returned by ndvi_table
+    """
+
+    index = r.astype(np.uint16)
+    index <<= 8
+    index |= v
+    np.take(table.ravel(), index, out=ndvi)
+
+
 class NDVI(object):
     def __init__(self, *args, camera, **kwargs):
         """
@@ -34,190 +108,347 @@ class NDVI(object):
 
         self.camera = camera
 
+        # the other vegetation indices, computed from the same planes as the ndvi (see core/indices.py)
+        self.indices = None
+        if self.camera.settings.indices:
+            self.indices = INDEX_ENGINE(indices = self.camera.settings.indices, lut = self.camera.settings.ndvi_lut)
+            if self.indices.uses_white and LC.WHITE not in self.camera.light_channels:
+                d_print("Vegetation indices {} need the white channel, which this camera does not have, not computing them", 3, self.indices.names)
+                self.indices = None
+        self.uses_white = self.indices is not None and self.indices.uses_white
+
+        # the nir frame is shifted onto the red frame, unless registration is disabled in the settings, as is the white
+        # frame if the indices need it (with its own shift, it is captured at a different time)
+        self.registration = None
+        self.quick_registration = None
+        self.white_registration = None
+        self.quick_white_registration = None
+        if self.camera.settings.registration is not None:
+            self.registration = REGISTRATION(**self.camera.settings.registration)
+            if self.uses_white:
+                self.white_registration = REGISTRATION(**self.camera.settings.registration)
+
+            # the quick captures are registered separately, with the pixel distances scaled down and fewer pyramid levels
+            if self.camera.quick_resolution is not None:
+                factor = self.camera.settings.quick_ndvi
+                options = dict(self.camera.settings.registration)
+                options["levels"] = max(0, options.get("levels", 2) - int(np.log2(factor)))
+                options["max_shift"] = options.get("max_shift", 40)/factor
+                options["tolerance"] = options.get("tolerance", 0.5)/factor
+                self.quick_registration = REGISTRATION(**options)
+                if self.uses_white:
+                    self.quick_white_registration = REGISTRATION(**options)
+
+        # previous result to reuse, set by ndvi_matrix() when the captures did not change
+        self.reused = None
+
+        # index matrices of the last ndvi matrix by name, set by ndvi_matrix()
+        self.index_maps = None
+
+        # the lookup table of the last capture, rebuilt only when the scale factors change
+        self.table = None
+        self.table_key = None
+
+
+    def process(self, channel: LC, rgb, gain, ff, debug = True):
+        """
+        Internal function that prepares a capture of the red or nir channel: crops it, extracts the value matrix and determines the scale factors that compare it to the saved values from the calibration. Also writes the debug images of the channel to cam/tmp. The red and nir paths are independent, so they can run concurrently.
+
+        :param channel: LC.RED or LC.NIR
+        :param rgb: 8 bit rgb array as returned by capture
+        :param gain: gain as returned by capture
+        :param ff: flatfield calibration at the resolution of the capture (see camera.calibration())
+        :param debug: whether to write the debug images
+        :return: (8 bit value matrix, gain correction, flatfield value)
+        """
+
+        with tracer.span("processing", channel=channel):
+            # crop the sensor readout
+            rgb = self.camera.crop_frame(rgb)
+            if channel == LC.RED:
+                v = rgb[:,:,0]
+            else:
+                hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
+                v = hsv[:,:,2]
+
+            # flatfield mask
+            factor = 0.8*ff["gain"][channel]/gain
+            mask = ff["value"][channel]
+
+        if not debug:
+            return (v, factor, mask)
+
+        # write debug images to file using the encoder, the normalized reflectance is looked up per value
+        path_to_img = "{}/cam/tmp/{}_raw".format(self.camera.working_directory, channel)
+        self.camera.encoder.write(path_to_img, v.astype(np.uint8), "jpg")
+
+        levels = reflectance(np.arange(256), factor, mask)
+        path_to_img = "{}/cam/tmp/{}".format(self.camera.working_directory, channel)
+        self.camera.encoder.write(path_to_img, np.uint8(255*levels/levels[np.amax(v)])[v], "jpg")
 
-    def ndvi_matrix(self):
+        return (v, factor, mask)
+
+
+    def ndvi_matrix(self, resolution = None, change_key = None):
         """
-        Internal function that makes the ndvi matrix from a red and a nir image. Pixel values are compared to the saved values from the calibration earlier in the process.
+        Internal function that makes the ndvi matrix from a red and a nir image. The red image is processed while the nir image is being captured, and the ndvi itself is computed in row chunks, all in the post-processing pool of the camera. Before that, the nir frame is registered onto the red frame. With settings.ndvi_lut, the ndvi is looked up in a table of all 8 bit red and nir combinations instead of being computed per pixel (with the same result). The vegetation indices of settings.indices are computed from the same planes (and a white image if they need it) and kept in self.index_maps.
 
+        :param resolution: capture resolution, None for the full readout resolution (with debug images)
+        :param change_key: key of the result in the change detector of the camera, if the captures did not change since the previous result of that key, self.reused holds it and None is returned
         :return: ndvi matrix
         """
 
-        # capture images in a square rgb array
-        rgb_r, gain_r = self.camera.capture(LC.RED)
-        rgb_nir, gain_nir = self.camera.capture(LC.NIR)
+        self.reused = None
+        self.index_maps = None
 
-        # if an error is caught upstream, send it downstream
-        if rgb_r is None or rgb_nir is None:
+        ff = self.camera.calibration(resolution)
+        debug = resolution is None
+        registration = self.registration if resolution is None else self.quick_registration
+        white_registration = self.white_registration if resolution is None else self.quick_white_registration
+
+        # capture images in a square rgb array, processing the red one during the nir capture
+        rgb_r, gain_r = self.camera.capture(LC.RED, resolution)
+        if rgb_r is None:
             return None
+        red = self.camera.pool.submit(self.process, LC.RED, rgb_r, gain_r, ff, debug)
 
-        # crop the sensor readout
-        rgb_r = rgb_r[self.camera.settings.crop["y_min"]:self.camera.settings.crop["y_max"], self.camera.settings.crop["x_min"]:self.camera.settings.crop["x_max"], :]
-        r = rgb_r[:,:,0]
+        rgb_nir, gain_nir = self.camera.capture(LC.NIR, resolution)
+        if rgb_nir is None:
+            # if an error is caught upstream, send it downstream
+            red.result()
+            return None
+        frames = [(rgb_r, gain_r), (rgb_nir, gain_nir)]
+
+        # the white image is only needed for the indices that use it
+        if self.uses_white:
+            rgb_w, gain_w = self.camera.capture(LC.WHITE, resolution)
+            if rgb_w is None:
+                red.result()
+                return None
+            frames.append((rgb_w, gain_w))
+
+        # stop here if nothing changed since the previous result
+        if change_key is not None and self.camera.change is not None:
+            with tracer.span("change detection"):
+                self.reused = self.camera.change.check(change_key, frames)
+            if self.reused is not None:
+                red.result()
+                return None
+        nir = self.camera.pool.submit(self.process, LC.NIR, rgb_nir, gain_nir, ff, debug)
+
+        r, factor_r, mask_r = red.result()
+        v, factor_nir, mask_nir = nir.result()
+
+        # line the nir frame up with the red frame, the plants may have moved in between
+        if registration is not None:
+            with tracer.span("registration"):
+                v = registration.align(r, v)
+        if self.uses_white:
+            w = self.camera.crop_frame(rgb_w)
+            if white_registration is not None:
+                with tracer.span("registration", channel=LC.WHITE):
+                    w = white_registration.align(r, w[:,:,0], apply_to = w)
 
-        # apply flatfield mask
-        mask = self.camera.config["ff"]["value"]["red"]
-        Rr = 0.8*self.camera.config["ff"]["gain"]["red"]/gain_r*np.divide(r, mask)
+        # finally calculate ndvi (with some failsafes)
+        with tracer.span("ndvi"):
+            if self.camera.settings.ndvi_lut:
+                key = (factor_r, mask_r, factor_nir, mask_nir)
+                if key != self.table_key:
+                    self.table = ndvi_table(reflectance(np.arange(256), factor_r, mask_r), reflectance(np.arange(256), factor_nir, mask_nir))
+                    self.table_key = key
+                ndvi = self.camera.pool.rows(functools.partial(ndvi_lookup_rows, table=self.table), np.empty(r.shape, dtype=self.table.dtype), r, v)
+            else:
+                Rr = reflectance(r, factor_r, mask_r)
+                Rnir = reflectance(v, factor_nir, mask_nir)
+                ndvi = self.camera.pool.rows(ndvi_rows, np.empty_like(Rr), Rr, Rnir)
+            ndvi[0, 0] = 1.0
+
+        # the other vegetation indices, in one pass over the same planes
+        if self.indices is not None:
+            with tracer.span("indices"):
+                planes = dict(R = r, NIR = v)
+                levels = dict(R = reflectance(np.arange(256), factor_r, mask_r), NIR = reflectance(np.arange(256), factor_nir, mask_nir))
+                if self.uses_white:
+                    for i, plane in enumerate(WHITE_PLANES):
+                        planes[plane] = w[:,:,i]
+                        levels[plane] = np.arange(256)/(255*gain_w)
+                self.index_maps = self.indices.compute(self.camera.pool, planes, levels)
 
-        # crop the sensor readout
-        rgb_nir = rgb_nir[self.camera.settings.crop["y_min"]:self.camera.settings.crop["y_max"], self.camera.settings.crop["x_min"]:self.camera.settings.crop["x_max"], :]
-        hsv = cv2.cvtColor(rgb_nir, cv2.COLOR_RGB2HSV)
-        v = hsv[:,:,2]
+        return ndvi
 
-        # apply flatfield mask
-        mask = self.camera.config["ff"]["value"]["nir"]
-        Rnir = 0.8*self.camera.config["ff"]["gain"]["nir"]/gain_nir*np.divide(v, mask)
 
-        # write image to file using imageio's imwrite
-        path_to_img = "{}/cam/tmp/{}.jpg".format(self.camera.working_directory, "red_raw")
-        imwrite(path_to_img, r.astype(np.uint8))
+    def add_indices(self, res, plant):
+        """
+        Add the mean of every vegetation index over the plant to the values of a result, and free the index matrices.
 
-        path_to_img = "{}/cam/tmp/{}.jpg".format(self.camera.working_directory, "nir_raw")
-        imwrite(path_to_img, v.astype(np.uint8))
+        :param res: result dict
+        :param plant: boolean matrix of the plant pixels (the ones the mean ndvi is taken over), None if there are too few
+        """
 
-        #d_print("\tred max: " + str(np.amax(Rr)), 1)
-        #d_print("\tnir max: " + str(np.amax(Rnir)), 1)
+        if self.index_maps is None:
+            return
 
-        #d_print("ground plane red avg: {}".format(np.mean(Rr[self.camera.settings.ground_plane["y_min"]:self.camera.settings.ground_plane["y_max"], self.camera.settings.ground_plane["x_min"]:self.camera.settings.ground_plane["x_max"]])), 1)
-        #d_print("ground plane nir avg: {}".format(np.mean(Rnir[self.camera.settings.ground_plane["y_min"]:self.camera.settings.ground_plane["y_max"], self.camera.settings.ground_plane["x_min"]:self.camera.settings.ground_plane["x_max"]])), 1)
-        #d_print("nir gain: {} ff value: {} ff gain: {}".format(gain_nir, self.camera.config["ff"]["value"]["nir"], self.camera.config["ff"]["gain"]["nir"]), 1)
-        #d_print("red gain: {} ff value: {} ff gain: {}".format(gain_r, self.camera.config["ff"]["value"]["red"], self.camera.config["ff"]["gain"]["red"]), 1)
+        for name, matrix in self.index_maps.items():
+            res["value"].append(float(np.mean(matrix[plant])) if plant is not None and np.any(plant) else 0.0)
+            res["value_kind"].append(name)
+            res["value_error"].append(0.0)
+        self.index_maps = None
 
-        path_to_img = "{}/cam/tmp/{}.jpg".format(self.camera.working_directory, "red")
-        imwrite(path_to_img, np.uint8(255*Rr/np.amax(Rr)))
 
-        path_to_img = "{}/cam/tmp/{}.jpg".format(self.camera.working_directory, "nir")
-        imwrite(path_to_img, np.uint8(255*Rnir/np.amax(Rnir)))
+    def add_quality(self, res):
+        """
+        Add the quality metrics of the red and the nir capture to a result, if the camera has a quality gate.
 
-        # finally calculate ndvi (with some failsafes)
-        Rr[Rnir < 0.1] = 0
-        Rnir[Rnir < 0.1] = 0
-        num = Rnir - Rr
-        den = Rnir + Rr
-        num[np.logical_and(den < 0.05, den > -0.05)] = 0.0
-        den[den < 0.05] = 1.0
-        ndvi = np.divide(num, den)
-        ndvi[0, 0] = 1.0
+        :param res: result dict
+        """
 
-        return ndvi
+        if self.camera.gate is not None:
+            res["quality"] = [self.camera.quality.get(LC.RED), self.camera.quality.get(LC.NIR)]
 
 
     def ndvi_photo(self):
         """
-        Make a photo in the nir and the red spectrum and overlay to obtain ndvi.
+        Make a photo in the nir and the red spectrum and overlay to obtain ndvi. With a change detector, the previous images and value are returned instead if nothing changed since they were made.
 
         :return: (path to the ndvi image, average ndvi value for >0.25 (iff the #pixels is larger than 2 percent of the total))
         """
 
         # get the ndvi matrix
-        ndvi_matrix = self.ndvi_matrix()
+        ndvi_matrix = self.ndvi_matrix(change_key = "ndvi_photo")
+        if self.reused is not None:
+            self.add_quality(self.reused)
+            return self.reused
 
         # catch error
         if ndvi_matrix is None:
-            res = dict()
-            res["contains_photo"] = False
-            res["contains_value"] = False
-            res["encountered_error"] = True
-            res["timestamp"] = curr_time
-
-            return res
+            return self.camera.error_result(self.camera.capture_error)
 
         ndvi_matrix = np.clip(ndvi_matrix, -1.0, 1.0)
-        if np.count_nonzero(ndvi_matrix > 0.25) > 0.02*np.size(ndvi_matrix):
-            ndvi = np.mean(ndvi_matrix[ndvi_matrix > 0.25])
+        plant = ndvi_matrix > 0.25
+        if np.count_nonzero(plant) > 0.02*np.size(ndvi_matrix):
+            ndvi = np.mean(ndvi_matrix[plant])
         else:
             ndvi = 0
-
-        rescaled = np.uint8(np.round(127.5*(ndvi_matrix + 1.0)))
-
-        ndvi_plot = np.copy(ndvi_matrix)
+            plant = None
+
+        # hand the plot matrix to the plotter through shared memory instead of pickling it
+        ctx = mp.get_context("spawn")
+        ring = FRAME_RING(slots = 1, shape = ndvi_matrix.shape, dtype = np.float64, condition = ctx.Condition())
+        slot = ring.acquire_write()
+        ndvi_plot = ring.view(slot)
+        np.copyto(ndvi_plot, ndvi_matrix)
         ndvi_plot[ndvi_plot<0.25] = np.nan
+        ring.commit(slot)
+        del ndvi_plot
 
-        # write images to file using imageio's imwrite and matplotlibs savefig
+        # write images to file using the encoder, the plot is rendered by matplotlib first
         d_print("Writing to file...", 1)
         curr_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
-        # set multiprocessing to spawn (so NOT fork)
-        try:
-            mp.set_start_method('spawn')
-        except RuntimeError:
-            pass
-
-        # write the matplotlib part in a separate process so no memory leaks
-        path_to_img_2 = "{}/cam/img/{}{}_{}.jpg".format(self.camera.working_directory, "ndvi", 2, curr_time)
-        p = mp.Process(target=plotter, args=(ndvi_plot, path_to_img_2,))
+        # write the matplotlib part in a separate (spawned, so NOT forked) process so no memory leaks
+        path_to_img_2 = "{}/cam/img/{}{}_{}".format(self.camera.working_directory, "ndvi", 2, curr_time)
+        q = ctx.Queue()
+        p = ctx.Process(target=plotter, args=(ring, slot, path_to_img_2, self.camera.encoder, q,))
         try:
-            p.start()
-            p.join()
-        except OSError:
-            d_print("Could not start child process, out of memory", 3)
+            with tracer.span("worker startup", target="plotter"):
+                p.start()
+            with tracer.span("plot"):
+                info_2 = self.camera.watchdog.get(q, "plot", p)
+                self.camera.watchdog.join(p, "plot")
+        except (OSError, STAGE_TIMEOUT) as e:
+            d_print("Plotting failed: {}", 3, e)
+            ring.unlink()
 
-            res = dict()
-            res["contains_photo"] = False
-            res["contains_value"] = False
-            res["encountered_error"] = True
-            res["timestamp"] = curr_time
+            return self.camera.error_result("plotting failed: {}".format(e))
 
-            return res
+        ring.unlink()
 
-        path_to_img_1 = "{}/cam/img/{}{}_{}.tif".format(self.camera.working_directory, "ndvi", 1, curr_time)
-        imwrite(path_to_img_1, rescaled)
+        path_to_img_1 = "{}/cam/img/{}{}_{}".format(self.camera.working_directory, "ndvi", 1, curr_time)
+        info_1 = self.camera.encoder.write_ndvi(path_to_img_1, ndvi_matrix)
 
         res = dict()
         res["contains_photo"] = True
         res["contains_value"] = True
         res["encountered_error"] = False
         res["timestamp"] = curr_time
-        res["photo_path"] = [path_to_img_1, path_to_img_2]
+        add_encode_info(res, [info_1, info_2])
         res["photo_kind"] = ["raw NDVI", "processed NDVI"]
         res["value"] = [ndvi]
         res["value_kind"] = ["NDVI"]
         res["value_error"] = [0.0]
+        self.add_indices(res, plant)
+        self.add_quality(res)
+
+        if self.camera.change is not None:
+            self.camera.change.store("ndvi_photo", res)
 
         return res
 
 
     def ndvi(self):
         """
-        Make a photo in the nir and the red spectrum and overlay to obtain ndvi.
+        Make a photo in the nir and the red spectrum and overlay to obtain ndvi. Only the mean is returned, so the photos are captured at the quick resolution (see settings.quick_ndvi) if the camera was calibrated at that resolution. With a change detector, the previous value is returned instead if nothing changed.
 
         :return: average ndvi value
         """
 
+        resolution = self.camera.quick_resolution
+        if resolution is not None and self.camera.calibration(resolution) is None:
+            d_print("Camera is not calibrated at the quick ndvi resolution {}x{}, using the full resolution (calibrate again to use it)", 2, *resolution)
+            resolution = None
+
         # get the ndvi matrix
-        ndvi_matrix = self.ndvi_matrix()
+        with tracer.span("ndvi matrix", resolution=resolution):
+            ndvi_matrix = self.ndvi_matrix(resolution, change_key = "ndvi")
+        if self.reused is not None:
+            self.add_quality(self.reused)
+            return self.reused
 
         # catch error
         if ndvi_matrix is None:
-            res = dict()
-            res["contains_photo"] = False
-            res["contains_value"] = False
-            res["encountered_error"] = True
-            res["timestamp"] = curr_time
+            return self.camera.error_result(self.camera.capture_error)
 
-            return res
-
-        ndvi = np.mean(ndvi_matrix[ndvi_matrix > 0.2])
+        plant = ndvi_matrix > 0.2
+        ndvi = np.mean(ndvi_matrix[plant])
 
         res = dict()
         res["contains_photo"] = False
         res["contains_value"] = True
         res["encountered_error"] = False
-        res["timestamp"] = curr_time
+        res["timestamp"] = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         res["value"] = [ndvi]
         res["value_kind"] = ["NDVI"]
         res["value_error"] = [0.0]
+        self.add_indices(res, plant)
+        self.add_quality(res)
+
+        if self.camera.change is not None:
+            self.camera.change.store("ndvi", res)
 
         return res
 
-def plotter(ndvi, path_to_img):
+def plotter(ring, slot, path_to_img, encoder, q):
+    # the plot matrix is read in place from the ring the parent wrote it into
+    ring.acquire_read(slot)
+    ndvi = ring.view(slot)
+
     # set the right colormap
     cmap = plt.get_cmap("nipy_spectral_r")
     Polariks_cmap = truncate_colormap(cmap, 0, 0.6)
 
-    plt.figure(figsize=(14,10))
+    fig = plt.figure(figsize=(14,10))
     plt.imshow(ndvi, cmap=Polariks_cmap)
     plt.colorbar()
     plt.title("NDVI")
-    plt.savefig(path_to_img)
+
+    # render the figure to an array and let the encoder write it, so the encoding is measured as well
+    fig.canvas.draw()
+    rgb = cv2.cvtColor(np.asarray(fig.canvas.buffer_rgba()), cv2.COLOR_RGBA2RGB)
+    q.put(encoder.write_photo(path_to_img, rgb))
+
+    plt.close(fig)
+    del fig, ndvi
+    ring.release(slot)
+    ring.close()
 
     time.sleep(2)
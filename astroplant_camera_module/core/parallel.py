@@ -0,0 +1,100 @@
+"""
+Implementation of the post-processing pool.
+Runs independent post-processing work (for example the red and the nir path of an ndvi measurement) concurrently in a bounded number of threads. OpenCV and most of numpy release the GIL, so threads are enough to use multiple cores.
+"""
+
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+# marks the threads of the pools, so work submitted from a worker is run inline instead of waiting for a free worker
+_local = threading.local()
+
+def _mark_worker():
+    _local.worker = True
+
+
+class PARALLEL(object):
+    def __init__(self, *args, max_workers = 2, chunk_rows = 0, **kwargs):
+        """
+        Initialize a post-processing pool. The threads are started on first use.
+
+        :param max_workers: maximum number of threads, keep this below the number of cores so capturing isn't disturbed (1 runs everything inline)
+        :param chunk_rows: number of rows per chunk when an array operation is split over the threads (0 to never split)
+        """
+
+        self.max_workers = max_workers
+        self.chunk_rows = chunk_rows
+        self.executor = None
+        self.lock = threading.Lock()
+
+
+    def inline(self):
+        """
+        Whether work should be run in the calling thread: if the pool is disabled, or if the caller is one of the workers (waiting for other workers from a worker could deadlock).
+
+        :return: bool
+        """
+
+        return self.max_workers <= 1 or getattr(_local, "worker", False)
+
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run a function in the pool.
+
+        :param fn: function to run
+        :return: concurrent.futures.Future with the result of the function
+        """
+
+        if self.inline():
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers = self.max_workers, thread_name_prefix = "postprocessing", initializer = _mark_worker)
+
+        return self.executor.submit(fn, *args, **kwargs)
+
+
+    def rows(self, fn, out, *arrays):
+        """
+        Apply an operation to row chunks of arrays concurrently. The operation is called as fn(out_chunk, *array_chunks) and has to write its result into out_chunk (the chunks are views, so in place changes to the input arrays are kept as well).
+
+        :param fn: operation on one chunk
+        :param out: output array, chunked along the first axis like the inputs
+        :param arrays: input arrays with the same number of rows as out
+        :return: out
+        """
+
+        n = out.shape[0]
+        if not self.chunk_rows or n <= self.chunk_rows or self.inline():
+            fn(out, *arrays)
+            return out
+
+        futures = []
+        for start in range(0, n, self.chunk_rows):
+            stop = min(start + self.chunk_rows, n)
+            futures.append(self.submit(fn, out[start:stop], *[a[start:stop] for a in arrays]))
+
+        for future in futures:
+            future.result()
+
+        return out
+
+
+    def shutdown(self):
+        """
+        Stop the threads of the pool, they are started again when needed.
+        """
+
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
@@ -0,0 +1,351 @@
+"""
+Implementation of the result publisher.
+Sends the results of the camera (and references to the files they point to) to a sink, such as a local unix socket or an http endpoint, in batches from a background thread. Records that can't be sent are kept in a spool directory on disk, so the camera never waits for the upstream.
+"""
+
+import time
+import json
+import os
+import queue
+import random
+import socket
+import threading
+import urllib.request
+import uuid
+
+from astroplant_camera_module.misc.debug_print import d_print
+
+
+def to_json(obj):
+    """
+    Convert the values json can't handle by itself (numpy scalars and arrays, mostly).
+
+    :param obj: value
+    :return: json serializable value
+    """
+
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+
+    return str(obj)
+
+
+def encode(records):
+    """
+    Encode records as json.
+
+    :param records: list of records
+    :return: bytes
+    """
+
+    return json.dumps(records, default=to_json).encode()
+
+
+class SPOOL_SINK(object):
+    def __init__(self, *args, directory, **kwargs):
+        """
+        Sink that writes every batch to a json file in a directory, for example a directory that is synchronized by another program.
+
+        :param directory: directory the batches are written to
+        """
+
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def send(self, records):
+        tmp_file = "{}/.{}.tmp".format(self.directory, time.time_ns())
+        with open(tmp_file, 'wb') as f:
+            f.write(encode(records))
+        os.replace(tmp_file, "{}/batch-{}.json".format(self.directory, time.time_ns()))
+
+
+class UNIX_SOCKET_SINK(object):
+    def __init__(self, *args, path, timeout = 5.0, **kwargs):
+        """
+        Sink that sends every batch to a local unix socket, as one json record per line.
+
+        :param path: path of the socket
+        :param timeout: timeout of connecting and sending in seconds
+        """
+
+        self.path = path
+        self.timeout = timeout
+
+
+    def send(self, records):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(self.timeout)
+            s.connect(self.path)
+            s.sendall(b"".join(encode(record) + b"\n" for record in records))
+
+
+class HTTP_SINK(object):
+    def __init__(self, *args, url, timeout = 10.0, headers = None, **kwargs):
+        """
+        Sink that posts every batch to an http endpoint as a json object {"records": [...]}. Any status other than 2xx counts as a failure.
+
+        :param url: url of the endpoint
+        :param timeout: timeout of the request in seconds
+        :param headers: dict with extra headers, for example for authentication
+        """
+
+        self.url = url
+        self.timeout = timeout
+        self.headers = {"Content-Type": "application/json"}
+        if headers is not None:
+            self.headers.update(headers)
+
+
+    def send(self, records):
+        data = json.dumps({"records": records}, default=to_json).encode()
+        request = urllib.request.Request(self.url, data=data, headers=self.headers, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class PUBLISHER(object):
+    def __init__(self, *args, sink, working_directory, batch_size = 32, max_delay = 2.0, max_queue = 256, min_backoff = 1.0, max_backoff = 300.0, max_spool_bytes = 64*1024*1024, **kwargs):
+        """
+        Initialize a publisher. Records are queued by publish() and sent by a background thread (see start()) in batches of at most batch_size records, at most max_delay seconds after they were published. If the sink fails, the batch is written to the spool in cam/res/outbox and sending is retried with exponential backoff. The spool is sent (oldest first) before any new record, and survives restarts. Records carry a unique id, since a batch may be delivered more than once.
+
+        :param sink: object with a send(records) method that raises an exception on failure (SPOOL_SINK, UNIX_SOCKET_SINK, HTTP_SINK or your own)
+        :param working_directory: working directory of the camera
+        :param batch_size: maximum number of records per batch
+        :param max_delay: maximum number of seconds a record waits for its batch to fill up
+        :param max_queue: maximum number of records kept in memory, records published when the queue is full go to the spool directly
+        :param min_backoff: seconds to wait after the first failure
+        :param max_backoff: maximum number of seconds to wait between retries
+        :param max_spool_bytes: maximum size of the spool, the oldest batches are dropped beyond it
+        """
+
+        self.sink = sink
+        self.spool_directory = "{}/cam/res/outbox".format(working_directory)
+        os.makedirs(self.spool_directory, exist_ok=True)
+
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_spool_bytes = max_spool_bytes
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.RLock()
+        self.seq = 0
+
+        # records are numbered in the order they are published, continuing from the numbers of earlier runs, so spooled
+        # batches sort by their first record
+        self.epoch = time.time_ns()
+        self.published = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.stats = dict()
+        self.stats["published"] = 0
+        self.stats["sent"] = 0
+        self.stats["spooled"] = 0
+        self.stats["dropped"] = 0
+        self.stats["failures"] = 0
+
+
+    def publish(self, record):
+        """
+        Queue a record for sending. Never blocks on the sink: if the queue is full, the queued records and this one are written to the spool instead, in order.
+
+        :param record: json serializable dict
+        """
+
+        record.setdefault("id", uuid.uuid4().hex)
+
+        with self.lock:
+            self.published += 1
+            record.setdefault("seq", self.epoch + self.published)
+            self.stats["published"] += 1
+
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                # the records that are still queued are older, so they go to the spool ahead of this one
+                batch = []
+                while True:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                batch.append(record)
+                self.spool(batch)
+
+
+    def publish_result(self, res, command = None, job = None):
+        """
+        Queue a result as returned by camera.do(), together with references to the files it points to. Anything that is not a result dict (camera.do() returns an empty string for commands it refuses) is not published.
+
+        :param res: result dict
+        :param command: command that produced the result
+        :param job: name of the job that produced the result, if any
+        """
+
+        if not isinstance(res, dict):
+            d_print("Not publishing the result of {}, it is not a result dict: {!r}", 2, command, res)
+            return
+
+        files = list(res.get("photo_path", []))
+        for paths in res.get("pyramid_path", []):
+            files.extend(paths)
+
+        record = dict()
+        record["timestamp"] = time.time()
+        record["command"] = command
+        record["job"] = job
+        record["result"] = res
+        record["files"] = files
+
+        self.publish(record)
+
+
+    def spool_files(self):
+        """
+        List the batches in the spool, oldest first.
+
+        :return: list of file names
+        """
+
+        return sorted(name for name in os.listdir(self.spool_directory) if name.endswith(".json"))
+
+
+    def spool(self, records):
+        """
+        Write a batch to the spool (atomically), dropping the oldest batches if the spool grows beyond its maximum size. Batches are named after the number of their first record, so they are sent in the order they were published.
+
+        :param records: list of records
+        """
+
+        with self.lock:
+            self.seq += 1
+            name = "{:020d}-{:06d}.json".format(records[0].get("seq", time.time_ns()), self.seq % 1000000)
+            tmp_file = "{}/.{}.tmp".format(self.spool_directory, name)
+            with open(tmp_file, 'wb') as f:
+                f.write(encode(records))
+            os.replace(tmp_file, "{}/{}".format(self.spool_directory, name))
+            self.stats["spooled"] += len(records)
+
+            names = self.spool_files()
+            sizes = [os.path.getsize("{}/{}".format(self.spool_directory, n)) for n in names]
+            total = sum(sizes)
+            for n, size in zip(names, sizes):
+                if total <= self.max_spool_bytes:
+                    break
+                os.remove("{}/{}".format(self.spool_directory, n))
+                total -= size
+                self.stats["dropped"] += 1
+                d_print("Publisher spool is full, dropped batch {}", 3, n)
+
+
+    def drain(self):
+        """
+        Send the batches in the spool, oldest first. Raises the exception of the sink if sending fails. Batches that can't be read are moved aside (renamed to .bad), so they don't keep the spool from emptying.
+        """
+
+        for name in self.spool_files():
+            path = "{}/{}".format(self.spool_directory, name)
+            try:
+                with open(path, 'rb') as f:
+                    records = json.loads(f.read().decode())
+            except FileNotFoundError:
+                # dropped because the spool was full
+                continue
+            except (EnvironmentError, ValueError) as e:
+                d_print("Publisher can't read spooled batch {}, moving it aside: {}", 3, name, e)
+                try:
+                    os.replace(path, path + ".bad")
+                except EnvironmentError:
+                    pass
+                continue
+
+            self.sink.send(records)
+            os.remove(path)
+            self.stats["sent"] += len(records)
+
+
+    def collect(self):
+        """
+        Collect a batch from the queue, waiting at most max_delay seconds for it to fill up.
+
+        :return: list of records, possibly empty
+        """
+
+        batch = []
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+
+    def run(self):
+        """
+        Keep sending batches until stop() is called. Records that are still queued then are written to the spool.
+        """
+
+        backoff = self.min_backoff
+
+        while not self.stop_event.is_set():
+            batch = self.collect()
+
+            # keep the order: while there is a spool, new batches go behind it
+            if batch and self.spool_files():
+                self.spool(batch)
+                batch = []
+
+            try:
+                if batch:
+                    self.sink.send(batch)
+                    self.stats["sent"] += len(batch)
+                    batch = []
+                self.drain()
+                backoff = self.min_backoff
+            except Exception as e:
+                self.stats["failures"] += 1
+                d_print("Publisher could not reach the sink, retrying in {:.0f} s: {}", 2, backoff, e)
+                if batch:
+                    self.spool(batch)
+                self.stop_event.wait(random.uniform(0.5, 1.0)*backoff)
+                backoff = min(2*backoff, self.max_backoff)
+
+        # keep whatever is left for the next run
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.spool(batch)
+
+
+    def start(self):
+        """
+        Start sending in a background thread.
+        """
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        Stop the background thread, spooling the records that were not sent yet.
+        """
+
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
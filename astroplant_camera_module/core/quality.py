@@ -0,0 +1,105 @@
+"""
+Implementation of the quality gate.
+Checks every capture right after it is decoded with a few cheap metrics on a subsampled grid, so saturated, black or blurred frames are retried instead of being measured.
+"""
+
+import cv2
+
+import numpy as np
+
+from astroplant_camera_module.typedef import LC
+
+
+class QUALITY_GATE(object):
+    def __init__(self, *args, camera, step = 4, max_saturation = 0.01, black_level = 0, max_black = 0.25, reflectance_range = (0.02, 1.25), min_sharpness = None, retries = 2, budget = 15.0, **kwargs):
+        """
+        Initialize a quality gate. Captures that fail one of the checks are retried at most the given number of times, as long as another attempt (taking as long as the last one) fits in the latency budget. With the exposure planner, every retry already uses the corrected exposure. The checks only apply to a calibrated camera, the metrics are always computed.
+
+        :param camera: link to the camera object controlling these subroutines
+        :param step: the metrics are computed on every step-th pixel in both directions
+        :param max_saturation: maximum fraction of pixels of the bright frame with a saturated subpixel
+        :param black_level: pixels at or below this value (after dark frame subtraction) count as clipped black
+        :param max_black: maximum fraction of clipped black pixels
+        :param reflectance_range: (min, max) mean reflectance of the ground plane relative to the calibration, only checked for the red and nir channel
+        :param min_sharpness: minimum variance of the laplacian of the ground plane, this depends on the scene so it is only reported by default (None)
+        :param retries: maximum number of retries of a failing capture
+        :param budget: maximum number of seconds spent on a capture, including retries
+        """
+
+        self.camera = camera
+
+        self.step = step
+        self.max_saturation = max_saturation
+        self.black_level = black_level
+        self.max_black = max_black
+        self.reflectance_range = reflectance_range
+        self.min_sharpness = min_sharpness
+        self.retries = retries
+        self.budget = budget
+
+
+    def metrics(self, channel: LC, bright, rgb, gain):
+        """
+        Compute the quality metrics of a capture.
+
+        :param channel: channel of light in which the photo was taken
+        :param bright: 8 bit rgb array of the bright frame (before dark frame subtraction)
+        :param rgb: 8 bit rgb array after dark frame subtraction
+        :param gain: effective gain of the capture
+        :return: dict with the saturated and clipped black fractions, the mean of the ground plane, its reflectance relative to the calibration (None if not calibrated for the channel) and the sharpness
+        """
+
+        # frames captured at a lower resolution are subsampled less
+        factor = self.camera.frame_factor(rgb)
+        step = max(1, self.step//factor)
+
+        # the brightest subpixel decides whether a pixel clips
+        sub = bright[::step, ::step]
+        peak = np.maximum(np.maximum(sub[:, :, 0], sub[:, :, 1]), sub[:, :, 2])
+
+        # the value the measurements are based on
+        sub = rgb[::step, ::step]
+        if channel == LC.RED:
+            v = sub[:, :, 0]
+        else:
+            v = np.maximum(np.maximum(sub[:, :, 0], sub[:, :, 1]), sub[:, :, 2])
+
+        # the ground plane in the coordinates of the captured frame
+        x_min, y_min, x_max, y_max = self.camera.ground_plane_roi(factor)
+        ground = v[y_min//step:y_max//step, x_min//step:x_max//step]
+
+        metrics = dict()
+        metrics["saturation"] = float(np.count_nonzero(peak == 255)/peak.size)
+        metrics["black"] = float(np.count_nonzero(v <= self.black_level)/v.size)
+        metrics["mean"] = float(ground.mean())
+
+        # the same normalization as the ndvi: the flatfield reflects 0.8 at the calibration gain of this resolution
+        metrics["reflectance"] = None
+        ff = self.camera.calibration((rgb.shape[1], rgb.shape[0])) or dict()
+        if channel in ff.get("value", dict()) and channel in ff.get("gain", dict()):
+            metrics["reflectance"] = float(0.8*metrics["mean"]*ff["gain"][channel]/(gain*max(ff["value"][channel], 1.0)))
+
+        metrics["sharpness"] = float(cv2.Laplacian(ground, cv2.CV_32F).var())
+
+        return metrics
+
+
+    def check(self, metrics):
+        """
+        Check the metrics of a capture against the limits.
+
+        :param metrics: dict as returned by metrics()
+        :return: list of reasons the capture failed, empty if it passed
+        """
+
+        reasons = []
+        if metrics["saturation"] > self.max_saturation:
+            reasons.append("saturated")
+        if metrics["black"] > self.max_black:
+            reasons.append("black")
+        if metrics["reflectance"] is not None and not self.reflectance_range[0] <= metrics["reflectance"] <= self.reflectance_range[1]:
+            reasons.append("ground plane")
+        if self.min_sharpness is not None and metrics["sharpness"] < self.min_sharpness:
+            reasons.append("blurred")
+
+        return reasons
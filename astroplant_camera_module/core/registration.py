@@ -0,0 +1,131 @@
+"""
+Implementation of the red/nir frame registration.
+The red and nir frames are captured a few seconds apart and plants move with the airflow in the kit, so the nir frame is shifted onto the red frame before the ndvi is computed.
+"""
+
+import cv2
+
+import numpy as np
+
+from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.misc.trace import tracer
+
+
+class REGISTRATION(object):
+    def __init__(self, *args, levels = 2, min_response = 0.05, max_shift = 40, tolerance = 0.5, stable_count = 3, reuse = 10, **kwargs):
+        """
+        Initialize the registration stage. The shift between the frames is estimated with phase correlation on a downsampled pyramid level, which keeps it cheap, and applied with subpixel accuracy to the full resolution frame. Once a number of consecutive estimates agree, the shift is considered stable and reused for a while without estimating it.
+
+        :param levels: number of times the frames are halved before the phase correlation
+        :param min_response: estimates with a lower phase correlation peak are considered unreliable and not used
+        :param max_shift: estimates of more pixels (at full resolution) are considered unreliable and not used
+        :param tolerance: estimates that differ less than this many pixels from the previous one agree with it
+        :param stable_count: number of consecutive agreeing estimates after which the shift is stable
+        :param reuse: number of frame pairs a stable shift is reused for before it is estimated again
+        """
+
+        self.levels = levels
+        self.min_response = min_response
+        self.max_shift = max_shift
+        self.tolerance = tolerance
+        self.stable_count = stable_count
+        self.reuse = reuse
+
+        # last used shift, how many estimates agreed with it and for how many more frame pairs it is reused
+        self.shift = (0.0, 0.0)
+        self.agreed = 0
+        self.reuse_left = 0
+        self.window = None
+
+
+    def downsample(self, img):
+        """
+        Bring a frame to the pyramid level the shift is estimated on.
+
+        :param img: 8 bit single channel frame
+        :return: 32 bit float frame
+        """
+
+        img = img.astype(np.float32)
+        for i in range(self.levels):
+            img = cv2.pyrDown(img)
+
+        return img
+
+
+    def estimate(self, ref, moving):
+        """
+        Estimate the shift of a frame relative to a reference frame.
+
+        :param ref: 8 bit single channel reference frame
+        :param moving: 8 bit single channel frame of the same size
+        :return: ((dx, dy) at full resolution, peak response of the phase correlation)
+        """
+
+        ref = self.downsample(ref)
+        moving = self.downsample(moving)
+
+        # the window suppresses the edges, which would otherwise dominate the correlation
+        if self.window is None or self.window.shape != ref.shape:
+            self.window = cv2.createHanningWindow((ref.shape[1], ref.shape[0]), cv2.CV_32F)
+
+        (dx, dy), response = cv2.phaseCorrelate(ref, moving, self.window)
+        scale = 2**self.levels
+
+        return ((scale*dx, scale*dy), response)
+
+
+    def update(self, ref, moving):
+        """
+        Determine the shift to use for a frame pair, estimating it unless a stable shift can be reused.
+
+        :param ref: 8 bit single channel reference frame
+        :param moving: 8 bit single channel frame of the same size
+        :return: (dx, dy) shift of the moving frame relative to the reference frame
+        """
+
+        if self.reuse_left > 0:
+            self.reuse_left -= 1
+            return self.shift
+
+        with tracer.span("registration estimate"):
+            shift, response = self.estimate(ref, moving)
+
+        if response < self.min_response or np.hypot(*shift) > self.max_shift:
+            d_print("Registration estimate ({:.2f}, {:.2f}) with response {:.3f} is unreliable, keeping ({:.2f}, {:.2f})", 2, shift[0], shift[1], response, self.shift[0], self.shift[1])
+            self.agreed = 0
+            return self.shift
+
+        if np.hypot(shift[0] - self.shift[0], shift[1] - self.shift[1]) <= self.tolerance:
+            self.agreed += 1
+        else:
+            self.agreed = 1
+
+        if self.agreed >= self.stable_count:
+            self.reuse_left = self.reuse
+
+        d_print("Registration shift: ({:.2f}, {:.2f}) with response {:.3f}", 1, shift[0], shift[1], response)
+        self.shift = shift
+
+        return shift
+
+
+    def align(self, ref, moving, apply_to = None):
+        """
+        Shift a frame onto a reference frame.
+
+        :param ref: 8 bit single channel reference frame
+        :param moving: 8 bit single channel frame of the same size
+        :param apply_to: frame to shift instead of the moving frame, by the shift estimated from it (for example all channels of the rgb frame the moving frame is a channel of)
+        :return: moving frame (or apply_to), translated so it lines up with the reference frame
+        """
+
+        dx, dy = self.update(ref, moving)
+        if apply_to is not None:
+            moving = apply_to
+        if dx == 0.0 and dy == 0.0:
+            return moving
+
+        with tracer.span("registration warp"):
+            M = np.float32([[1, 0, -dx], [0, 1, -dy]])
+            return cv2.warpAffine(moving, M, (moving.shape[1], moving.shape[0]), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
@@ -0,0 +1,442 @@
+"""
+Implementation of the retention engine.
+Keeps cam/img and cam/tmp from growing without bound by compacting, deduplicating and deleting old captures, a little bit at a time.
+"""
+
+import bisect
+import time
+import datetime
+import hashlib
+import json
+import os
+import re
+import threading
+import cv2
+
+from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.core.encoder import ENCODER
+
+
+# file names written by the camera look like <kind>_<yyyymmdd-hhmmss>[_1-<scale>].<ext>
+NAME_PATTERN = re.compile(r"^(?P<kind>.+)_(?P<stamp>\d{8}-\d{6})(?P<level>_1-\d+)?\.(?P<ext>\w+)$")
+
+# number of bytes read at a time while hashing
+CHUNK_SIZE = 1024*1024
+
+
+class RETENTION(object):
+    def __init__(self, *args, working_directory, compact_after_days = 7, compact_levels = 1, compact_quality = 75, delete_after_days = None, max_count = None, tmp_max_age_hours = 24, io_budget = 8*1024*1024, interval = 60, **kwargs):
+        """
+        Initialize a retention engine for the image directory of a camera. Work is done in small steps that each read and write at most io_budget bytes, so it can run next to the camera without disturbing it. The captures are kept in sorted queues that are updated as files come and go, so a step only looks at the captures it acts on.
+
+        :param working_directory: working directory of the camera
+        :param compact_after_days: captures older than this are downsampled and re-encoded in place (None to disable)
+        :param compact_levels: number of times the resolution of a compacted capture is halved
+        :param compact_quality: jpeg/webp quality used when re-encoding compacted captures
+        :param delete_after_days: captures older than this are deleted (None to keep them forever)
+        :param max_count: maximum number of captures kept per kind (for example "white" or "ndvi1"), the oldest ones are deleted first (None for no limit)
+        :param tmp_max_age_hours: files in cam/tmp that were not touched for this long are deleted
+        :param io_budget: maximum number of bytes read plus written per step
+        :param interval: number of seconds between steps when running in the background
+        """
+
+        self.img_directory = "{}/cam/img".format(working_directory)
+        self.tmp_directory = "{}/cam/tmp".format(working_directory)
+        self.state_file = "{}/cam/res/retention.json".format(working_directory)
+
+        self.compact_after_days = compact_after_days
+        self.compact_levels = compact_levels
+        self.delete_after_days = delete_after_days
+        self.max_count = max_count
+        self.tmp_max_age_hours = tmp_max_age_hours
+        self.io_budget = io_budget
+        self.interval = interval
+
+        self.encoder = ENCODER(jpeg_quality = compact_quality, webp_quality = compact_quality)
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.load_state()
+
+
+    def load_state(self):
+        """
+        Load the index of known files from file. The index keeps the hash and compaction state of every capture, so nothing needs to be read twice.
+        """
+
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+        except (EnvironmentError, ValueError):
+            state = dict()
+
+        self.files = state.get("files", dict())
+        self.hashes = state.get("hashes", dict())
+        self.dir_mtime = state.get("dir_mtime", 0)
+
+        # captures per kind, oldest first, and the queues of files to hash and captures to compact, as (stamp, name)
+        self.captures = dict()
+        self.levels = dict()
+        self.unhashed = []
+        self.uncompacted = []
+        for name in self.files:
+            self.index(name)
+
+        # hash of the file that did not fit in the budget of the previous step
+        self.partial = None
+
+        self.dirty = False
+
+
+    def save_state(self):
+        """
+        Save the index of known files to file (atomically), if it changed.
+        """
+
+        if not self.dirty:
+            return
+
+        state = dict()
+        state["files"] = self.files
+        state["hashes"] = self.hashes
+        state["dir_mtime"] = self.dir_mtime
+
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_file)
+
+        self.dirty = False
+
+
+    def index(self, name):
+        """
+        Add a file of the index to the capture list and the queues it belongs in.
+
+        :param name: file name
+        """
+
+        match = NAME_PATTERN.match(name)
+        key = (match.group("stamp"), name)
+
+        if self.files[name]["sha"] is None:
+            bisect.insort(self.unhashed, key)
+
+        if match.group("level") is None:
+            bisect.insort(self.captures.setdefault(match.group("kind"), []), key)
+            if not self.files[name]["compacted"]:
+                bisect.insort(self.uncompacted, key)
+        else:
+            self.levels.setdefault("{}_{}".format(match.group("kind"), match.group("stamp")), set()).add(name)
+
+
+    def unindex(self, name):
+        """
+        Remove a file of the index from the capture list and the queues.
+
+        :param name: file name
+        """
+
+        match = NAME_PATTERN.match(name)
+        key = (match.group("stamp"), name)
+
+        for queue in [self.unhashed, self.uncompacted, self.captures.get(match.group("kind"), [])]:
+            i = bisect.bisect_left(queue, key)
+            if i < len(queue) and queue[i] == key:
+                del queue[i]
+
+        if match.group("level") is not None:
+            base = "{}_{}".format(match.group("kind"), match.group("stamp"))
+            self.levels.get(base, set()).discard(name)
+            if not self.levels.get(base, True):
+                del self.levels[base]
+
+
+    def update(self, name, sha, compacted):
+        """
+        Set the hash and compaction state of a file in the index, keeping the queues up to date.
+
+        :param name: file name
+        :param sha: hash of the contents, None if they still have to be hashed
+        :param compacted: whether the capture was compacted
+        """
+
+        if name in self.files:
+            self.unindex(name)
+        self.files[name] = dict()
+        self.files[name]["sha"] = sha
+        self.files[name]["compacted"] = compacted
+        self.index(name)
+
+        self.dirty = True
+
+
+    def refresh(self):
+        """
+        Add new files to the index and drop files that disappeared. The directory is only listed when its modification time changed, file contents are not read here. Temporary files left behind by an interrupted write are removed once they are as old as the ones in cam/tmp.
+        """
+
+        mtime = os.stat(self.img_directory).st_mtime
+        if mtime == self.dir_mtime:
+            return
+
+        limit = time.time() - 3600*self.tmp_max_age_hours
+
+        names = set()
+        with os.scandir(self.img_directory) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                if NAME_PATTERN.match(entry.name):
+                    names.add(entry.name)
+                elif entry.name.endswith(".tmp") and entry.stat().st_mtime < limit:
+                    os.remove(entry.path)
+                    d_print("Retention: removed temporary file {}", 1, entry.name)
+
+        for name in names - set(self.files):
+            self.update(name, None, False)
+
+        for name in set(self.files) - names:
+            self.forget(name)
+
+        self.dir_mtime = mtime
+
+
+    def forget(self, name):
+        """
+        Remove a file from the index.
+
+        :param name: file name
+        """
+
+        self.unindex(name)
+        sha = self.files.pop(name)["sha"]
+        if sha is not None and self.hashes.get(sha) == name:
+            del self.hashes[sha]
+
+        self.dirty = True
+
+
+    def delete(self, name):
+        """
+        Delete a capture together with its pyramid levels.
+
+        :param name: file name of the capture
+        """
+
+        match = NAME_PATTERN.match(name)
+        for other in [name] + sorted(self.levels.get("{}_{}".format(match.group("kind"), match.group("stamp")), [])):
+            try:
+                os.remove("{}/{}".format(self.img_directory, other))
+            except FileNotFoundError:
+                pass
+            self.forget(other)
+
+        d_print("Retention: deleted {}", 1, name)
+
+
+    @staticmethod
+    def age_days(name, now):
+        """
+        Get the age of a capture in days from the timestamp in its file name.
+
+        :param name: file name
+        :param now: current datetime
+        :return: age in days
+        """
+
+        stamp = datetime.datetime.strptime(NAME_PATTERN.match(name).group("stamp"), "%Y%m%d-%H%M%S")
+
+        return (now - stamp).total_seconds()/86400
+
+
+    def deduplicate(self, name, budget):
+        """
+        Hash a capture and, if an identical file is already known, replace it by a hard link to that file so the contents are only stored once. The file is read in chunks, at most budget bytes per call: a file that does not fit is hashed further by the next call, unless it changed in between.
+
+        :param name: file name
+        :param budget: maximum number of bytes to read
+        :return: number of bytes read
+        """
+
+        path = "{}/{}".format(self.img_directory, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.forget(name)
+            return 0
+
+        key = [st.st_ino, st.st_size, st.st_mtime_ns]
+        partial = self.partial
+        if partial is None or partial["name"] != name or partial["key"] != key:
+            partial = dict(name = name, key = key, sha = hashlib.sha256(), offset = 0)
+
+        read = 0
+        end = False
+        with open(path, 'rb') as f:
+            f.seek(partial["offset"])
+            while read < budget:
+                chunk = f.read(min(CHUNK_SIZE, budget - read))
+                if not chunk:
+                    end = True
+                    break
+                partial["sha"].update(chunk)
+                read += len(chunk)
+        partial["offset"] += read
+
+        if not end and partial["offset"] < st.st_size:
+            self.partial = partial
+            return read
+        self.partial = None
+
+        sha = partial["sha"].hexdigest()
+        self.update(name, sha, self.files[name]["compacted"])
+        canonical = self.hashes.get(sha)
+
+        if canonical is None or canonical == name:
+            self.hashes[sha] = name
+        elif not os.path.samefile(path, "{}/{}".format(self.img_directory, canonical)):
+            tmp_path = path + ".tmp"
+            try:
+                os.link("{}/{}".format(self.img_directory, canonical), tmp_path)
+                os.replace(tmp_path, path)
+                d_print("Retention: {} is a duplicate of {}", 1, name, canonical)
+            except OSError as e:
+                d_print("Retention: could not link duplicate {}: {}", 2, name, e)
+
+        return read
+
+
+    def compact(self, name):
+        """
+        Downsample and re-encode a capture in place.
+
+        :param name: file name
+        :return: number of bytes read plus written
+        """
+
+        path = "{}/{}".format(self.img_directory, name)
+        ext = NAME_PATTERN.match(name).group("ext")
+        size = os.path.getsize(path)
+
+        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            d_print("Retention: could not read {}, skipping compaction", 2, name)
+            self.update(name, self.files[name]["sha"], True)
+            return size
+
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        for i in range(self.compact_levels):
+            img = cv2.pyrDown(img)
+
+        # write next to the original first so a crash never leaves a half written capture
+        buf = self.encoder.encode(img, ext)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(buf.tobytes())
+        os.replace(tmp_path, path)
+
+        # the contents changed, so the hash has to be computed again
+        self.forget(name)
+        self.update(name, None, True)
+
+        d_print("Retention: compacted {} from {} to {} bytes", 1, name, size, buf.size)
+
+        return size + buf.size
+
+
+    def clean_tmp(self):
+        """
+        Delete files from cam/tmp that were not touched for a while.
+        """
+
+        limit = time.time() - 3600*self.tmp_max_age_hours
+
+        with os.scandir(self.tmp_directory) as it:
+            for entry in it:
+                if entry.is_file() and entry.stat().st_mtime < limit:
+                    os.remove(entry.path)
+                    d_print("Retention: removed temporary file {}", 1, entry.name)
+
+
+    def step(self):
+        """
+        Perform one bounded step of retention work: apply the deletion policies, then hash new captures and compact old ones until the io budget is spent.
+
+        :return: number of bytes read plus written in this step
+        """
+
+        self.refresh()
+        self.clean_tmp()
+
+        now = datetime.datetime.now()
+
+        # deletion only costs metadata operations, so it is not limited by the budget, the oldest captures of every kind
+        # are deleted until the rest are within the limits
+        for kind, captures in self.captures.items():
+            while captures:
+                name = captures[0][1]
+                if self.max_count is not None and len(captures) > self.max_count:
+                    self.delete(name)
+                elif self.delete_after_days is not None and self.age_days(name, now) > self.delete_after_days:
+                    self.delete(name)
+                else:
+                    break
+
+        spent = 0
+
+        # hash new files first (newest first, finishing a file that did not fit in the previous step before anything
+        # else), then compact old captures (oldest first)
+        while self.unhashed and spent < self.io_budget:
+            name = self.unhashed[-1][1]
+            if self.partial is not None and self.partial["name"] in self.files and self.files[self.partial["name"]]["sha"] is None:
+                name = self.partial["name"]
+            spent += self.deduplicate(name, self.io_budget - spent)
+
+        if self.compact_after_days is not None:
+            while self.uncompacted and spent < self.io_budget:
+                name = self.uncompacted[0][1]
+                if self.age_days(name, now) <= self.compact_after_days:
+                    break
+                spent += self.compact(name)
+
+        self.save_state()
+
+        return spent
+
+
+    def run(self):
+        """
+        Keep performing steps until stop() is called.
+        """
+
+        while not self.stop_event.is_set():
+            try:
+                self.step()
+            except Exception as e:
+                d_print("Retention step failed: {}", 3, e)
+
+            self.stop_event.wait(self.interval)
+
+
+    def start(self):
+        """
+        Start performing steps in a background thread.
+        """
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        Stop the background thread after the current step.
+        """
+
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
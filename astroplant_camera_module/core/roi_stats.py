@@ -0,0 +1,107 @@
+"""
+Implementation of the region of interest statistics engine.
+Builds integral images of a frame once, after which the mean and variance of any rectangular region can be looked up in constant time.
+"""
+
+import cv2
+
+import numpy as np
+
+
+class ROI_STATS(object):
+    def __init__(self, img):
+        """
+        Build the integral and squared integral images of a frame. This is the only pass over the full frame, every query afterwards only reads four values per table.
+
+        :param img: 8 bit, 32 bit float or 64 bit float array, either single channel or multichannel (for example rgb)
+        """
+
+        self.shape = img.shape
+        self.sums, self.sqsums = cv2.integral2(img, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+
+    @staticmethod
+    def as_array(rois):
+        """
+        Turn regions into an array of [x_min, y_min, x_max, y_max] rows. Regions can be given as such lists or as dicts with x_min, y_min, x_max and y_max keys (like the crop and ground_plane settings).
+
+        :param rois: list of regions
+        :return: integer array of shape (regions, 4)
+        """
+
+        rows = []
+        for roi in rois:
+            if isinstance(roi, dict):
+                rows.append([roi["x_min"], roi["y_min"], roi["x_max"], roi["y_max"]])
+            else:
+                rows.append(list(roi))
+
+        return np.array(rows, dtype=np.intp).reshape(-1, 4)
+
+
+    def box(self, table, rois):
+        """
+        Look up the sums over a number of regions in one of the integral tables.
+
+        :param table: integral table
+        :param rois: integer array of shape (regions, 4)
+        :return: array of shape (regions,) or (regions, channels)
+        """
+
+        x0, y0, x1, y1 = rois.T
+
+        return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+
+    def means_vars(self, rois):
+        """
+        Compute the mean and variance of many regions at once.
+
+        :param rois: list of regions, see as_array
+        :return: (means, variances), arrays of shape (regions,) or (regions, channels)
+        """
+
+        rois = self.as_array(rois)
+        area = ((rois[:, 2] - rois[:, 0])*(rois[:, 3] - rois[:, 1])).astype(np.float64)
+        if len(self.shape) == 3:
+            area = area[:, np.newaxis]
+
+        means = self.box(self.sums, rois)/area
+        variances = np.maximum(self.box(self.sqsums, rois)/area - np.square(means), 0.0)
+
+        return (means, variances)
+
+
+    def mean(self, roi):
+        """
+        Mean of a single region.
+
+        :param roi: region as [x_min, y_min, x_max, y_max] or dict
+        :return: scalar, or array with a value per channel
+        """
+
+        return self.means_vars([roi])[0][0]
+
+
+    def std(self, roi):
+        """
+        Standard deviation of a single region.
+
+        :param roi: region as [x_min, y_min, x_max, y_max] or dict
+        :return: scalar, or array with a value per channel
+        """
+
+        return np.sqrt(self.means_vars([roi])[1][0])
+
+
+    def mean_std(self, roi):
+        """
+        Mean and standard deviation of a single region.
+
+        :param roi: region as [x_min, y_min, x_max, y_max] or dict
+        :return: (mean, std), scalars or arrays with a value per channel
+        """
+
+        means, variances = self.means_vars([roi])
+
+        return (means[0], np.sqrt(variances[0]))
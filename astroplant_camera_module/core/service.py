@@ -0,0 +1,391 @@
+"""
+Implementation of the camera service.
+Hosts a single camera behind a JSON-RPC interface on a local unix socket, so the host process only needs the thin client in misc/client.py and doesn't carry cv2, numpy, matplotlib and picamera in memory. Commands are queued and executed by a bounded number of workers.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+
+from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.core.publisher import to_json
+from astroplant_camera_module.typedef import CC, LC
+
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+QUEUE_FULL = -32000
+UNKNOWN_JOB = -32001
+
+
+class RPC_ERROR(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class SERVICE_JOB(object):
+    def __init__(self, job_id, command: CC):
+        """
+        A command waiting in, or taken from, the command queue of the service.
+
+        :param job_id: unique id of the job
+        :param command: (C)amera (C)ommand to execute
+        """
+
+        self.id = job_id
+        self.command = command
+        self.state = "queued"
+        self.result = None
+        self.error = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+
+    def info(self):
+        """
+        Describe the job for the client.
+
+        :return: dict with id, command, state, result, error and timestamps
+        """
+
+        info = dict()
+        info["id"] = self.id
+        info["command"] = self.command
+        info["state"] = self.state
+        info["result"] = self.result
+        info["error"] = self.error
+        info["queued"] = self.queued
+        info["started"] = self.started
+        info["finished"] = self.finished
+
+        return info
+
+
+class SERVICE(object):
+    def __init__(self, *args, camera, socket_path, workers = 1, max_queue = 16, keep_jobs = 100, **kwargs):
+        """
+        Initialize the service for a camera. The camera only has one sensor and one set of lights, so commands are executed one at a time by default. More workers only make sense for cameras that can handle concurrent commands.
+
+        :param camera: camera object (for example PI_CAM_NOIR_V21)
+        :param socket_path: path of the unix socket the service listens on
+        :param workers: number of commands executed concurrently
+        :param max_queue: maximum number of queued commands, further commands are refused
+        :param keep_jobs: number of finished jobs that are remembered for status requests
+        """
+
+        self.camera = camera
+        self.socket_path = socket_path
+        self.workers = workers
+        self.keep_jobs = keep_jobs
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.jobs = dict()
+        self.finished = []
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+        self.server = None
+        self.threads = []
+        self.stopped = threading.Event()
+
+        self.methods = dict()
+        self.methods["ping"] = self.rpc_ping
+        self.methods["do"] = self.rpc_do
+        self.methods["submit"] = self.rpc_submit
+        self.methods["status"] = self.rpc_status
+        self.methods["wait"] = self.rpc_wait
+        self.methods["stats"] = self.rpc_stats
+        self.methods["shutdown"] = self.rpc_shutdown
+
+
+    def enqueue(self, command: CC):
+        """
+        Put a command in the queue.
+
+        :param command: (C)amera (C)ommand
+        :return: SERVICE_JOB
+        """
+
+        if command not in [v for k, v in vars(CC).items() if not k.startswith("_")]:
+            raise RPC_ERROR(INVALID_PARAMS, "unknown command '{}'".format(command))
+
+        job = SERVICE_JOB(next(self.ids), command)
+
+        # known before a worker can take it, so its status can be requested (and it can be forgotten) as soon as it runs
+        with self.lock:
+            self.jobs[job.id] = job
+
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                self.jobs.pop(job.id, None)
+            raise RPC_ERROR(QUEUE_FULL, "command queue is full")
+
+        return job
+
+
+    def work(self):
+        """
+        Execute commands from the queue until a None is taken from it.
+        """
+
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+
+            job.state = "running"
+            job.started = time.time()
+            d_print("Service running job {} ({})...", 1, job.id, job.command)
+
+            try:
+                res = self.camera.do(job.command)
+                # round trip through json, so numpy values become plain values once
+                job.result = json.loads(json.dumps(res, default=to_json))
+                job.state = "done"
+            except Exception as e:
+                d_print("Service job {} raised an exception: {}", 3, job.id, e)
+                job.error = str(e)
+                job.state = "error"
+
+            job.finished = time.time()
+            job.done.set()
+
+            # forget the oldest finished jobs
+            with self.lock:
+                self.finished.append(job.id)
+                while len(self.finished) > self.keep_jobs:
+                    self.jobs.pop(self.finished.pop(0), None)
+
+
+    def get_job(self, params):
+        try:
+            with self.lock:
+                return self.jobs[params["job"]]
+        except KeyError:
+            raise RPC_ERROR(UNKNOWN_JOB, "unknown job")
+
+
+    def rpc_ping(self, params):
+        return "pong"
+
+
+    def rpc_submit(self, params):
+        """
+        Queue a command and return immediately. Params: {"command": ...}
+        """
+
+        return self.enqueue(params.get("command")).info()
+
+
+    def rpc_wait(self, params):
+        """
+        Wait for a job to finish. Params: {"job": ..., "timeout": seconds (optional)}
+        """
+
+        job = self.get_job(params)
+        job.done.wait(params.get("timeout"))
+
+        return job.info()
+
+
+    def rpc_do(self, params):
+        """
+        Queue a command and wait for its result. Params: {"command": ..., "timeout": seconds (optional)}
+        """
+
+        job = self.enqueue(params.get("command"))
+        job.done.wait(params.get("timeout"))
+
+        return job.info()
+
+
+    def rpc_status(self, params):
+        """
+        Get the state of a job. Params: {"job": ...}
+        """
+
+        return self.get_job(params).info()
+
+
+    def rpc_stats(self, params):
+        stats = dict()
+        stats["queued"] = self.queue.qsize()
+        stats["workers"] = self.workers
+        stats["calibrated"] = self.camera.CALIBRATED
+        stats["ndvi_capable"] = self.camera.NDVI_CAPABLE
+        stats["light_channels"] = self.camera.light_channels
+
+        return stats
+
+
+    def rpc_shutdown(self, params):
+        threading.Thread(target=self.stop, daemon=True).start()
+
+        return "stopping"
+
+
+    def handle(self, line):
+        """
+        Handle a single JSON-RPC 2.0 request.
+
+        :param line: request as bytes
+        :return: response dict, or None for notifications
+        """
+
+        request_id = None
+        try:
+            try:
+                request = json.loads(line.decode())
+            except ValueError:
+                raise RPC_ERROR(PARSE_ERROR, "parse error")
+
+            if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+                raise RPC_ERROR(INVALID_REQUEST, "invalid request")
+
+            request_id = request.get("id")
+            method = self.methods.get(request["method"])
+            if method is None:
+                raise RPC_ERROR(METHOD_NOT_FOUND, "method '{}' not found".format(request["method"]))
+
+            params = request.get("params", dict())
+            if not isinstance(params, dict):
+                raise RPC_ERROR(INVALID_PARAMS, "params should be an object")
+
+            result = method(params)
+            if "id" not in request:
+                return None
+
+            return {"jsonrpc": "2.0", "id": request_id, "result": result}
+        except RPC_ERROR as e:
+            return {"jsonrpc": "2.0", "id": request_id, "error": {"code": e.code, "message": e.message}}
+        except Exception as e:
+            d_print("Service request failed: {}", 3, e)
+            return {"jsonrpc": "2.0", "id": request_id, "error": {"code": INTERNAL_ERROR, "message": str(e)}}
+
+
+    def start(self):
+        """
+        Start the workers and listen on the socket in background threads.
+        """
+
+        service = self
+
+        class HANDLER(socketserver.StreamRequestHandler):
+            def handle(self):
+                # one request per line, one response per line
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    response = service.handle(line)
+                    if response is not None:
+                        self.wfile.write(json.dumps(response, default=to_json).encode() + b"\n")
+                        self.wfile.flush()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, HANDLER)
+        self.server.daemon_threads = True
+
+        self.threads = [threading.Thread(target=self.work, daemon=True) for i in range(self.workers)]
+        self.threads.append(threading.Thread(target=self.server.serve_forever, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+        d_print("Service listening on {}", 1, self.socket_path)
+
+
+    def stop(self):
+        """
+        Stop listening, let the workers finish the queued commands and stop them. Only the first of concurrent calls (a shutdown request and a signal) does so.
+        """
+
+        with self.lock:
+            server, self.server = self.server, None
+        if server is None:
+            return
+
+        server.shutdown()
+        server.server_close()
+
+        for i in range(self.workers):
+            self.queue.put(None)
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self.threads = []
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.stopped.set()
+        d_print("Service stopped.", 1)
+
+
+    def run(self):
+        """
+        Run the service until SIGINT/SIGTERM is received or a shutdown request comes in.
+        """
+
+        signal.signal(signal.SIGINT, lambda *args: self.stop())
+        signal.signal(signal.SIGTERM, lambda *args: self.stop())
+
+        self.stopped.clear()
+        self.start()
+        while not self.stopped.wait(1):
+            pass
+
+
+def main():
+    """
+    Entry point of the service: python3 -m astroplant_camera_module.core.service --socket /run/astroplant/camera.sock --pins white=17,red=3,nir=4
+    """
+
+    parser = argparse.ArgumentParser(description="Host an AstroPlant camera behind a JSON-RPC interface on a unix socket.")
+    parser.add_argument("--socket", default="/tmp/astroplant-camera.sock", help="path of the unix socket")
+    parser.add_argument("--camera", default="noir", choices=["noir", "v21"], help="camera to host")
+    parser.add_argument("--working-directory", default=os.getcwd(), help="working directory of the camera")
+    parser.add_argument("--pins", default="", help="light pins as channel=pin pairs, for example white=17,red=3,nir=4 (requires pigpio)")
+    parser.add_argument("--workers", type=int, default=1, help="number of commands executed concurrently")
+    parser.add_argument("--max-queue", type=int, default=16, help="maximum number of queued commands")
+    args = parser.parse_args()
+
+    if args.camera == "noir":
+        from astroplant_camera_module.cameras.pi_cam_noir_v21 import PI_CAM_NOIR_V21 as CAMERA_CLASS, SETTINGS_V5
+    else:
+        from astroplant_camera_module.cameras.pi_cam_V21 import PI_CAM_V21 as CAMERA_CLASS, SETTINGS_V5
+
+    kwargs = dict()
+    if args.pins:
+        import pigpio
+        from astroplant_camera_module.core.light import LIGHT_MANAGER
+
+        pins = dict(pair.split("=") for pair in args.pins.split(","))
+        kwargs["light_control"] = LIGHT_MANAGER(gpio = pigpio.pi(), pins = {channel: int(pin) for channel, pin in pins.items()})
+        kwargs["light_channels"] = list(pins)
+    else:
+        kwargs["light_channels"] = [LC.GROWTH]
+
+    camera = CAMERA_CLASS(settings = SETTINGS_V5(), working_directory = args.working_directory, **kwargs)
+
+    SERVICE(camera = camera, socket_path = args.socket, workers = args.workers, max_queue = args.max_queue).run()
+
+
+if __name__ == "__main__":
+    main()
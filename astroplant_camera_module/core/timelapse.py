@@ -0,0 +1,213 @@
+"""
+Implementation of the time-lapse builder.
+Appends every photo the camera writes to a video segment per kind and per day, as it is written. The segments are motion jpeg streams (jpeg frames one after the other), so frames are appended without encoding anything and segments are joined into longer videos by concatenating them.
+"""
+
+import argparse
+import os
+import threading
+
+from astroplant_camera_module.misc.debug_print import d_print
+from astroplant_camera_module.core.retention import NAME_PATTERN
+
+
+class TIMELAPSE(object):
+    def __init__(self, *args, working_directory, level = 2, kinds = None, **kwargs):
+        """
+        Initialize a time-lapse builder. Segments are written to cam/timelapse/<kind>/<yyyymmdd>.mjpeg, with an index of the frames in <yyyymmdd>.idx (one "timestamp offset length" line per frame).
+
+        :param working_directory: working directory of the camera
+        :param level: pyramid level of the photos the frames are taken from (0 for the full resolution, 2 for a quarter of the resolution, ...), only jpeg files can be used
+        :param kinds: list of kinds of photos to make time-lapses of, as named in the file names (for example "white" or "ndvi2"), None for all kinds
+        """
+
+        self.directory = "{}/cam/timelapse".format(working_directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.level = level
+        self.kinds = kinds
+        self.lock = threading.Lock()
+
+
+    def add_result(self, res):
+        """
+        Append the photos of a result (as returned by camera.do()) to their time-lapses. Results that reuse the photos of a previous one (see core/change.py) add nothing.
+
+        :param res: result dict
+        """
+
+        if not isinstance(res, dict) or not res.get("contains_photo") or res.get("reused"):
+            return
+
+        pyramids = res.get("pyramid_path", [[] for path in res["photo_path"]])
+        for path, pyramid in zip(res["photo_path"], pyramids):
+            self.add(path, pyramid)
+
+
+    def add(self, photo_path, pyramid_paths = ()):
+        """
+        Append a photo to the time-lapse of its kind.
+
+        :param photo_path: path of the photo, named <kind>_<yyyymmdd-hhmmss>.<ext>
+        :param pyramid_paths: paths of the downscaled versions of the photo, from large to small
+        :return: True if a frame was appended
+        """
+
+        match = NAME_PATTERN.match(os.path.basename(photo_path))
+        if match is None:
+            return False
+
+        kind = match.group("kind")
+        if self.kinds is not None and kind not in self.kinds:
+            return False
+
+        # take the frame from the requested pyramid level, or the smallest one available
+        paths = [photo_path] + list(pyramid_paths)
+        source = paths[min(self.level, len(paths) - 1)]
+        if os.path.splitext(source)[1].lower() not in [".jpg", ".jpeg"]:
+            d_print("Time-lapse can't use {}, only jpeg frames can be appended", 2, source)
+            return False
+
+        with open(source, 'rb') as f:
+            data = f.read()
+
+        self.append(kind, match.group("stamp"), data)
+
+        return True
+
+
+    def paths(self, kind, day):
+        path = "{}/{}/{}".format(self.directory, kind, day)
+
+        return (path + ".mjpeg", path + ".idx")
+
+
+    def indexed_end(self, index_path):
+        """
+        End of the last complete frame of a segment, anything after it is the remainder of an interrupted append.
+
+        :param index_path: path of the index of the segment
+        :return: number of bytes
+        """
+
+        end = 0
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 3:
+                        end = int(fields[1]) + int(fields[2])
+
+        return end
+
+
+    def append(self, kind, stamp, data):
+        """
+        Append a jpeg frame to the segment of its day.
+
+        :param kind: kind of the photo
+        :param stamp: timestamp of the photo as yyyymmdd-hhmmss
+        :param data: bytes of the jpeg file
+        """
+
+        with self.lock:
+            os.makedirs("{}/{}".format(self.directory, kind), exist_ok=True)
+            segment_path, index_path = self.paths(kind, stamp[:8])
+
+            # the frame is only listed in the index once it is written completely
+            offset = self.indexed_end(index_path)
+            with open(segment_path, 'ab') as f:
+                f.truncate(offset)
+                f.write(data)
+            with open(index_path, 'a') as f:
+                f.write("{} {} {}\n".format(stamp, offset, len(data)))
+
+
+    def kinds_available(self):
+        """
+        :return: list of kinds that have a time-lapse
+        """
+
+        return sorted(name for name in os.listdir(self.directory) if os.path.isdir("{}/{}".format(self.directory, name)))
+
+
+    def days(self, kind):
+        """
+        :param kind: kind of photo
+        :return: list of the days (yyyymmdd) that have a segment, oldest first
+        """
+
+        directory = "{}/{}".format(self.directory, kind)
+        if not os.path.isdir(directory):
+            return []
+
+        return sorted(name[:-len(".mjpeg")] for name in os.listdir(directory) if name.endswith(".mjpeg"))
+
+
+    def build(self, kind, path = None, first = None, last = None):
+        """
+        Join the segments of a kind into a single video by concatenating them, without decoding or encoding anything. The result is a motion jpeg stream that can be played as is, or put in a container without re-encoding, for example: ffmpeg -framerate 10 -f mjpeg -i white.mjpeg -c copy white.avi
+
+        :param kind: kind of photo
+        :param path: path of the video, cam/timelapse/<kind>.mjpeg by default
+        :param first: first day (yyyymmdd) to include, None for the first segment
+        :param last: last day (yyyymmdd) to include, None for the last segment
+        :return: dict with the path, the number of frames and the number of bytes of the video
+        """
+
+        if path is None:
+            path = "{}/{}.mjpeg".format(self.directory, kind)
+
+        info = dict()
+        info["path"] = path
+        info["frames"] = 0
+        info["bytes"] = 0
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as out:
+            for day in self.days(kind):
+                if (first is not None and day < first) or (last is not None and day > last):
+                    continue
+
+                with self.lock:
+                    segment_path, index_path = self.paths(kind, day)
+                    end = self.indexed_end(index_path)
+                    with open(index_path, 'r') as f:
+                        info["frames"] += sum(1 for line in f if line.strip())
+
+                    # copy up to the last complete frame
+                    with open(segment_path, 'rb') as f:
+                        remaining = end
+                        while remaining > 0:
+                            chunk = f.read(min(remaining, 1024*1024))
+                            if not chunk:
+                                break
+                            out.write(chunk)
+                            remaining -= len(chunk)
+                    info["bytes"] += end - remaining
+
+        os.replace(tmp_path, path)
+        d_print("Time-lapse of {}: {} frames, {} bytes in {}", 1, kind, info["frames"], info["bytes"], path)
+
+        return info
+
+
+def main():
+    """
+    Build the full time-lapses: python3 -m astroplant_camera_module.core.timelapse --working-directory . --kind white
+    """
+
+    parser = argparse.ArgumentParser(description="Join the daily time-lapse segments of the camera into videos.")
+    parser.add_argument("--working-directory", default=os.getcwd(), help="working directory of the camera")
+    parser.add_argument("--kind", action="append", help="kind of photo (for example white or ndvi2), all kinds by default")
+    parser.add_argument("--first", help="first day to include (yyyymmdd)")
+    parser.add_argument("--last", help="last day to include (yyyymmdd)")
+    args = parser.parse_args()
+
+    timelapse = TIMELAPSE(working_directory = args.working_directory)
+    for kind in args.kind or timelapse.kinds_available():
+        timelapse.build(kind, first = args.first, last = args.last)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Implementation of the capture watchdog.
+Puts a deadline on every stage that runs in a worker process (a raspistill capture, the plotter, ...), kills workers that hang and decides whether a failed capture is retried, with an exponential backoff within a latency budget.
+"""
+
+import queue
+import time
+
+from astroplant_camera_module.misc.debug_print import d_print
+
+
+# deadlines in seconds of the stages, named like their tracing spans
+DEADLINES = {
+    "exposure": 30,
+    "plot": 60,
+}
+
+
+class STAGE_TIMEOUT(Exception):
+    def __init__(self, stage, deadline):
+        """
+        Raised when a stage does not finish within its deadline, after its worker was killed.
+
+        :param stage: name of the stage
+        :param deadline: deadline of the stage in seconds
+        """
+
+        self.stage = stage
+        self.deadline = deadline
+        super().__init__("{} did not finish within {} seconds".format(stage, deadline))
+
+
+class WATCHDOG(object):
+    def __init__(self, *args, deadlines = None, retries = 2, backoff = 1.0, max_backoff = 8.0, budget = 90.0, **kwargs):
+        """
+        Initialize a watchdog.
+
+        :param deadlines: dict of deadlines in seconds by stage, overriding the ones in DEADLINES
+        :param retries: maximum number of retries of a failed capture
+        :param backoff: seconds to wait before the first retry, doubled for every next one
+        :param max_backoff: maximum number of seconds to wait before a retry
+        :param budget: maximum number of seconds spent on a capture including retries, a retry is only started if it (taking as long as the last attempt) fits
+        """
+
+        self.deadlines = dict(DEADLINES)
+        self.deadlines.update(deadlines or dict())
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+
+
+    def deadline(self, stage):
+        return self.deadlines.get(stage, max(self.deadlines.values()))
+
+
+    def kill(self, p):
+        """
+        Stop a worker process, forcefully if it does not react to SIGTERM.
+
+        :param p: multiprocessing.Process
+        """
+
+        p.terminate()
+        p.join(2)
+        if p.is_alive():
+            p.kill()
+            p.join()
+
+
+    def join(self, p, stage):
+        """
+        Wait for a worker process to finish, for at most the deadline of the stage.
+
+        :param p: started multiprocessing.Process
+        :param stage: name of the stage
+        """
+
+        deadline = self.deadline(stage)
+        p.join(deadline)
+        if p.is_alive():
+            d_print("Worker of stage '{}' hangs, killing it...", 3, stage)
+            self.kill(p)
+            raise STAGE_TIMEOUT(stage, deadline)
+
+
+    def get(self, q, stage, p):
+        """
+        Wait for the result a worker process puts in a queue, for at most the deadline of the stage. Gives up early if the worker exits without a result.
+
+        :param q: multiprocessing queue
+        :param stage: name of the stage
+        :param p: started multiprocessing.Process that puts the result
+        :return: the result
+        """
+
+        deadline = self.deadline(stage)
+        end = time.monotonic() + deadline
+        while True:
+            try:
+                return q.get(timeout=min(0.5, max(0.0, end - time.monotonic())))
+            except queue.Empty:
+                pass
+
+            if not p.is_alive():
+                # the result may have been put just before the worker exited
+                try:
+                    return q.get(timeout=0.5)
+                except queue.Empty:
+                    raise EnvironmentError("worker of stage '{}' exited with code {} without a result".format(stage, p.exitcode))
+
+            if time.monotonic() >= end:
+                d_print("Worker of stage '{}' hangs, killing it...", 3, stage)
+                self.kill(p)
+                raise STAGE_TIMEOUT(stage, deadline)
+
+
+    def retry(self, failures, start, attempt_start):
+        """
+        Decide whether to retry a failed capture, and wait for the backoff if so.
+
+        :param failures: number of failed attempts so far
+        :param start: time.monotonic() at the start of the first attempt
+        :param attempt_start: time.monotonic() at the start of the failed attempt
+        :return: True if the capture should be tried again
+        """
+
+        backoff = min(self.backoff*2**(failures - 1), self.max_backoff)
+        now = time.monotonic()
+        if failures > self.retries or now + backoff + (now - attempt_start) - start > self.budget:
+            return False
+
+        d_print("Retrying in {:.1f} s...", 2, backoff)
+        time.sleep(backoff)
+
+        return True
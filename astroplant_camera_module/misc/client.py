@@ -0,0 +1,126 @@
+"""
+Thin client for the camera service (see core/service.py).
+Only uses the standard library, so the host process doesn't need to import cv2, numpy, matplotlib or picamera to use the camera.
+"""
+
+import itertools
+import json
+import socket
+
+
+class CAMERA_SERVICE_ERROR(Exception):
+    def __init__(self, code, message):
+        super().__init__("{} ({})".format(message, code))
+        self.code = code
+        self.message = message
+
+
+class CAMERA_CLIENT(object):
+    def __init__(self, *args, socket_path = "/tmp/astroplant-camera.sock", timeout = None, **kwargs):
+        """
+        Initialize a client for the camera service. A connection is made per call, so the client survives restarts of the service.
+
+        :param socket_path: path of the unix socket of the service
+        :param timeout: socket timeout in seconds (None to wait as long as the command takes)
+        """
+
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.ids = itertools.count(1)
+
+
+    def call(self, method, **params):
+        """
+        Call a method of the service.
+
+        :param method: name of the method
+        :param params: parameters of the method
+        :return: result of the call, raises CAMERA_SERVICE_ERROR if the service returned an error
+        """
+
+        request = {"jsonrpc": "2.0", "id": next(self.ids), "method": method, "params": params}
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(self.timeout)
+            s.connect(self.socket_path)
+            s.sendall(json.dumps(request).encode() + b"\n")
+            with s.makefile('rb') as f:
+                response = json.loads(f.readline().decode())
+
+        if "error" in response:
+            raise CAMERA_SERVICE_ERROR(response["error"]["code"], response["error"]["message"])
+
+        return response["result"]
+
+
+    def ping(self):
+        """
+        :return: True if the service is up
+        """
+
+        try:
+            return self.call("ping") == "pong"
+        except (OSError, ValueError):
+            return False
+
+
+    def do(self, command, timeout = None):
+        """
+        Execute a command and wait for it, like camera.do().
+
+        :param command: (C)amera (C)ommand, see typedef.py
+        :param timeout: maximum number of seconds to wait for the result
+        :return: result dict of the camera, or None if the command failed or did not finish in time
+        """
+
+        job = self.call("do", command = command, timeout = timeout)
+
+        return job["result"]
+
+
+    def submit(self, command):
+        """
+        Queue a command without waiting for it.
+
+        :param command: (C)amera (C)ommand, see typedef.py
+        :return: job id
+        """
+
+        return self.call("submit", command = command)["id"]
+
+
+    def status(self, job):
+        """
+        :param job: job id
+        :return: dict with the id, command, state ("queued", "running", "done" or "error"), result, error and timestamps of the job
+        """
+
+        return self.call("status", job = job)
+
+
+    def wait(self, job, timeout = None):
+        """
+        Wait for a queued command to finish.
+
+        :param job: job id
+        :param timeout: maximum number of seconds to wait
+        :return: dict like status()
+        """
+
+        return self.call("wait", job = job, timeout = timeout)
+
+
+    def stats(self):
+        """
+        :return: dict with the queue length and the state of the camera
+        """
+
+        return self.call("stats")
+
+
+    def shutdown(self):
+        """
+        Ask the service to stop after finishing the queued commands.
+        """
+
+        return self.call("shutdown")
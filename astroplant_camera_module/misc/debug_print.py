@@ -1,3 +1,5 @@
+import logging
+
 # set this parameter to the level which you still want to print
 SEVERITY = 3
 
@@ -7,12 +9,33 @@ WRN_PRINT = 2
 ERR_PRINT = 3
 FTL_PRINT = 4
 
-def d_print(str, lvl):
-    if DBG_PRINT >= SEVERITY and lvl == DBG_PRINT:
-        print("DEBUG: " + str)
-    elif WRN_PRINT >= SEVERITY and lvl == WRN_PRINT:
-        print("WARNING: " + str)
-    elif ERR_PRINT >= SEVERITY and lvl == ERR_PRINT:
-        print("ERROR: " + str)
-    elif FTL_PRINT >= SEVERITY and lvl == FTL_PRINT:
-        print("FATAL: " + str)
+# the logging levels the defined levels map to
+LEVELS = {DBG_PRINT: logging.DEBUG, WRN_PRINT: logging.WARNING, ERR_PRINT: logging.ERROR, FTL_PRINT: logging.CRITICAL}
+
+# all messages go through this logger, by default it prints them with a timestamp
+logger = logging.getLogger("astroplant_camera_module")
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+def d_print(str, lvl, *args):
+    """
+    Print a message if its level is at least SEVERITY. The message is only formatted (with str.format) when it is actually printed, so pass the arguments separately instead of formatting them at the call site:
+
+        d_print("Measured ag: {} for channel {}", 1, ag, channel)
+
+    :param str: message, optionally containing {} fields for the arguments
+    :param lvl: level of the message, one of DBG_PRINT, WRN_PRINT, ERR_PRINT and FTL_PRINT
+    :param args: arguments that are formatted into the message
+    """
+
+    if lvl < SEVERITY:
+        return
+
+    if args:
+        str = str.format(*args)
+
+    logger.log(LEVELS.get(lvl, logging.ERROR), str)
@@ -0,0 +1,125 @@
+import collections
+import json
+import os
+import threading
+import time
+
+
+class NULL_SPAN(object):
+    """
+    Span that does nothing, returned when tracing is disabled so spans cost (almost) nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class SPAN(object):
+    def __init__(self, tracer, name, args):
+        """
+        A timed section of code, recorded in the tracer when it is exited. Spans can be nested, nesting is derived from the timestamps when the trace is viewed.
+
+        :param tracer: tracer the span is recorded in
+        :param name: name of the span
+        :param args: dict with extra information shown with the span
+        """
+
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.record(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class TRACER(object):
+    def __init__(self, *args, enabled = False, max_events = 10000, **kwargs):
+        """
+        Initialize a tracer that records nested spans (for example light switching, exposure, decoding, processing and encoding) and exports them in the Chrome trace format (chrome://tracing or https://ui.perfetto.dev).
+
+        :param enabled: whether spans are recorded
+        :param max_events: maximum number of spans kept, the oldest ones are dropped first
+        """
+
+        self.enabled = enabled
+        self.events = collections.deque(maxlen=max_events)
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+
+    def span(self, name, **args):
+        """
+        Create a span, to be used as a context manager:
+
+            with tracer.span("decode", channel=channel):
+                ...
+
+        :param name: name of the span
+        :param args: extra information shown with the span
+        :return: context manager
+        """
+
+        if not self.enabled:
+            return _null_span
+
+        return SPAN(self, name, args)
+
+
+    def record(self, name, start, end, args):
+        """
+        Record a finished span.
+
+        :param name: name of the span
+        :param start: start time as given by time.perf_counter
+        :param end: end time as given by time.perf_counter
+        :param args: extra information shown with the span
+        """
+
+        event = dict()
+        event["name"] = name
+        event["ph"] = "X"
+        event["ts"] = 1e6*(start - self.origin)
+        event["dur"] = 1e6*(end - start)
+        event["pid"] = os.getpid()
+        event["tid"] = threading.get_ident()
+        event["args"] = {key: str(value) for key, value in args.items()}
+
+        with self.lock:
+            self.events.append(event)
+
+
+    def export(self, path):
+        """
+        Write all recorded spans to a file in the Chrome trace (JSON) format.
+
+        :param path: path of the trace file
+        """
+
+        with self.lock:
+            events = list(self.events)
+
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+    def clear(self):
+        """
+        Forget all recorded spans.
+        """
+
+        with self.lock:
+            self.events.clear()
+
+
+_null_span = NULL_SPAN()
+
+# tracer shared by the whole module, enable it with tracer.enabled = True
+tracer = TRACER()
@@ -19,6 +19,8 @@ class CC(object):
 
     # calibrate the camera and the lights
     CALIBRATE = "CALIBRATE"
+    # calibrate only the lights whose calibration is stale, failed or missing
+    CALIBRATE_STALE = "CALIBRATE_STALE"
     # update camera settings if camera needs this (for example, redetermine gains etc)
     UPDATE = "UPDATE"
 
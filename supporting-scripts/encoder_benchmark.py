@@ -0,0 +1,50 @@
+import time
+import sys
+import os
+
+import numpy as np
+
+from PIL import Image
+
+from astroplant_camera_module.core.encoder import ENCODER
+
+# script that encodes a photo and an ndvi matrix with all encoder options and prints the size/time trade-offs
+if __name__ == "__main__":
+    # photo to encode, defaults to one of the result photos
+    path = sys.argv[1] if len(sys.argv) > 1 else "../results/img/nir_plant.jpg"
+    rgb = np.array(Image.open(path).convert("RGB"))
+
+    # fake ndvi matrix with the same dimensions, derived from the photo so it compresses like a real one
+    ndvi = np.clip((rgb[:,:,0].astype(np.float64) - 128.0)/128.0, -1.0, 1.0)
+
+    out = "/tmp/encoder_benchmark"
+    N = 5
+
+    options = [
+        ("jpg q70", dict(photo_format="jpg", jpeg_quality=70), "photo"),
+        ("jpg q90", dict(photo_format="jpg", jpeg_quality=90), "photo"),
+        ("jpg q95", dict(photo_format="jpg", jpeg_quality=95), "photo"),
+        ("png c1", dict(photo_format="png", png_compression=1), "photo"),
+        ("png c3", dict(photo_format="png", png_compression=3), "photo"),
+        ("png c9", dict(photo_format="png", png_compression=9), "photo"),
+        ("webp q80", dict(photo_format="webp", webp_quality=80), "photo"),
+        ("webp lossless", dict(photo_format="webp", webp_quality=101), "photo"),
+        ("ndvi tif8 (legacy)", dict(ndvi_format="tif8"), "ndvi"),
+        ("ndvi tif16 lzw", dict(ndvi_format="tif16", tiff_compression=5), "ndvi"),
+        ("ndvi tif16 deflate", dict(ndvi_format="tif16", tiff_compression=8), "ndvi"),
+    ]
+
+    print("{:<20} {:>12} {:>12}".format("option", "bytes", "time [ms]"))
+    for name, kwargs, kind in options:
+        encoder = ENCODER(**kwargs)
+
+        times = []
+        for i in range(N):
+            if kind == "photo":
+                info = encoder.write_photo(out, rgb)
+            else:
+                info = encoder.write_ndvi(out, ndvi)
+            times.append(info["encode_time"])
+            os.remove(info["path"])
+
+        print("{:<20} {:>12} {:>12.1f}".format(name, info["bytes"], 1000*np.median(times)))
@@ -5,92 +5,53 @@ import matplotlib.pyplot as plt
 
 from PIL import Image
 
+from astroplant_camera_module.core.roi_stats import ROI_STATS
+
 def get_row(array, row):
     return array[row, :]
 
 def get_col(array, col):
     return array[:, col]
 
-if __name__ == "__main__":
-    with open("red_rf.field", 'rb') as f:
-        red = np.load(f)
-    with open("nir_rf.field", 'rb') as f:
-        nir = np.load(f)
-
-    # create a list for the calculated reflectances
-    R_nir = []
-    R_red = []
-
-    # calculate for the lower right corner of the picture
-    nir_zeroth = np.mean(nir[950:975, 1175:1200])
-    nir_first = np.mean(nir[1070:1095, 1195:1220])
-    nir_second = np.mean(nir[1070:1095, 1260:1285])
-    nir_black = np.mean(nir[625:650, 1515:1540])
-
-    R_nir.append((nir_first-nir_black)/(nir_zeroth-nir_black))
-    R_nir.append((nir_second-nir_black)/(nir_first-nir_black))
-
-    red_zeroth = np.mean(red[950:975, 1175:1200])
-    red_first = np.mean(red[1070:1095, 1195:1220])
-    red_second = np.mean(red[1070:1095, 1260:1285])
-    red_black = np.mean(red[625:650, 1515:1540])
-
-    R_red.append((red_first-red_black)/(red_zeroth-red_black))
-    R_red.append((red_second-red_black)/(red_first-red_black))
+def reflectances(stats, corners, black):
+    """
+    Calculate the first and second order reflectances for every corner with a single lookup of all the regions.
 
-    # calculate for the upper right corner
-    nir_zeroth = np.mean(nir[195:220, 1150:1175])
-    nir_first = np.mean(nir[195:220, 1220:1245])
-    nir_second = np.mean(nir[130:155, 1220:1245])
-    nir_black = np.mean(nir[625:650, 1515:1540])
+    :param stats: ROI_STATS of the field
+    :param corners: list of (zeroth, first, second) regions per corner, as [x_min, y_min, x_max, y_max]
+    :param black: region of a black part of the image
+    :return: array with the first and second reflectance for every corner
+    """
 
-    R_nir.append((nir_first-nir_black)/(nir_zeroth-nir_black))
-    R_nir.append((nir_second-nir_black)/(nir_first-nir_black))
+    rois = [roi for corner in corners for roi in corner] + [black]
+    means, _ = stats.means_vars(rois)
 
-    red_zeroth = np.mean(red[195:220, 1150:1175])
-    red_first = np.mean(red[195:220, 1220:1245])
-    red_second = np.mean(red[130:155, 1220:1245])
-    red_black = np.mean(red[625:650, 1515:1540])
+    zeroth, first, second = (means[i:-1:3] - means[-1] for i in range(3))
 
-    R_red.append((red_first-red_black)/(red_zeroth-red_black))
-    R_red.append((red_second-red_black)/(red_first-red_black))
+    return np.stack([first/zeroth, second/first], axis=1).flatten()
 
-    # calculate for the upper left corner
-    nir_zeroth = np.mean(nir[198:223, 410:435])
-    nir_first = np.mean(nir[198:223, 275:300])
-    nir_second = np.mean(nir[125:150, 275:300])
-    nir_black = np.mean(nir[625:650, 1515:1540])
-
-    R_nir.append((nir_first-nir_black)/(nir_zeroth-nir_black))
-    R_nir.append((nir_second-nir_black)/(nir_first-nir_black))
-
-    red_zeroth = np.mean(red[198:223, 410:435])
-    red_first = np.mean(red[198:223, 275:300])
-    red_second = np.mean(red[125:150, 275:300])
-    red_black = np.mean(red[625:650, 1515:1540])
-
-    R_red.append((red_first-red_black)/(red_zeroth-red_black))
-    R_red.append((red_second-red_black)/(red_first-red_black))
-
-    # calculate for the lower left corner
-    nir_zeroth = np.mean(nir[980:1005, 345:370])
-    nir_first = np.mean(nir[1075:1100, 340:365])
-    nir_second = np.mean(nir[1075:1100, 250:275])
-    nir_black = np.mean(nir[625:650, 1515:1540])
-
-    R_nir.append((nir_first-nir_black)/(nir_zeroth-nir_black))
-    R_nir.append((nir_second-nir_black)/(nir_first-nir_black))
-
-    red_zeroth = np.mean(red[980:1005, 345:370])
-    red_first = np.mean(red[1075:1100, 340:365])
-    red_second = np.mean(red[1075:1100, 250:275])
-    red_black = np.mean(red[625:650, 1515:1540])
+if __name__ == "__main__":
+    with open("red_rf.field", 'rb') as f:
+        red = np.load(f)
+    with open("nir_rf.field", 'rb') as f:
+        nir = np.load(f)
 
-    R_red.append((red_first-red_black)/(red_zeroth-red_black))
-    R_red.append((red_second-red_black)/(red_first-red_black))
+    # 25x25 pixel regions [x_min, y_min, x_max, y_max] used per corner: zeroth, first and second reflection
+    corners = [
+        # lower right corner of the picture
+        ([1175, 950, 1200, 975], [1195, 1070, 1220, 1095], [1260, 1070, 1285, 1095]),
+        # upper right corner
+        ([1150, 195, 1175, 220], [1220, 195, 1245, 220], [1220, 130, 1245, 155]),
+        # upper left corner
+        ([410, 198, 435, 223], [275, 198, 300, 223], [275, 125, 300, 150]),
+        # lower left corner
+        ([345, 980, 370, 1005], [340, 1075, 365, 1100], [250, 1075, 275, 1100]),
+    ]
+    black = [1515, 625, 1540, 650]
 
-    R_nir = np.array(R_nir)
-    R_red = np.array(R_red)
+    # create a list for the calculated reflectances
+    R_nir = reflectances(ROI_STATS(nir), corners, black)
+    R_red = reflectances(ROI_STATS(red), corners, black)
 
     print("red reflectance: {:.2f} \pm {:.2f}".format(np.mean(R_red), np.std(R_red)))
     print("nir reflectance: {:.2f} \pm {:.2f}".format(np.mean(R_nir), np.std(R_nir)))
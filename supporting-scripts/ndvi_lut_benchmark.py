@@ -0,0 +1,66 @@
+import time
+import sys
+
+import numpy as np
+
+from PIL import Image
+
+from astroplant_camera_module.core.ndvi import ndvi_rows, ndvi_table, ndvi_lookup_rows, reflectance
+
+# script that checks that the lookup table ndvi equals the arithmetic ndvi exactly and compares their speed
+def arithmetic(r, v, factor_r, mask_r, factor_nir, mask_nir):
+    Rr = reflectance(r, factor_r, mask_r)
+    Rnir = reflectance(v, factor_nir, mask_nir)
+    ndvi = np.empty_like(Rr)
+    ndvi_rows(ndvi, Rr, Rnir)
+
+    return ndvi
+
+def lookup(r, v, factor_r, mask_r, factor_nir, mask_nir, dtype = None):
+    table = ndvi_table(reflectance(np.arange(256), factor_r, mask_r), reflectance(np.arange(256), factor_nir, mask_nir), dtype = dtype)
+    ndvi = np.empty(r.shape, dtype = table.dtype)
+    ndvi_lookup_rows(ndvi, r, v, table)
+
+    return ndvi
+
+if __name__ == "__main__":
+    # red and nir photos, defaults to the result photos
+    path_r = sys.argv[1] if len(sys.argv) > 1 else "../results/img/red_plant.jpg"
+    path_nir = sys.argv[2] if len(sys.argv) > 2 else "../results/img/nir_plant.jpg"
+    r = np.array(Image.open(path_r).convert("RGB"))[:,:,0]
+    v = np.array(Image.open(path_nir).convert("HSV"))[:,:,2]
+    shape = (min(r.shape[0], v.shape[0]), min(r.shape[1], v.shape[1]))
+    r = np.ascontiguousarray(r[:shape[0], :shape[1]])
+    v = np.ascontiguousarray(v[:shape[0], :shape[1]])
+
+    # every combination of 8 bit values, and a few sets of scale factors (gain correction and flatfield value per channel)
+    all_r, all_v = np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8), indexing="ij")
+    scales = [(0.8, 120.0, 0.8, 90.0), (0.8*2.2/1.7, 97.3, 0.8*1.9/2.6, 143.1), (0.8*1.5/3.0, 31.7, 0.8*3.0/1.0, 250.2)]
+
+    print("exact equivalence:")
+    for scale in scales:
+        for name, (a, b) in [("all pairs", (all_r, all_v)), ("photos", (r, v))]:
+            equal = np.array_equal(arithmetic(a, b, *scale), lookup(a, b, *scale), equal_nan=True)
+            print("    {:<10} {:<40} {}".format(name, str(tuple(round(s, 3) for s in scale)), equal))
+            if not equal:
+                sys.exit(1)
+
+    N = 10
+    scale = scales[1]
+    options = [
+        ("arithmetic", lambda: arithmetic(r, v, *scale)),
+        ("lookup float64", lambda: lookup(r, v, *scale)),
+        ("lookup int8", lambda: lookup(r, v, *scale, dtype=np.int8)),
+        ("lookup uint8", lambda: lookup(r, v, *scale, dtype=np.uint8)),
+    ]
+
+    print("\n{} x {} pixels".format(*shape))
+    print("{:<20} {:>12}".format("path", "time [ms]"))
+    for name, fn in options:
+        times = []
+        for i in range(N):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+
+        print("{:<20} {:>12.1f}".format(name, 1000*np.median(times)))
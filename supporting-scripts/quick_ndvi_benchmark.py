@@ -0,0 +1,71 @@
+import time
+import sys
+
+import cv2
+import numpy as np
+
+from PIL import Image
+
+from astroplant_camera_module.core.ndvi import ndvi_table, ndvi_lookup_rows, reflectance
+
+# script that compares the quick (low resolution) ndvi mean with the full resolution ndvi mean, for a number of scale
+# factors, and times both. Every resolution gets its own flatfield value, like the camera calibrates them.
+def downsample(img, factor):
+    if factor == 1:
+        return img
+    return cv2.resize(img, (img.shape[1]//factor, img.shape[0]//factor), interpolation=cv2.INTER_AREA)
+
+def prepare(rgb_r, rgb_nir, ff_r, ff_nir, factor):
+    # capture at the lower resolution (done by the image processor on the camera) and calibrate at that resolution,
+    # the photos are assumed to be taken at the calibration gain
+    rgb_r = downsample(rgb_r, factor)
+    rgb_nir = downsample(rgb_nir, factor)
+    table = ndvi_table(reflectance(np.arange(256), 0.8, downsample(ff_r, factor).mean()), reflectance(np.arange(256), 0.8, downsample(ff_nir, factor).mean()))
+
+    return (rgb_r, rgb_nir, table)
+
+def ndvi_mean(rgb_r, rgb_nir, table):
+    # the processing of every poll (the table is cached by the camera)
+    r = rgb_r[:,:,0]
+    v = cv2.cvtColor(rgb_nir, cv2.COLOR_RGB2HSV)[:,:,2]
+    ndvi = np.empty(r.shape, dtype=table.dtype)
+    ndvi_lookup_rows(ndvi, r, v, table)
+    ndvi[0, 0] = 1.0
+
+    return np.mean(ndvi[ndvi > 0.2])
+
+if __name__ == "__main__":
+    # pairs of red and nir photos and the flatfields, defaults to the result photos
+    pairs = [("../results/img/red_plant.jpg", "../results/img/nir_plant.jpg"), ("../results/img/red_leafs.jpg", "../results/img/nir_leafs.jpg")]
+    if len(sys.argv) > 2:
+        pairs = [(sys.argv[1], sys.argv[2])]
+    ff_r = np.load("../results/cfg/red.ff")
+    ff_nir = np.load("../results/cfg/nir.ff")
+
+    N = 10
+    factors = [1, 2, 4, 8]
+
+    for path_r, path_nir in pairs:
+        rgb_r = np.array(Image.open(path_r).convert("RGB"))
+        rgb_nir = np.array(Image.open(path_nir).convert("RGB"))
+        # cut to a multiple of the largest factor, so every factor scales by an integer
+        shape = (min(rgb_r.shape[0], rgb_nir.shape[0], ff_r.shape[0])//factors[-1]*factors[-1], min(rgb_r.shape[1], rgb_nir.shape[1], ff_r.shape[1])//factors[-1]*factors[-1])
+        rgb_r = np.ascontiguousarray(rgb_r[:shape[0], :shape[1]])
+        rgb_nir = np.ascontiguousarray(rgb_nir[:shape[0], :shape[1]])
+        ff_r_cut = np.ascontiguousarray(ff_r[:shape[0], :shape[1]])
+        ff_nir_cut = np.ascontiguousarray(ff_nir[:shape[0], :shape[1]])
+
+        print("\n{} + {} ({} x {} pixels)".format(path_r, path_nir, *shape))
+        print("{:<8} {:>12} {:>12} {:>12}".format("factor", "ndvi", "error", "time [ms]"))
+        full = None
+        for factor in factors:
+            frames = prepare(rgb_r, rgb_nir, ff_r_cut, ff_nir_cut, factor)
+            times = []
+            for i in range(N):
+                start = time.perf_counter()
+                mean = ndvi_mean(*frames)
+                times.append(time.perf_counter() - start)
+            if full is None:
+                full = mean
+
+            print("{:<8} {:>12.4f} {:>12.4f} {:>12.1f}".format(factor, mean, mean - full, 1000*np.median(times)))
@@ -1,38 +1,9 @@
 from __future__ import print_function
 
 import picamera
-from picamera import mmal, mmalobj, exc
-from picamera.mmalobj import to_rational
 import time
 
-
-MMAL_PARAMETER_ANALOG_GAIN = mmal.MMAL_PARAMETER_GROUP_CAMERA + 0x59
-MMAL_PARAMETER_DIGITAL_GAIN = mmal.MMAL_PARAMETER_GROUP_CAMERA + 0x5A
-
-def set_gain(camera, gain, value):
-    """Set the analog gain of a PiCamera.
-
-    camera: the picamera.PiCamera() instance you are configuring
-    gain: either MMAL_PARAMETER_ANALOG_GAIN or MMAL_PARAMETER_DIGITAL_GAIN
-    value: a numeric value that can be converted to a rational number.
-    """
-    if gain not in [MMAL_PARAMETER_ANALOG_GAIN, MMAL_PARAMETER_DIGITAL_GAIN]:
-        raise ValueError("The gain parameter was not valid")
-    ret = mmal.mmal_port_parameter_set_rational(cam._camera.control._port,
-                                                    gain,
-                                                    to_rational(value))
-    if ret == 4:
-        raise exc.PiCameraMMALError(ret, "Are you running the latest version of the userland libraries? Gain setting was introduced in late 2017.")
-    elif ret != 0:
-        raise exc.PiCameraMMALError(ret)
-
-def set_analog_gain(camera, value):
-    """Set the gain of a PiCamera object to a given value."""
-    set_gain(camera, MMAL_PARAMETER_ANALOG_GAIN, value)
-
-def set_digital_gain(camera, value):
-    """Set the digital gain of a PiCamera object to a given value."""
-    set_gain(camera, MMAL_PARAMETER_DIGITAL_GAIN, value)
+from astroplant_camera_module.cameras.picamera_backend import set_analog_gain, set_digital_gain
 
 
 if __name__ == "__main__":
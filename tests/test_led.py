@@ -1,28 +1,10 @@
 import pigpio
-import time
 import os
 
-from astroplant_camera_module.misc.debug_print import d_print
 from astroplant_camera_module.typedef import CC, LC
 from astroplant_camera_module.cameras.pi_cam_noir_v21 import PI_CAM_NOIR_V21, SETTINGS_V5
-from misc import set_all_lights_to_zero
-
-def light_control_curry(pi):
-    def light_control(channel: LC, state):
-        d_print("Setting {} camera lighting state to {}".format(channel, state), 1)
-
-        if channel == LC.WHITE:
-            pi.write(17, state)
-        elif channel == LC.RED:
-            pi.write(3, state)
-        elif channel == LC.NIR:
-            pi.write(4, state)
-        else:
-            d_print("no such light available", 3)
-
-        time.sleep(0.1)
-
-    return light_control
+from astroplant_camera_module.core.light import LIGHT_MANAGER
+from misc import set_all_lights_to_zero, light_pins
 
 if __name__ == "__main__":
     pi = pigpio.pi()
@@ -30,7 +12,8 @@ if __name__ == "__main__":
     set_all_lights_to_zero(pi)
 
     # set up parameters for the camera
-    light_control = light_control_curry(pi)
+    # the light manager switches the pins directly, in a single bank write per change
+    light_control = LIGHT_MANAGER(gpio = pi, pins = {LC.WHITE: light_pins["white"], LC.RED: light_pins["red"], LC.NIR: light_pins["nir"]})
     light_channels = [LC.WHITE, LC.RED, LC.NIR]
     settings = SETTINGS_V5()
     wd = os.getcwd()